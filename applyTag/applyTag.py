@@ -23,6 +23,9 @@ def applyTag(tag, devices, clear = False):
     # Authenticate to Trellix API
     session = trellixAPI.Trellix()
 
+    # Estimate queries: tag id, device ids by chunks of names, then apply tag for each device
+    session.estimate(1 + len(session.deviceNameChunks(devices)) + len(devices))
+
     # Get tag id
     tag_id = session.getTagId(tag)
 
@@ -31,37 +34,25 @@ def applyTag(tag, devices, clear = False):
         sys.exit()
     logger.info('{0} tag id is {1}.'.format(tag, tag_id))
 
-    # Apply tag on each device
-    for device in devices:
-        
-        # Get device id for each device in list
-        device_id = session.getDeviceId(device)
-        
-        # If device has been found in ePO
-        if device_id:
-            logger.info('Device {0} id: {1}'.format(device, device_id))
-
-            # If device is a list (duplicate entries for the same hostname)
-            if isinstance(device_id, list):
-                for id in device_id:
-                    if clear:
-                        logger.debug('Clearing tag on device {0} with id {1}'.format(device, id))
-                        session.clearTag(tag_id, id)
-                    else:
-                        logger.debug('Applying tag on device {0} with id {1}'.format(device, id))
-                        session.applyTag(tag_id, id)
-
-            elif clear:
-                logger.debug('Clearing tag on device {0} with id {1}'.format(device, device_id))
-                session.clearTag(tag_id, device_id)
+    # Get device ids for all devices in list
+    resolved, not_found = session.resolveDevices(devices)
+
+    # Apply tag on each device found in ePO
+    for device, device_ids in resolved.items():
+        logger.info('Device {0} id: {1}'.format(device, device_ids))
 
+        # Several ids if duplicate entries for the same hostname
+        for id in device_ids:
+            if clear:
+                logger.debug('Clearing tag on device {0} with id {1}'.format(device, id))
+                session.clearTag(tag_id, id)
             else:
-                logger.debug('Applying tag on device {0} with id {1}'.format(device, device_id))
-                session.applyTag(tag_id, device_id)
-            
-        # If device has not been found
-        elif device_id == 0:
-            logger.info('Device {0} not found'.format(device))
+                logger.debug('Applying tag on device {0} with id {1}'.format(device, id))
+                session.applyTag(tag_id, id)
+
+    # Devices that have not been found
+    for device in not_found:
+        logger.info('Device {0} not found'.format(device))
 
 
 def main():
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+#
+# Apply and clear many tags in a single run
+#
+# Copyright (C) 2023 Philippe Le Bescond
+#
+# Contact : philippe.le.bescond(at)trellix.com
+
+import argparse
+import csv
+import os
+import sys
+import math
+
+# Setting path for module import
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from lib.trellixAPI import logger
+from lib.inventory import Inventory
+from lib.bulkTag import BulkTag
+from lib.fleet import Fleet
+
+ACTIONS = ('apply', 'clear')
+
+
+def readJob(filename):
+    """
+    Read job file, each line formatted as device,tag[,action]
+    Action is 'apply' or 'clear', default is 'apply'. A header line starting with 'device' is skipped
+    Params: filename, string containing CSV file path
+    Result: dict formatted as "(tag, action)": [device names]
+    """
+
+    job = {}
+    with open(filename, 'r', newline = '') as job_file:
+        for line, row in enumerate(csv.reader(job_file), 1):
+            row = [field.strip() for field in row]
+            if not any(row) or (line == 1 and row[0].lower() == 'device'):
+                continue
+            if len(row) < 2 or not row[0] or not row[1]:
+                logger.error('Line {0} of {1} is not formatted as device,tag[,action]: {2}'.format(line, filename, row))
+                sys.exit()
+            action = row[2].lower() if len(row) > 2 and row[2] else 'apply'
+            if action not in ACTIONS:
+                logger.error('Line {0} of {1}: unknown action {2}, must be apply or clear'.format(line, filename, action))
+                sys.exit()
+            job.setdefault((row[1], action), []).append(row[0])
+    return job
+
+
+def applyTagJob(job, use_inventory = False, report_path = None):
+
+    # Authenticate to Trellix API
+    bulk = BulkTag()
+    session = bulk.session
+
+    devices = list(dict.fromkeys(name for names in job.values() for name in names))
+
+    # Estimate queries: tag catalog, device ids by chunks of names (or inventory sync and tags refresh, unless inventory is fresh),
+    # and tag queries by chunks
+    tag_queries = sum(len(bulk.chunks(names)) for names in job.values())
+    if use_inventory:
+        inventory = Inventory()
+        if inventory.isFresh():
+            session.estimate(1 + tag_queries)
+        else:
+            session.estimate(2 + tag_queries + math.ceil(session.getDeviceCount() / session.device_page_limit))
+    else:
+        session.estimate(1 + len(session.deviceNameChunks(devices)) + tag_queries)
+
+    # Device resolution is shared by all tags. From inventory, names are matched like on the whole device list:
+    # not case sensitive, and short names match FQDN. Tags are refreshed, as tags are skipped from inventory
+    if use_inventory:
+        inventory.refresh(session, tags = True)
+        session.deviceList = Fleet.fromRows(inventory.deviceRows())
+        resolved, ambiguous, not_found = session.lookupDevices(devices)
+    else:
+        resolved, not_found = session.resolveDevices(devices)
+
+    for device in not_found:
+        logger.error('Device {0} not found'.format(device))
+
+    rows = []
+    for (tag, action), names in job.items():
+
+        # Tag id from tag catalog, loaded once
+        tag_id = session.getTagId(tag)
+        if tag_id == 0:
+            logger.error('Tag {0} is not found, skipping {1} device(s)'.format(tag, len(names)))
+            rows.extend([name, '', tag, action, 'tag_not_found', ''] for name in names)
+            continue
+
+        # Device ids, several ids if duplicate entries for the same hostname
+        device_names = {}
+        for name in names:
+            for id in resolved.get(name, []):
+                device_names[int(id)] = name
+        ids = list(device_names)
+
+        # Skip devices where nothing changes, when tags are known from inventory
+        if use_inventory:
+            tagged = set(inventory.getDevicesWithTag(tag))
+            skipped = [id for id in ids if (id in tagged) == (action == 'apply')]
+            rows.extend([device_names[id], id, tag, action, 'unchanged', ''] for id in skipped)
+            ids = [id for id in ids if (id in tagged) != (action == 'apply')]
+
+        logger.info('Starting {0} tag {1} on {2} device(s).'.format(action, tag, len(ids)))
+        report = bulk.run(tag_id, ids, action == 'clear') if ids else {}
+        rows.extend([device_names[id], id, tag, action, result['outcome'], result['status'] or ''] for id, result in report.items())
+
+        # Keep local inventory up to date, tag changes are not visible in incremental sync
+        if use_inventory:
+            inventory.setTag([id for id, result in report.items() if result['outcome'] in ('done', 'unchanged')], tag, action == 'apply')
+
+    rows.extend([name, '', '', '', 'device_not_found', ''] for name in not_found)
+
+    # Devices which could not be tagged
+    for row in rows:
+        if row[4] not in ('done', 'unchanged'):
+            logger.error('Device {0} ({1}), {2} tag {3}: {4}'.format(row[0], row[1], row[3], row[2], row[4]))
+
+    if report_path:
+        with open(report_path, 'w', newline = '') as report_file:
+            writer = csv.writer(report_file)
+            writer.writerow(['name', 'id', 'tag', 'action', 'outcome', 'status'])
+            writer.writerows(rows)
+
+    return rows
+
+
+def main():
+
+    # Script usage
+    parser = argparse.ArgumentParser(description='Apply and clear many tags on device names in a single run', usage='applyTagJob.py [-i] [-r report] [jobfile]')
+    parser.add_argument('jobfile', type=str, help='CSV file, each line formatted as device,tag[,action] where action is apply (default) or clear')
+    parser.add_argument('-i', '--inventory', action='store_true', help = '(Optional) Use local inventory instead of resolving device names, if synced recently')
+    parser.add_argument('-r', '--report', type=str, help = '(Optional) CSV file where to write outcome of each device and tag')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    try:
+        job = readJob(args.jobfile)
+    except OSError:
+        logger.error('Error while opening {0} file'.format(args.jobfile))
+        sys.exit()
+
+    logger.warning('Running {0} tag operation(s) on {1} device(s).'.format(
+        len(job), len(set(name for names in job.values() for name in names))))
+
+    applyTagJob(job, args.inventory, args.report)
+
+    logger.warning('ApplyTagJob script done.')
+
+
+if __name__ == "__main__":
+    main()
@@ -11,16 +11,33 @@ import json
 import argparse
 import os
 import sys
+import math
 
 # Setting path for module import
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import lib.trellixAPI as trellixAPI
 from lib.trellixAPI import logger
+from lib.inventory import Inventory
+from lib.bulkTag import BulkTag, writeReport
+from lib.fleet import Fleet, FleetTags
 
-def applyTagOnMany(tag, devices, clear = False):
+def applyTagOnMany(tag, devices, clear = False, use_inventory = False, report_path = None):
     # Authenticate to Trellix API
-    session = trellixAPI.Trellix()
+    bulk = BulkTag()
+    session = bulk.session
+
+    # Local inventory, synced only if not fresh
+    if use_inventory:
+        inventory = Inventory()
+
+    # Estimate queries: tag id, all devices pages (unless inventory is fresh, with inventory sync if not) and one apply tag query per chunk
+    chunks = len(bulk.chunks(devices))
+    if use_inventory and inventory.isFresh():
+        session.estimate(1 + chunks)
+    else:
+        device_count = session.getDeviceCount()
+        session.estimate(1 + chunks + math.ceil(device_count / session.device_page_limit) + (1 if use_inventory else 0))
 
     # Get tag id
     tag_id = session.getTagId(tag)
@@ -31,15 +48,22 @@ def applyTagOnMany(tag, devices, clear = False):
     logger.info('{0} tag id is {1}.'.format(tag, tag_id))
 
 
-    # Get all devices in ePO
-    session.getAllDevices()
+    # Get all devices in ePO, or from local inventory, in compact fleet
+    if use_inventory:
+        inventory.refresh(session, tags = True)
+        fleet = Fleet.fromRows(inventory.deviceRows())
+        session.deviceList = fleet
+        session.tagsApplied = FleetTags(fleet)
+    else:
+        session.getAllDevices()
+        fleet = session.deviceList
 
-    # Filter device id in args
-    device_id_list = []
+    # Filter device id in args, using name index
+    resolved, ambiguous, not_found = session.lookupDevices(devices)
+    device_id_list = list(dict.fromkeys(id for ids in resolved.values() for id in ids))
 
-    for device in devices:
-        device_id = [i for i,j in session.deviceList.items() if j == device]
-        device_id_list.extend(device_id)
+    for device in not_found:
+        logger.info('Device {0} not found'.format(device))
 
     logger.info('Filtered device id list: {0}'.format(device_id_list))
 
@@ -49,7 +73,7 @@ def applyTagOnMany(tag, devices, clear = False):
     # Filter devices where operate tag applying or clearing
     for id in device_id_list:
         # XNOR with isTagApplied and clear
-        if not(session.isTagApplied(id, tag) ^ clear):
+        if not(fleet.hasTag(id, tag) ^ clear):
             device_list.append(id)  
         else:
             if clear:
@@ -59,15 +83,24 @@ def applyTagOnMany(tag, devices, clear = False):
 
     logger.info('devices list where applying or clearing tag: {0}'.format(device_list))
 
-    # Clearing or appling tag
+    # Clearing or appling tag by chunks
     if clear:
-        logger.debug('JSON system list where to clear tag {0}'.format(device_list))
         logger.info('Starting clear tag on {0} device(s).'.format(len(device_list)))
-        session.clearTag(tag_id, device_list)
     else:
-        logger.debug('JSON system list where to apply tag {0}'.format(device_list))
         logger.info('Starting apply tag on {0} device(s).'.format(len(device_list)))
-        session.applyTag(tag_id, device_list)    
+    report = bulk.run(tag_id, device_list, clear)
+
+    # Systems which could not be tagged
+    for device, result in report.items():
+        if result['outcome'] not in ('done', 'unchanged'):
+            logger.error('Device {0} ({1}): {2}, status code {3}'.format(session.deviceList.get(device), device, result['outcome'], result['status']))
+
+    if report_path:
+        writeReport(report, report_path, session.deviceList)
+
+    # Keep local inventory up to date, tag changes are not visible in incremental sync
+    if use_inventory:
+        inventory.setTag([device for device, result in report.items() if result['outcome'] in ('done', 'unchanged')], tag, not clear)
 
     logger.warning('ApplyTagOnMany script done.') 
 
@@ -78,6 +111,8 @@ def main():
     parser.add_argument('tag', type=str, help='Tag to apply on device. Must be already existing in ePO')
     parser.add_argument('filename', type=str, help='Filepath containing device names')
     parser.add_argument('-c', '--clear', action='store_true', help = '(Optional) Clear tag from system instead of apply')
+    parser.add_argument('-i', '--inventory', action='store_true', help = '(Optional) Use local inventory instead of gathering all systems, if synced recently')
+    parser.add_argument('-r', '--report', type=str, help = '(Optional) CSV file where to write outcome of each system')
 
     # Parse arguments
     args = parser.parse_args()
@@ -97,7 +132,7 @@ def main():
         logger.warning('Applying tag on {0} device(s).'.format(len(devices)))
 
     # Run applyTagOnMany
-    applyTagOnMany(args.tag, devices, args.clear)
+    applyTagOnMany(args.tag, devices, args.clear, args.inventory, args.report)
 
 
 if __name__ == "__main__":
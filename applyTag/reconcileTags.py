@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+#
+# Reconcile tags applied on systems with a desired state
+#
+# Copyright (C) 2023 Philippe Le Bescond
+#
+# Contact : philippe.le.bescond(at)trellix.com
+
+import argparse
+import csv
+import json
+import os
+import sys
+import math
+
+# Setting path for module import
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from lib.trellixAPI import logger
+from lib.inventory import Inventory
+from lib.bulkTag import BulkTag
+from lib.reconcile import planReconcile
+from lib.fleet import Fleet, FleetTags
+
+
+def readDesiredState(filename):
+    """
+    Read desired state file, each line formatted as device,tag
+    A device can be listed on several lines, one per tag, or with an empty tag to clear all managed tags
+    A header line starting with 'device' is skipped
+    Params: filename, string containing CSV file path
+    Result: dict formatted as "device name": set of tags
+    """
+
+    desired = {}
+    with open(filename, 'r', newline = '') as desired_file:
+        for line, row in enumerate(csv.reader(desired_file), 1):
+            row = [field.strip() for field in row]
+            if not any(row) or (line == 1 and row[0].lower() == 'device'):
+                continue
+            tags = desired.setdefault(row[0], set())
+            if len(row) > 1 and row[1]:
+                tags.add(row[1])
+    return desired
+
+
+def reconcileTags(desired, managed_tags = None, exclusive = False, dry_run = False, use_inventory = False, output = sys.stdout):
+
+    # Authenticate to Trellix API
+    bulk = BulkTag()
+    session = bulk.session
+
+    # Estimate queries: tag catalog and all devices pages (unless inventory is fresh, with inventory sync if not),
+    # tag queries are estimated with plan
+    if use_inventory:
+        inventory = Inventory()
+    if not (use_inventory and inventory.isFresh()):
+        session.estimate(1 + math.ceil(session.getDeviceCount() / session.device_page_limit) + (1 if use_inventory else 0))
+
+    # Actual state of all devices
+    if use_inventory:
+        inventory.refresh(session, tags = True)
+        fleet = Fleet.fromRows(inventory.deviceRows())
+        session.deviceList = fleet
+        session.tagsApplied = FleetTags(fleet)
+    else:
+        session.getAllDevices()
+
+    plan, not_found = planReconcile(desired, session.deviceList, session.deviceTags(), managed_tags, exclusive)
+
+    for device in not_found:
+        logger.error('Device {0} not found'.format(device))
+
+    # Plan, grouped by tag and action
+    operations = [{'tag': tag, 'action': action,
+                   'devices': [{'id': device, 'name': session.deviceList.get(device)} for device in sorted(ids)]}
+                  for tag, actions in sorted(plan.items()) for action, ids in sorted(actions.items())]
+    queries = sum(len(bulk.chunks([device['id'] for device in operation['devices']])) for operation in operations)
+    logger.warning('Reconcile plan: {0} operation(s), {1} tag queries'.format(len(operations), queries))
+
+    if dry_run:
+        json.dump({'operations': operations, 'queries': queries, 'not_found': not_found}, output, indent=4)
+        output.write('\n')
+        return operations
+
+    session.estimate(1 + queries)
+
+    # Apply plan, one bulk run per tag and action
+    for operation in operations:
+        tag_id = session.getTagId(operation['tag'])
+        if tag_id == 0:
+            logger.error('Tag {0} is not found, skipping {1} device(s)'.format(operation['tag'], len(operation['devices'])))
+            continue
+
+        ids = [device['id'] for device in operation['devices']]
+        report = bulk.run(tag_id, ids, operation['action'] == 'clear')
+        for device in operation['devices']:
+            device['outcome'] = report[device['id']]['outcome']
+            if device['outcome'] not in ('done', 'unchanged'):
+                logger.error('Device {0} ({1}), {2} tag {3}: {4}'.format(
+                    device['name'], device['id'], operation['action'], operation['tag'], device['outcome']))
+
+        # Keep local inventory up to date, tag changes are not visible in incremental sync
+        if use_inventory:
+            inventory.setTag([id for id, result in report.items() if result['outcome'] in ('done', 'unchanged')],
+                             operation['tag'], operation['action'] == 'apply')
+
+    return operations
+
+
+def main():
+
+    # Script usage
+    parser = argparse.ArgumentParser(description='Apply and clear tags so systems match a desired state',
+                                     usage='reconcileTags.py [-n] [-i] [-x] [-t tags] [desiredstate]')
+    parser.add_argument('desiredstate', type=str, help='CSV file, each line formatted as device,tag')
+    parser.add_argument('-n', '--dry-run', action='store_true', help = '(Optional) Only output plan in JSON, without applying or clearing tags')
+    parser.add_argument('-t', '--tags', type=str, help = '(Optional) Comma separated list of tags to reconcile. Default is all tags in desired state')
+    parser.add_argument('-x', '--exclusive', action='store_true', help = '(Optional) Clear reconciled tags from systems not listed in desired state')
+    parser.add_argument('-i', '--inventory', action='store_true', help = '(Optional) Use local inventory instead of gathering all systems, if synced recently')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    try:
+        desired = readDesiredState(args.desiredstate)
+    except OSError:
+        logger.error('Error while opening {0} file'.format(args.desiredstate))
+        sys.exit()
+
+    managed_tags = set(tag.strip() for tag in args.tags.split(',') if tag.strip()) if args.tags else None
+
+    logger.warning('Reconciling tags on {0} device(s).'.format(len(desired)))
+    reconcileTags(desired, managed_tags, args.exclusive, args.dry_run, args.inventory)
+    logger.warning('ReconcileTags script done.')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+#
+# Filter benchmark: pulling all threat events versus client side and server side filtering
+#
+# Copyright (C) 2023 Philippe Le Bescond
+#
+# Contact : philippe.le.bescond(at)trellix.com
+
+import argparse
+import os
+import sys
+import time
+
+# Setting path for module import
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from standInServer import StandInServer, useStandInProfile
+
+# Fields kept by a SIEM only interested in detections
+FIELDS = ['timestamp', 'autoguid', 'agentguid', 'analyzer', 'analyzerhostname', 'analyzeripv4', 'analyzerdetectionmethod',
+          'sourceprocessname', 'targetusername', 'targetfilename', 'targethash', 'threatcategory', 'threatseverity',
+          'threatname', 'threatactiontaken']
+
+
+def run(label, server, session, event_filter, pushdown):
+
+    from lib.sinks import encodeEvent
+
+    # Pull all events again
+    session.threat_events_cursor = ''
+    session.events_pushdown = pushdown
+    server.resetStats()
+
+    start = time.perf_counter()
+    count = 0
+    output = 0
+    for events, cursor in session.iterThreatEventPages(event_filter):
+        count += len(events)
+        output += sum(len(encodeEvent(event)) for event in events)
+    elapsed = time.perf_counter() - start
+
+    print('{0:<22} {1:>8} events {2:>6} queries {3:>9.1f} MB received {4:>9.1f} MB written {5:>7.2f} s'.format(
+        label, count, server.stats['requests'], server.stats['bytes'] / 1024 / 1024, output / 1024 / 1024, elapsed))
+
+
+def main():
+
+    # Script usage
+    parser = argparse.ArgumentParser(description='Compare pulling all threat events with client side and server side filtering',
+                                     usage='filterBenchmark.py [-n events] [-S max_severity]')
+    parser.add_argument('-n', '--events', type=int, default=100000, help='Number of synthetic events. Default is 100000')
+    parser.add_argument('-S', '--severity', type=int, default=3, help='Highest severity kept. Default is 3')
+    args = parser.parse_args()
+
+    # Start stand-in server and point profile to it before loading the library
+    server = StandInServer(devices=0, events=args.events).start()
+    useStandInProfile(server)
+
+    import lib.trellixAPI as trellixAPI
+    from lib.eventFilter import EventFilter
+
+    session = trellixAPI.Trellix()
+    event_filter = EventFilter(args.severity, ['ENDP_AM_1070', 'ENDP_AP_1070'], fields=FIELDS)
+
+    run('no filter', server, session, None, False)
+    run('client side filter', server, session, event_filter, False)
+    run('server side filter', server, session, event_filter, True)
+
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
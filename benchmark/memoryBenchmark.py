@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+#
+# Memory benchmark: device list and tags in dicts versus compact fleet
+#
+# Copyright (C) 2023 Philippe Le Bescond
+#
+# Contact : philippe.le.bescond(at)trellix.com
+
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+# Setting path for module import
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from standInServer import StandInServer, useStandInProfile
+
+TAGS = ['Workstation', 'Server', 'Quarantine', 'Laptop', 'Datacenter', 'Windows', 'Linux', 'VIP', 'Pilot', 'Legacy']
+
+
+def syntheticFleet(count):
+    # Same shape as getAllDevices data: id, FQDN name and 1 to 4 tags per device
+    rng = random.Random(count)
+    for i in range(1, count + 1):
+        yield i, 'host{0:07d}.corp.local'.format(i), ', '.join(rng.sample(TAGS, rng.randint(1, 4)))
+
+
+def measure(label, build):
+    # Build time without tracing, then memory of a second build, as tracing slows allocations down
+    gc.collect()
+    start = time.perf_counter()
+    structure = build()
+    elapsed = time.perf_counter() - start
+    del structure
+    gc.collect()
+    tracemalloc.start()
+    structure = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{0:<28} {1:>9.1f} MB {2:>8.2f} s build'.format(label, current / 1024 / 1024, elapsed))
+    return structure
+
+
+def timed(label, function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    elapsed = time.perf_counter() - start
+    print('    {0:<36} {1:>10.3f} ms'.format(label, elapsed * 1000 / repeat))
+    return result
+
+
+def main():
+
+    # Script usage
+    parser = argparse.ArgumentParser(description='Compare memory and tag query time of dicts and compact fleet',
+                                     usage='memoryBenchmark.py [-n devices] [-c checks]')
+    parser.add_argument('-n', '--devices', type=int, default=1000000, help='Number of synthetic devices. Default is 1000000')
+    parser.add_argument('-c', '--checks', type=int, default=100000, help='Number of tag membership checks. Default is 100000')
+    args = parser.parse_args()
+
+    # Library needs a profile, no query is sent
+    server = StandInServer(devices=0).start()
+    useStandInProfile(server)
+
+    from lib.trellixAPI import splitTags
+    from lib.fleet import Fleet
+
+    checks = [random.randint(1, args.devices) for _ in range(args.checks)]
+
+    # Previous structure: Trellix.deviceList and Trellix.tagsApplied
+    def dicts():
+        device_list = {}
+        tags_applied = {}
+        for device, name, tags in syntheticFleet(args.devices):
+            device_list[device] = name
+            tags_applied[device] = tags
+        return device_list, tags_applied
+
+    device_list, tags_applied = measure('dicts', dicts)
+    timed('{0} isTagApplied (split)'.format(args.checks),
+          lambda: sum('VIP' in tags_applied[device].split(', ') for device in checks), 1)
+    timed('Server but not Windows',
+          lambda: [device for device, tags in tags_applied.items() if 'Server' in splitTags(tags) and 'Windows' not in splitTags(tags)], 1)
+    del device_list, tags_applied
+
+    # Compact fleet
+    def fleet():
+        fleet = Fleet()
+        for device, name, tags in syntheticFleet(args.devices):
+            fleet.add(device, name, tags)
+        return fleet
+
+    fleet = measure('fleet', fleet)
+    timed('{0} hasTag'.format(args.checks), lambda: sum(fleet.hasTag(device, 'VIP') for device in checks), 1)
+    selected = timed('Server but not Windows', lambda: fleet.select(['Server'], none_of = ['Windows']), 5)
+    timed('count Server', lambda: fleet.count('Server'), 5)
+    print('    {0} devices with Server but not Windows'.format(len(selected)))
+
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
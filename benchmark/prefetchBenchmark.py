@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+#
+# Prefetch benchmark: serial paging versus read-ahead paging
+#
+# Copyright (C) 2023 Philippe Le Bescond
+#
+# Contact : philippe.le.bescond(at)trellix.com
+
+import argparse
+import os
+import sys
+import time
+
+# Setting path for module import
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from standInServer import StandInServer, useStandInProfile
+
+
+def run(label, server, session, depth, work):
+
+    session.prefetch_depth = depth
+    server.resetStats()
+    start = time.perf_counter()
+    count = 0
+    for device in session.iterAllProperties():
+        count += 1
+        # Simulated processing time for each device (decode, write to output...)
+        time.sleep(work)
+    elapsed = time.perf_counter() - start
+
+    print('{0:<22} {1:>8} devices {2:>6} queries {3:>8.2f} s'.format(label, count, server.stats['requests'], elapsed))
+
+
+def main():
+
+    # Script usage
+    parser = argparse.ArgumentParser(description='Compare serial paging with read-ahead paging on a full fleet scan',
+                                     usage='prefetchBenchmark.py [-n devices] [-p page] [-l latency] [-w work] [-d depth]')
+    parser.add_argument('-n', '--devices', type=int, default=10000, help='Number of devices. Default is 10000')
+    parser.add_argument('-p', '--page', type=int, default=100, help='Devices per page. Default is 100')
+    parser.add_argument('-l', '--latency', type=float, default=0.2, help='Simulated server latency per query in seconds. Default is 0.2')
+    parser.add_argument('-w', '--work', type=float, default=0.002, help='Simulated processing time per device in seconds. Default is 0.002')
+    parser.add_argument('-d', '--depth', type=int, default=2, help='Prefetch depth. Default is 2')
+    args = parser.parse_args()
+
+    # Start stand-in server and point profile to it before loading the library
+    server = StandInServer(devices=args.devices, latency=args.latency).start()
+    useStandInProfile(server, device_page_limit=args.page)
+
+    import lib.trellixAPI as trellixAPI
+
+    session = trellixAPI.Trellix()
+
+    run('serial', server, session, 0, args.work)
+    run('prefetch depth {0}'.format(args.depth), server, session, args.depth, args.work)
+
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+#
+# Pooled session benchmark: one connection per query versus keep-alive session
+#
+# Copyright (C) 2023 Philippe Le Bescond
+#
+# Contact : philippe.le.bescond(at)trellix.com
+
+import argparse
+import os
+import sys
+import time
+
+import requests
+
+# Setting path for module import
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from standInServer import StandInServer, useStandInProfile
+
+
+def run(label, server, query, devices):
+
+    server.resetStats()
+    start = time.perf_counter()
+    for device in devices:
+        query(device)
+    elapsed = time.perf_counter() - start
+
+    print('{0:<22} {1:>8} queries {2:>8} connections {3:>9.3f} ms/query {4:>8.2f} s'.format(
+        label, server.stats['requests'], server.stats['connections'], elapsed * 1000 / len(devices), elapsed))
+
+
+def main():
+
+    # Script usage
+    parser = argparse.ArgumentParser(description='Compare per-query connections with pooled keep-alive session',
+                                     usage='sessionBenchmark.py [-n devices] [-l latency] [-k handshake]')
+    parser.add_argument('-n', '--devices', type=int, default=10000, help='Number of getDeviceId queries. Default is 10000')
+    parser.add_argument('-l', '--latency', type=float, default=0.0, help='Simulated server latency per query in seconds')
+    parser.add_argument('-k', '--handshake', type=float, default=0.002, help='Simulated handshake latency per connection in seconds')
+    args = parser.parse_args()
+
+    # Start stand-in server and point profile to it before loading the library
+    server = StandInServer(devices=args.devices, latency=args.latency, handshake_latency=args.handshake).start()
+    useStandInProfile(server)
+
+    import lib.trellixAPI as trellixAPI
+
+    session = trellixAPI.Trellix()
+    devices = ['host{0}'.format(i) for i in range(1, args.devices + 1)]
+
+    def perQuery(device):
+        # Previous behaviour: module level requests, new connection for each query
+        query = session.url + 'devices?filter=%7B%22EQ%22%3A%7B%22name%22%20%3A%20%22' + device + '%22%7D%7D'
+        requests.get(query, headers=session.headers)
+
+    run('requests.get', server, perQuery, devices)
+    run('Trellix.getDeviceId', server, session.getDeviceId, devices)
+
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
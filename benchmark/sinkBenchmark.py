@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#
+# Sink benchmark: per-event logging handlers versus batched sink pipeline
+#
+# Copyright (C) 2023 Philippe Le Bescond
+#
+# Contact : philippe.le.bescond(at)trellix.com
+
+import argparse
+import logging
+import os
+import socket
+import sys
+import time
+from logging.handlers import SysLogHandler
+
+# Setting path for module import
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from standInServer import StandInServer, SyslogStandIn, syntheticEvents, useStandInProfile
+
+
+def waitReceived(collector, expected, timeout=10):
+    # Wait until collector has received all messages sent, or timeout
+    deadline = time.time() + timeout
+    while collector.messages < expected and time.time() < deadline:
+        time.sleep(0.05)
+
+
+def report(label, count, elapsed, collector):
+    print('{0:<34} {1:>8} events {2:>9.0f} events/s {3:>8} received by syslog'.format(
+        label, count, count / elapsed, collector.messages))
+
+
+def loggingHandlers(events, path, collector, socktype):
+    # Previous behaviour: logging FileHandler and SysLogHandler, one event at a time
+    event_logger = logging.getLogger('Sink benchmark {0}'.format(socktype))
+    event_logger.propagate = False
+    event_logger.setLevel(logging.INFO)
+    file_handler = logging.FileHandler(path)
+    syslog_handler = SysLogHandler(address=('127.0.0.1', collector.port), socktype=socktype)
+    event_logger.addHandler(file_handler)
+    event_logger.addHandler(syslog_handler)
+
+    start = time.perf_counter()
+    for event in events:
+        event_logger.info(event)
+    elapsed = time.perf_counter() - start
+
+    file_handler.close()
+    syslog_handler.close()
+    return elapsed
+
+
+def pipeline(events, path, collector, protocol, page, format):
+    from lib.sinks import FileSink, SyslogSink, Pipeline
+
+    sinks = [FileSink(path, format), SyslogSink('127.0.0.1', collector.port, protocol, format = format)]
+    commits = []
+    delivery = Pipeline(sinks, commits.append)
+
+    start = time.perf_counter()
+    for i in range(0, len(events), page):
+        delivery.deliver(events[i:i + page], i + page)
+    delivery.close()
+    elapsed = time.perf_counter() - start
+    return elapsed
+
+
+def main():
+
+    # Script usage
+    parser = argparse.ArgumentParser(description='Compare per-event logging handlers with batched sink pipeline',
+                                     usage='sinkBenchmark.py [-n events] [-p page]')
+    parser.add_argument('-n', '--events', type=int, default=100000, help='Number of synthetic events. Default is 100000')
+    parser.add_argument('-p', '--page', type=int, default=1000, help='Events per page (batch). Default is 1000')
+    args = parser.parse_args()
+
+    # Library needs a profile, no query is sent
+    server = StandInServer(devices=0).start()
+    folder = useStandInProfile(server)
+
+    events = [event['attributes'] for event in syntheticEvents(args.events)]
+
+    runs = [
+        ('logging file + syslog udp', lambda path, collector: loggingHandlers(events, path, collector, socket.SOCK_DGRAM), 'udp'),
+        ('pipeline raw file + syslog udp', lambda path, collector: pipeline(events, path, collector, 'udp', args.page, 'raw'), 'udp'),
+        ('pipeline ndjson file + syslog udp', lambda path, collector: pipeline(events, path, collector, 'udp', args.page, 'ndjson'), 'udp'),
+        ('pipeline ndjson file + syslog tcp', lambda path, collector: pipeline(events, path, collector, 'tcp', args.page, 'ndjson'), 'tcp'),
+    ]
+
+    for label, run, protocol in runs:
+        collector = SyslogStandIn(protocol).start()
+        path = os.path.join(folder, 'events.log')
+        if os.path.exists(path):
+            os.remove(path)
+        elapsed = run(path, collector)
+        waitReceived(collector, len(events))
+        report(label, len(events), elapsed, collector)
+        collector.stop()
+
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for Trellix IAM and ePO SaaS API, used by benchmark scripts
+
+Copyright (C) 2023 Philippe Le Bescond
+
+Contact : philippe.le.bescond(at)trellix.com
+"""
+
+import json
+import os
+import socketserver
+import tempfile
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, quote
+
+### Constants ###
+
+API_PATH = '/epo/v2/'
+AUTH_PATH = '/iam/v1.1/token'
+TOKEN = 'stand-in-token'
+
+
+### Stand-in data ###
+
+def syntheticDevices(count):
+    """
+    Generate synthetic devices
+    Params: count, number of devices to generate
+    Result: list of device dict formatted as returned by the API
+    """
+
+    devices = []
+    for i in range(1, count + 1):
+        devices.append({
+            'type': 'devices',
+            'id': str(i),
+            'attributes': {
+                'name': 'host{0}'.format(i),
+                'agentGuid': '00000000-0000-0000-0000-{0:012d}'.format(i),
+                'lastUpdate': '2024-03-07T13:09:{0:02d}.000Z'.format(i % 60),
+                'nodeCreatedDate': '2024-01-01T00:00:00.000Z',
+                'tags': 'Workstation, Server' if i % 2 else 'Workstation',
+                'osType': 'Windows',
+                'ipAddress': '10.0.{0}.{1}'.format(i // 256 % 256, i % 256),
+            }
+        })
+    return devices
+
+
+def syntheticEvents(count):
+    """
+    Generate synthetic threat events
+    Params: count, number of events to generate
+    Result: list of event dict formatted as returned by the API
+    """
+
+    analyzers = ['ENDP_AM_1070', 'ENDP_AP_1070', 'ENDP_FW_1070']
+    categories = ['av.detect', 'av.pup', 'ips.block', 'fw.block']
+    events = []
+    for i in range(1, count + 1):
+        # Same attributes as events returned by the API, timestamps in ascending order
+        events.append({
+            'type': 'events',
+            'id': 'event-{0}'.format(i),
+            'attributes': {
+                'timestamp': '2024-03-{0:02d}T{1:02d}:{2:02d}:{3:02d}.000Z'.format(7 + i // 86400, i // 3600 % 24, i // 60 % 60, i % 60),
+                'autoguid': 'event-{0}'.format(i),
+                'detectedutc': str(1709816932000 + i * 1000),
+                'receivedutc': str(1709816946118 + i * 1000),
+                'agentguid': '00000000-0000-0000-0000-{0:012d}'.format(i),
+                'analyzer': analyzers[i % len(analyzers)],
+                'analyzername': 'Trellix Endpoint Security',
+                'analyzerversion': '10.7.0.5786',
+                'analyzerhostname': 'HOST{0:07d}'.format(i % 5000),
+                'analyzeripv4': '10.0.{0}.{1}'.format(i // 256 % 256, i % 256),
+                'analyzeripv6': '/0:0:0:0:0:0:0:0',
+                'analyzermac': '0123456789ab',
+                'analyzerdatversion': '5457.0',
+                'analyzerengineversion': '6700.10107',
+                'analyzerdetectionmethod': 'On-Access Scan',
+                'sourcehostname': None,
+                'sourceipv4': '10.0.0.1',
+                'sourceipv6': '/0:0:0:0:0:0:0:0',
+                'sourcemac': None,
+                'sourceusername': None,
+                'sourceprocessname': 'C:\\Windows\\System32\\cmd.exe',
+                'sourceurl': None,
+                'targethostname': None,
+                'targetipv4': '10.0.0.2',
+                'targetipv6': '/0:0:0:0:0:0:0:0',
+                'targetmac': None,
+                'targetusername': 'HOST\\Administrator',
+                'targetport': None,
+                'targetprotocol': None,
+                'targetprocessname': None,
+                'targetfilename': 'C:\\Users\\Administrator\\Documents\\file{0}.txt'.format(i),
+                'threatcategory': categories[i % len(categories)],
+                'threateventid': 1278,
+                'threatseverity': str(i % 7),
+                'threatname': 'Installation Check',
+                'threattype': 'test',
+                'threatactiontaken': 'IDS_ALERT_ACT_TAK_DEL',
+                'threathandled': True,
+                'nodepath': '1\\1234569\\1234568\\1234567',
+                'targethash': '10c0d81225bac79e7c09a1278cd8f0e1',
+                'sourceprocesshash': None,
+                'sourceprocesssigned': None,
+                'sourceprocesssigner': None,
+                'sourcefilepath': None,
+            }
+        })
+    return events
+
+
+def matchFilter(attributes, device_filter):
+    """
+    Check if device attributes match a JSON API filter (EQ, IN, OR, AND, GT, GE, LT, LE)
+    """
+
+    for operator, operand in device_filter.items():
+        if operator == 'EQ':
+            if not all(attributes.get(k) == v for k, v in operand.items()):
+                return False
+        elif operator == 'IN':
+            if not all(attributes.get(k) in v for k, v in operand.items()):
+                return False
+        elif operator == 'GT':
+            if not all(str(attributes.get(k)) > str(v) for k, v in operand.items()):
+                return False
+        elif operator == 'GE':
+            if not all(str(attributes.get(k)) >= str(v) for k, v in operand.items()):
+                return False
+        elif operator == 'LT':
+            if not all(str(attributes.get(k)) < str(v) for k, v in operand.items()):
+                return False
+        elif operator == 'LE':
+            if not all(str(attributes.get(k)) <= str(v) for k, v in operand.items()):
+                return False
+        elif operator == 'OR':
+            if not any(matchFilter(attributes, f) for f in operand):
+                return False
+        elif operator == 'AND':
+            if not all(matchFilter(attributes, f) for f in operand):
+                return False
+    return True
+
+
+def filterNames(device_filter):
+    """
+    Return device names from a filter only made of EQ/IN name conditions joined by OR, None otherwise
+    """
+
+    if list(device_filter.get('EQ', {}).keys()) == ['name']:
+        return [device_filter['EQ']['name']]
+    if list(device_filter.get('IN', {}).keys()) == ['name']:
+        return list(device_filter['IN']['name'])
+    if 'OR' in device_filter and len(device_filter) == 1:
+        names = []
+        for condition in device_filter['OR']:
+            condition_names = filterNames(condition)
+            if condition_names is None:
+                return None
+            names.extend(condition_names)
+        return names
+    return None
+
+
+### HTTP handler ###
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    HTTP/1.1 keep-alive handler answering like Trellix API
+    """
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # One setup per TCP connection, counted as one handshake
+        super().setup()
+        self.server.stats['connections'] += 1
+        time.sleep(self.server.handshake_latency)
+
+    def log_message(self, format, *args):
+        pass
+
+    def __send(self, status, body=None, headers=None):
+        payload = json.dumps(body).encode() if body is not None else b''
+        self.server.stats['bytes'] += len(payload)
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/vnd.api+json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def __readBody(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def __route(self, method):
+        self.server.stats['requests'] += 1
+        time.sleep(self.server.latency)
+
+        url = urlsplit(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = self.__readBody()
+
+        if url.path == AUTH_PATH and method == 'POST':
+            return self.__send(200, {'access_token': TOKEN, 'token_type': 'Bearer', 'expires_in': 600})
+
+        if self.headers.get('Authorization') != 'Bearer ' + TOKEN:
+            return self.__send(401, {'message': 'Unauthorized'})
+
+        if not url.path.startswith(API_PATH):
+            return self.__send(404, {'message': 'Not found'})
+        path = url.path[len(API_PATH):].strip('/').split('/')
+
+        # Injected faults, answered instead of API queries
+        try:
+            status, retry_after = self.server.faults.popleft()
+            return self.__send(status, {'message': 'Injected fault'},
+                               {'Retry-After': str(retry_after)} if retry_after is not None else None)
+        except IndexError:
+            pass
+
+        # Simulate server errors on large pages
+        failing = self.server.failing_page_limit
+        if failing and int(params.get('page[limit]', 0)) > failing:
+            return self.__send(500, {'message': 'Internal Server Error'})
+
+        if path[0] == 'devices' and len(path) == 1:
+            return self.__send(200, self.__page(url.path, params, self.server.devices))
+        if path[0] == 'devices' and len(path) == 2:
+            device = self.server.devices_by_id.get(int(path[1]))
+            if device is None:
+                return self.__send(404, {'message': 'Not found'})
+            if 'fields' in params:
+                fields = params['fields'].split(',')
+                device = {'type': device['type'], 'id': device['id'],
+                          'attributes': {k: v for k, v in device['attributes'].items() if k in fields}}
+            return self.__send(200, {'data': device})
+        if path[0] == 'devices' and path[2:] == ['installedProducts']:
+            return self.__send(200, {'data': [{'type': 'installedProducts', 'id': 1, 'attributes': {
+                'productFamilyName': 'Trellix Agent', 'productVersion': '5.8.0.161'}}]})
+        if path[0] == 'tags' and len(path) == 1:
+            return self.__send(200, self.__page(url.path, params, self.server.tags))
+        if path[0] == 'tags' and path[2:] == ['relationships', 'devices']:
+            payload = json.loads(body or b'{}')
+            if len(payload.get('data', [])) > self.server.max_tag_payload:
+                return self.__send(400, {'message': 'Too many devices'})
+            tag = next((t['attributes']['name'] for t in self.server.tags if t['id'] == path[1]), None)
+            if tag is None:
+                return self.__send(404, {'message': 'Not found'})
+            for item in payload.get('data', []):
+                device = self.server.devices_by_id.get(int(item['id']))
+                if device is None:
+                    return self.__send(404, {'message': 'Not found'})
+                tags = [t for t in device['attributes']['tags'].split(', ') if t and t != tag]
+                if method == 'POST':
+                    tags.append(tag)
+                device['attributes']['tags'] = ', '.join(tags)
+            return self.__send(204)
+        if path[0] == 'events':
+            return self.__send(200, self.__events(url.path, params))
+
+        return self.__send(404, {'message': 'Not found'})
+
+    def __page(self, path, params, records):
+        # Offset paging with links.next, like devices and tags endpoints
+        if 'filter' in params:
+            records_filter = json.loads(params['filter'])
+            names = filterNames(records_filter)
+            if names is not None and records is self.server.devices:
+                # Indexed lookup for device name filters
+                records = [r for name in names for r in self.server.devices_by_name.get(name, [])]
+            else:
+                records = [r for r in records if matchFilter(r['attributes'], records_filter)]
+        offset = int(params.get('page[offset]', 0))
+        limit = min(int(params.get('page[limit]', 20)), self.server.max_page_limit)
+        page = records[offset:offset + limit]
+        if 'fields' in params:
+            fields = params['fields'].split(',')
+            page = [{'type': r['type'], 'id': r['id'],
+                     'attributes': {k: v for k, v in r['attributes'].items() if k in fields}} for r in page]
+        result = {'data': page, 'links': {}, 'meta': {'totalResourceCount': len(records)}}
+        if offset + limit < len(records):
+            next_params = dict(params)
+            next_params['page[offset]'] = str(offset + limit)
+            next_params['page[limit]'] = str(limit)
+            query = '&'.join('{0}={1}'.format(quote(k), quote(v)) for k, v in next_params.items())
+            result['links']['next'] = self.server.base_url + path + '?' + query
+        return result
+
+    def __events(self, path, params):
+        # Cursor paging with relative links.next, like events endpoint, with optional filter and fields
+        limit = min(int(params.get('page[limit]', 1000)), self.server.max_page_limit)
+        start = 0
+        if params.get('page[cursor]'):
+            guid = params['page[cursor]'].split('_:_')[0]
+            start = self.server.events_index.get(guid, -1) + 1
+        events = self.server.events
+        if 'filter' in params:
+            events_filter = json.loads(params['filter'])
+            page = []
+            end = start
+            while end < len(events) and len(page) < limit:
+                if matchFilter(events[end]['attributes'], events_filter):
+                    page.append(events[end])
+                end += 1
+        else:
+            page = events[start:start + limit]
+            end = start + limit
+        last = page[-1] if page else None
+        if 'fields' in params:
+            fields = params['fields'].split(',')
+            page = [{'type': e['type'], 'id': e['id'],
+                     'attributes': {k: v for k, v in e['attributes'].items() if k in fields}} for e in page]
+        result = {'data': page, 'links': {}}
+        if end < len(events) and last is not None:
+            cursor = last['id'] + '_:_' + last['attributes']['timestamp']
+            result['links']['next'] = '{0}?page[limit]={1}&page[cursor]={2}&sort=timestamp'.format(path, limit, cursor)
+            for key in ('filter', 'fields'):
+                if key in params:
+                    result['links']['next'] += '&{0}={1}'.format(key, quote(params[key]))
+        return result
+
+    def do_GET(self):
+        self.__route('GET')
+
+    def do_POST(self):
+        self.__route('POST')
+
+    def do_DELETE(self):
+        self.__route('DELETE')
+
+
+### Server ###
+
+class StandInServer:
+    """
+    Local Trellix API stand-in running in a background thread
+    """
+
+    def __init__(self, devices=1000, events=0, latency=0.0, handshake_latency=0.0,
+                 max_page_limit=1000, max_tag_payload=1000, failing_page_limit=None):
+        """
+        Params:
+            devices: number of synthetic devices
+            events: number of synthetic threat events
+            latency: seconds added to each request, to simulate network round trip
+            handshake_latency: seconds added to each new connection, to simulate TCP+TLS handshake
+            max_page_limit: largest page size accepted by paged endpoints
+            max_tag_payload: largest number of devices accepted by tag queries
+            failing_page_limit: optional page size above which paged endpoints answer 500, like an overloaded API
+        """
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.base_url = 'http://127.0.0.1:{0}'.format(self.httpd.server_address[1])
+        self.httpd.stats = {'connections': 0, 'requests': 0, 'bytes': 0}
+        self.httpd.latency = latency
+        self.httpd.handshake_latency = handshake_latency
+        self.httpd.max_page_limit = max_page_limit
+        self.httpd.max_tag_payload = max_tag_payload
+        self.httpd.failing_page_limit = failing_page_limit
+        self.httpd.faults = deque()
+        self.httpd.devices = syntheticDevices(devices)
+        self.httpd.devices_by_id = {int(d['id']): d for d in self.httpd.devices}
+        self.httpd.devices_by_name = {}
+        for device in self.httpd.devices:
+            self.httpd.devices_by_name.setdefault(device['attributes']['name'], []).append(device)
+        self.httpd.tags = [{'type': 'tags', 'id': str(i), 'attributes': {'name': name}}
+                           for i, name in enumerate(['Workstation', 'Server', 'Quarantine'], 1)]
+        self.httpd.events = syntheticEvents(events)
+        self.httpd.events_index = {e['id']: i for i, e in enumerate(self.httpd.events)}
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return self.httpd.base_url
+
+    @property
+    def stats(self):
+        return self.httpd.stats
+
+    def resetStats(self):
+        self.httpd.stats['connections'] = 0
+        self.httpd.stats['requests'] = 0
+        self.httpd.stats['bytes'] = 0
+
+    def injectFaults(self, status, count=1, retry_after=None):
+        """
+        Answer next API queries with an error status, authentication queries excluded
+        Params:
+            status: HTTP status code returned
+            count: number of queries answered with this status
+            retry_after: optional Retry-After header value, in seconds
+        """
+        self.httpd.faults.extend([(status, retry_after)] * count)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+### Syslog stand-in ###
+
+class SyslogStandIn:
+    """
+    Local syslog server counting messages received, over UDP or TCP with octet counting framing (RFC 6587)
+    Optional delay per TCP read simulates a slow collector
+    """
+
+    def __init__(self, protocol='tcp', read_delay=0.0):
+        self.protocol = protocol
+        self.messages = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+        stand_in = self
+
+        class TCPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                buffer = b''
+                while True:
+                    data = self.request.recv(65536)
+                    if not data:
+                        return
+                    time.sleep(read_delay)
+                    buffer += data
+                    # Parse complete frames: length, space, message
+                    count = 0
+                    while True:
+                        space = buffer.find(b' ')
+                        if space < 0:
+                            break
+                        length = int(buffer[:space])
+                        if len(buffer) < space + 1 + length:
+                            break
+                        buffer = buffer[space + 1 + length:]
+                        count += 1
+                    stand_in.record(count, len(data))
+
+        class UDPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                stand_in.record(1, len(self.request[0]))
+
+        if protocol == 'udp':
+            self.server = socketserver.ThreadingUDPServer(('127.0.0.1', 0), UDPHandler)
+        else:
+            self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), TCPHandler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def record(self, messages, size):
+        with self.lock:
+            self.messages += messages
+            self.bytes += size
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def useStandInProfile(server, **settings):
+    """
+    Write a profile pointing to the stand-in server in a temporary folder and move into a subfolder
+    Must be called before importing lib.trellixAPI, which loads profile at import time
+    Params:
+        server: running StandInServer
+        settings: profile settings to override
+    Result: temporary folder path
+    """
+
+    folder = tempfile.mkdtemp(prefix='trellix-bench-')
+    profile = {
+        'id': 'bench',
+        'secret': 'bench',
+        'auth_url': server.url + AUTH_PATH,
+        'api_url': server.url + API_PATH,
+        'api_short_url': server.url,
+        'auth_headers': {'Content-Type': 'application/x-www-form-urlencoded'},
+        'api_headers': {'Content-Type': 'application/vnd.api+json', 'x-api-key': 'bench', 'Authorization': 'Bearer '},
+        'auth_payload': {'grant_type': 'client_credentials', 'scope': 'epo.device.r', 'audience': 'mcafee'},
+        'device_page_limit': 20,
+        'events_page_limit': 1000,
+        'events_cursor': '',
+        'log_level': 'ERROR',
+        'log_path': folder + os.sep,
+    }
+    profile.update(settings)
+
+    with open(os.path.join(folder, 'profile'), 'w') as profile_file:
+        json.dump(profile, profile_file, indent=4)
+
+    # Scripts are run from a subfolder, profile being in parent folder
+    os.mkdir(os.path.join(folder, 'work'))
+    os.chdir(os.path.join(folder, 'work'))
+    return folder
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+#
+# Multi-tenant collector: pull threat events and keep inventory of many tenants in a single process
+#
+# Copyright (C) 2023 Philippe Le Bescond
+#
+# Contact : philippe.le.bescond(at)trellix.com
+
+import argparse
+import os
+import sys
+
+# Setting path for module import
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from lib.trellixAPI import logger
+from lib.sinks import FileSink, SyslogSink
+from lib.eventFilter import EventFilter
+from lib.collector import Collector, Tenant, loadTenantProfiles
+
+### Functions ###
+
+def main():
+
+    # Script usage
+    parser = argparse.ArgumentParser(description='Pull threat events and keep inventory of many Trellix ePO SaaS tenants',
+                                     usage='collectTenants.py -T tenants_folder [-f output_folder] [-F ndjson|raw] [-s syslog_server] [-p syslog_port]\n'
+                                           '       [-t udp|tcp|tls] [-c ca_file] [-d] [-i] [-w workers]')
+    parser.add_argument('-T', '--tenants', type=str, required=True, help='Folder containing one profile per tenant, named <tenant>.json')
+    parser.add_argument('-f', '--folder', type=str, help='Folder where to write threat events, one file per tenant')
+    parser.add_argument('-F', '--format', type=str, choices=['ndjson', 'raw'], default='ndjson', help='Events format, in files and syslog messages. Default is ndjson')
+    parser.add_argument('-s', '--server', type=str, help='Syslog server address where to send threat events')
+    parser.add_argument('-p', '--port', type=int, help='Syslog server port')
+    parser.add_argument('-t', '--protocol', type=str, choices=['udp', 'tcp', 'tls'], default='tcp', help='Syslog protocol. Default is tcp')
+    parser.add_argument('-c', '--ca', type=str, help='CA file used to verify syslog server certificate with tls protocol. Default is system CAs')
+    parser.add_argument('-d', '--dedup', action='store_true', help='Drop threat events already delivered, when events are pulled again')
+    parser.add_argument('-i', '--inventory', action='store_true', help='Keep local inventory of each tenant synced')
+    parser.add_argument('-w', '--workers', type=int, help='Number of jobs running at the same time. Default is collector_workers setting')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    # Verifying at least folder or server is specified
+    if not (args.folder or args.server):
+        logger.error('Failed to execute collectTenants, at least an output folder (-f) or a syslog server (-s) must be specified')
+        sys.exit()
+
+    # Verifying syslog adress and port are specified
+    if (args.server is None) ^ (args.port is None):
+        logger.error('Failed to execute collectTenants, Both syslog server (-s) and syslog port (-p) must be specified')
+        sys.exit()
+
+    # Output folder is created if needed, file sinks write in it
+    if args.folder:
+        try:
+            os.makedirs(args.folder, exist_ok = True)
+        except OSError as e:
+            logger.error('Failed to execute collectTenants, can not create output folder {0}: {1}'.format(args.folder, e))
+            sys.exit()
+
+    # Load tenant profiles
+    profiles = loadTenantProfiles(args.tenants)
+    if not profiles:
+        logger.error('Failed to execute collectTenants, no valid tenant profile found in {0}'.format(args.tenants))
+        sys.exit()
+
+    # Each tenant has its own sinks, so a tenant cursor is only committed once its own events are delivered
+    tenants = []
+    for name, settings in profiles.items():
+        sinks = []
+        if args.folder:
+            sinks.append(FileSink(os.path.join(args.folder, name + ('.ndjson' if args.format == 'ndjson' else '.log')), args.format))
+        if args.server:
+            sinks.append(SyslogSink(args.server, args.port, args.protocol, args.ca, msg_id = name, format = args.format))
+
+        # Optional filter set in tenant profile
+        event_filter = EventFilter(**settings['events_filter']) if settings.get('events_filter') else None
+        tenants.append(Tenant(name, settings, sinks, event_filter, args.dedup, args.inventory))
+
+    # Run until interrupted
+    collector = Collector(tenants, args.workers)
+    try:
+        collector.run()
+    except KeyboardInterrupt:
+        logger.warning('Stopping collector, writing queued events...')
+    finally:
+        collector.stop()
+
+
+if __name__ == "__main__":
+    main()
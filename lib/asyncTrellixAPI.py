@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Asyncio façade of Trellix API library: blocking Trellix methods run in a bounded worker pool
+
+Copyright (C) 2023 Philippe Le Bescond
+
+Contact : philippe.le.bescond(at)trellix.com
+"""
+
+import asyncio
+import functools
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.trellixAPI import Trellix, AVAILABLE_PROPS, profile, logger
+
+### Constants ###
+
+# Default number of queries running at the same time, used when not set in profile file
+DEFAULT_MAX_IN_FLIGHT = 32
+
+# Interval between progress reports, in seconds
+PROGRESS_INTERVAL = 10
+
+
+### Progress ###
+
+class Progress:
+    """
+    Count items processed by a job and log progress every PROGRESS_INTERVAL seconds:
+    items done, failures, throughput and estimated time left
+    """
+
+    def __init__(self, label, total, interval = PROGRESS_INTERVAL):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.reported = self.started
+
+
+    def update(self, failed = False):
+        """
+        Count an item, and log progress if last report is older than interval
+        Params: failed, Boolean, True if item failed
+        """
+
+        self.done += 1
+        self.failed += failed
+        now = time.monotonic()
+        if now - self.reported >= self.interval:
+            self.reported = now
+            rate = self.done / (now - self.started)
+            logger.warning('{0}: {1}/{2} done, {3} failed, {4:.1f} per second, about {5} seconds left'.format(
+                self.label, self.done, self.total, self.failed, rate, int((self.total - self.done) / rate) if rate else '?'))
+
+
+    def summary(self):
+        """
+        Log totals and throughput of the job
+        """
+
+        elapsed = time.monotonic() - self.started
+        logger.warning('{0}: {1} done, {2} failed in {3:.1f} seconds, {4:.1f} per second'.format(
+            self.label, self.done, self.failed, elapsed, self.done / elapsed if elapsed else 0))
+
+
+def iterate(function, *args):
+    """
+    Consume an async generator from synchronous code: the generator runs in its own event loop thread
+    and items are yielded as soon as they are produced
+    Params:
+        function: async generator function
+        args: arguments passed to function
+    Result: yields items of the async generator, exceptions raised by it are raised again
+    """
+
+    items = queue.Queue(maxsize = 1024)
+    done = object()
+
+    async def produce():
+        try:
+            async for item in function(*args):
+                await asyncio.get_running_loop().run_in_executor(None, items.put, item)
+        except BaseException as e:
+            items.put(e)
+            return
+        items.put(done)
+
+    thread = threading.Thread(target = asyncio.run, args = (produce(),), daemon = True)
+    thread.start()
+    while True:
+        item = items.get()
+        if item is done:
+            break
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+    thread.join()
+
+
+### Async Trellix API Class ###
+
+class AsyncTrellix:
+    """
+    Asyncio Trellix API session object
+    This is not an asyncio HTTP client: each query runs on the pooled session of a blocking Trellix object,
+    in a worker pool of max_in_flight threads, so 401 re-authentication and retries behave as in Trellix
+    and the event loop is never blocked
+    Coroutines have the same parameters and results as Trellix methods, and build full lists like them.
+    Paging methods are also async iterators (iterAllProperties, iterDevices, iterThreatEvents), yielding
+    items page by page, so memory does not grow with the number of devices or events
+    """
+
+    def __init__(self, max_in_flight = None):
+        """
+        Create a new session to Trellix API. Blocking, use AsyncTrellix.create() from a coroutine
+        Params: max_in_flight, optional int overriding max_in_flight setting from profile
+        Result: AsyncTrellix object
+        """
+
+        self.max_in_flight = max_in_flight or profile.get('max_in_flight', DEFAULT_MAX_IN_FLIGHT)
+
+        # Connection pool must be large enough to keep a connection per query in flight
+        self.trellix = Trellix(pool_size = max(self.max_in_flight, profile.get('pool_size', 0)))
+        self.executor = ThreadPoolExecutor(max_workers = self.max_in_flight, thread_name_prefix = 'AsyncTrellix')
+        logger.debug('Async session created with {0} queries in flight'.format(self.max_in_flight))
+
+
+    @classmethod
+    async def create(cls, max_in_flight = None):
+        """
+        Create a new session to Trellix API without blocking event loop
+        Params: max_in_flight, optional int overriding max_in_flight setting from profile
+        Result: AsyncTrellix object
+        """
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(cls, max_in_flight))
+
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Stop worker pool and close HTTP session
+        """
+
+        self.executor.shutdown(wait = True)
+        self.trellix.session.close()
+
+
+    async def __run(self, function, *args):
+        """
+        Internal function running a Trellix method in worker pool
+        At most max_in_flight queries are sent at the same time, others are waiting for a free worker
+        """
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(function, *args))
+
+
+    async def __iterate(self, generator, batch_size):
+        """
+        Internal async generator consuming a Trellix generator in worker pool, batch_size items at a time,
+        so a page is read in a worker while event loop runs other coroutines
+        Generator is closed if iteration stops early
+        """
+
+        try:
+            while True:
+                batch = await self.__run(lambda: list(itertools.islice(generator, batch_size)))
+                if not batch:
+                    return
+                for item in batch:
+                    yield item
+        finally:
+            generator.close()
+
+
+    async def gather(self, function, items, *args):
+        """
+        Run a coroutine method on each item, keeping results in items order
+        Params:
+            function: AsyncTrellix coroutine method, like getDeviceId or collectProperties
+            items: list of first argument for each call
+            args: other arguments passed to each call
+        Result: list of results
+        """
+
+        return await asyncio.gather(*[function(item, *args) for item in items])
+
+
+    async def stream(self, function, items, *args, progress = None):
+        """
+        Run a coroutine method on each item, yielding results in items order as soon as they are available
+        At most twice max_in_flight calls are pending, so memory does not grow with items.
+        A failing call does not stop other calls, its error is yielded instead
+        Params:
+            function: AsyncTrellix coroutine method, like getInstalledProducts
+            items: iterable of first argument for each call
+            args: other arguments passed to each call
+            progress: optional Progress object updated for each item
+        Result: yields (item, result, error), error is None if call succeeded
+        """
+
+        async def guarded(item):
+            # Library functions may also stop with sys.exit
+            try:
+                return await function(item, *args), None
+            except (Exception, SystemExit) as e:
+                return None, e
+
+        iterator = iter(items)
+        pending = deque()
+        window = self.max_in_flight * 2
+
+        def fill():
+            for item in iterator:
+                pending.append((item, asyncio.ensure_future(guarded(item))))
+                if len(pending) >= window:
+                    return
+
+        fill()
+        while pending:
+            item, task = pending.popleft()
+            result, error = await task
+            fill()
+            if progress:
+                progress.update(error is not None)
+            yield item, result, error
+
+
+    ### Auth ###
+
+    async def auth(self, force = False):
+        return await self.__run(self.trellix.auth, force)
+
+
+    ### Tag functions ###
+
+    async def getTagId(self, tag):
+        return await self.__run(self.trellix.getTagId, tag)
+
+    async def applyTag(self, tag_id, device_id):
+        return await self.__run(self.trellix.applyTag, tag_id, device_id)
+
+    async def clearTag(self, tag_id, device_id):
+        return await self.__run(self.trellix.clearTag, tag_id, device_id)
+
+
+    ### Devices functions ###
+
+    async def getDeviceId(self, device):
+        return await self.__run(self.trellix.getDeviceId, device)
+
+    async def resolveDevices(self, names):
+        return await self.__run(self.trellix.resolveDevices, names)
+
+    async def getAllDevices(self):
+        await self.__run(self.trellix.getAllDevices)
+        return self.trellix.deviceList, self.trellix.tagsApplied
+
+    async def collectProperties(self, device_id, props = AVAILABLE_PROPS):
+        return await self.__run(self.trellix.collectProperties, device_id, props)
+
+    async def collectAllProperties(self, props = AVAILABLE_PROPS):
+        return await self.__run(self.trellix.collectAllProperties, props)
+
+    async def iterAllProperties(self, props = AVAILABLE_PROPS):
+        async for device in self.__iterate(self.trellix.iterAllProperties(props), self.trellix.device_page_limit):
+            yield device
+
+    async def iterDevices(self, props, device_filter = None):
+        async for device in self.__iterate(self.trellix.iterDevices(props, device_filter), self.trellix.device_page_limit):
+            yield device
+
+    async def getInstalledProducts(self, device_id):
+        return await self.__run(self.trellix.getInstalledProducts, device_id)
+
+
+    ### Events functions ###
+
+    async def pullThreatEvents(self, event_filter = None):
+        return await self.__run(self.trellix.pullThreatEvents, event_filter)
+
+    async def iterThreatEvents(self, event_filter = None):
+        async for event in self.__iterate(self.trellix.iterThreatEvents(event_filter), self.trellix.events_page_limit):
+            yield event
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Bulk tag executor, applying or clearing a tag on many systems by chunks
+
+Copyright (C) 2023 Philippe Le Bescond
+
+Contact : philippe.le.bescond(at)trellix.com
+"""
+
+import csv
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+
+from lib.trellixAPI import Trellix, profile, logger
+
+### Constants ###
+
+# Largest number of systems sent in a single tag query, and number of tag queries sent at the same time
+DEFAULT_TAG_CHUNK_SIZE = 1000
+DEFAULT_TAG_WORKERS = 4
+
+# Number of times a chunk failing on server side is sent again, after retry policy of each query
+DEFAULT_TAG_CHUNK_RETRIES = 1
+
+# Outcome of each system, by response status of a query targeting this system only
+OUTCOMES = {
+    204: 'done',
+    400: 'rejected',
+    404: 'not_found',
+    409: 'unchanged',
+}
+
+# Statuses caused by some systems of a chunk, found by splitting it. Other 4xx statuses (scope, permission)
+# would fail on any part of the chunk, and 401 or 403 on any chunk, so they are never split
+SPLIT_STATUS = (400, 404, 409)
+ABORT_STATUS = (401, 403)
+
+
+### Bulk Tag Class ###
+
+class BulkTag:
+    """
+    Apply or clear a tag on many systems
+    Systems are split in chunks sent concurrently. A chunk rejected because of some systems (400, 404, 409) is split
+    in two halves until offending systems are found, while other systems of the chunk are tagged.
+    A chunk failing on server side is sent again, alone, up to tag_chunk_retries times.
+    A chunk refused for another reason (4xx) fails as a whole, and 401 or 403 stops the run, as any query would fail
+    """
+
+    def __init__(self, session = None, chunk_size = None, workers = None):
+        """
+        Create bulk tag executor
+        Params:
+            session: optional Trellix object, a new session is created if not set
+            chunk_size: optional int overriding tag_chunk_size setting from profile
+            workers: optional int overriding tag_workers setting from profile
+        Result: BulkTag object
+        """
+
+        self.chunk_size = chunk_size or profile.get('tag_chunk_size', DEFAULT_TAG_CHUNK_SIZE)
+        self.workers = workers or profile.get('tag_workers', DEFAULT_TAG_WORKERS)
+        self.chunk_retries = profile.get('tag_chunk_retries', DEFAULT_TAG_CHUNK_RETRIES)
+
+        # Connection pool must be large enough to keep a connection per worker
+        self.session = session or Trellix(pool_size = max(self.workers, profile.get('pool_size', 0)))
+
+
+    def chunks(self, device_ids):
+        """
+        Split device ids in chunks sized to tag_chunk_size, duplicates removed
+        Params: device_ids, list of device ids
+        Result: list of chunks, each one is a list of device ids
+        """
+
+        device_ids = list(dict.fromkeys(device_ids))
+        return [device_ids[i:i + self.chunk_size] for i in range(0, len(device_ids), self.chunk_size)]
+
+
+    def run(self, tag_id, device_ids, clear = False):
+        """
+        Apply or clear a tag on a list of systems
+        Params:
+            tag_id: tag id
+            device_ids: list of device ids
+            clear: Boolean, True to clear tag instead of applying it
+        Result: report, dict formatted as "device id": {"outcome": outcome, "status": status code}
+            outcome is 'done', 'unchanged' (tag already applied), 'not_found', 'rejected' or 'failed'
+        """
+
+        action = 'clear' if clear else 'apply'
+        report = {}
+        pending = {}
+        queries = 0
+        aborted = None
+
+        def submit(executor, chunk, attempt = 0):
+            pending[executor.submit(self.__send, tag_id, chunk, clear)] = (chunk, attempt)
+
+        with ThreadPoolExecutor(max_workers = self.workers, thread_name_prefix = 'BulkTag') as executor:
+
+            for chunk in self.chunks(device_ids):
+                submit(executor, chunk)
+
+            while pending:
+                done, _ = wait(pending, return_when = FIRST_COMPLETED)
+                for future in done:
+                    chunk, attempt = pending.pop(future)
+                    status = future.result()
+                    queries += 1
+
+                    # Whole chunk tagged
+                    if status == 204:
+                        report.update((device, {'outcome': 'done', 'status': status}) for device in chunk)
+
+                    # Authentication or permission refused: no other query can succeed, pending chunks are dropped
+                    elif status in ABORT_STATUS:
+                        logger.error('{0} tag query on {1} systems refused ({2}), stopping'.format(action, len(chunk), status))
+                        report.update((device, {'outcome': 'failed', 'status': status}) for device in chunk)
+                        aborted = status
+                        for other in list(pending):
+                            if other.cancel():
+                                pending.pop(other)
+
+                    # Chunk rejected because of some systems: split it to find offending systems
+                    elif status in SPLIT_STATUS and len(chunk) > 1 and not aborted:
+                        logger.info('{0} tag query on {1} systems rejected ({2}), splitting chunk'.format(action, len(chunk), status))
+                        half = len(chunk) // 2
+                        submit(executor, chunk[:half])
+                        submit(executor, chunk[half:])
+
+                    # Chunk rejected after run was stopped: it is not split, and none of its systems is known to be tagged
+                    elif status in SPLIT_STATUS and len(chunk) > 1:
+                        logger.error('{0} tag query on {1} systems rejected ({2}) after run was stopped'.format(action, len(chunk), status))
+                        report.update((device, {'outcome': 'failed', 'status': status}) for device in chunk)
+
+                    # Single system rejected
+                    elif status in OUTCOMES:
+                        report[chunk[0]] = {'outcome': OUTCOMES[status], 'status': status}
+
+                    # Chunk refused for a reason splitting can not fix
+                    elif status is not None and 400 <= status < 500 and status != 429:
+                        logger.error('{0} tag query on {1} systems refused ({2})'.format(action, len(chunk), status))
+                        report.update((device, {'outcome': 'failed', 'status': status}) for device in chunk)
+
+                    # Server side failure: send chunk again
+                    elif attempt < self.chunk_retries and not aborted:
+                        logger.info('{0} tag query on {1} systems failed ({2}), sending chunk again'.format(action, len(chunk), status))
+                        submit(executor, chunk, attempt + 1)
+
+                    else:
+                        logger.error('{0} tag query on {1} systems failed ({2})'.format(action, len(chunk), status))
+                        report.update((device, {'outcome': 'failed', 'status': status}) for device in chunk)
+
+        # Systems of chunks dropped after run was stopped
+        if aborted:
+            for device in dict.fromkeys(device_ids):
+                report.setdefault(device, {'outcome': 'failed', 'status': aborted})
+
+        logger.warning('{0} tag on {1} systems in {2} queries: {3}'.format(
+            action, len(report), queries, dict(summary(report))))
+        return report
+
+
+    def __send(self, tag_id, chunk, clear):
+        """
+        Internal function sending a tag query on a chunk
+        Result: response status code, None if query failed without response
+        """
+
+        try:
+            return self.session.tagQuery(tag_id, chunk, clear).status_code
+        except requests.exceptions.RequestException as e:
+            logger.error('Tag query on {0} systems failed: {1}'.format(len(chunk), e))
+            return None
+
+
+def summary(report):
+    """
+    Count systems by outcome
+    Params: report, returned by BulkTag.run
+    Result: Counter formatted as "outcome": number of systems
+    """
+
+    return Counter(result['outcome'] for result in report.values())
+
+
+def writeReport(report, path, names = None):
+    """
+    Write bulk tag report in a CSV file
+    Params:
+        report: returned by BulkTag.run
+        path: string containing CSV file path
+        names: optional dict formatted as "device id":"device name", like Trellix.deviceList
+    """
+
+    names = names or {}
+    with open(path, 'w', newline = '') as report_file:
+        writer = csv.writer(report_file)
+        writer.writerow(['id', 'name', 'outcome', 'status'])
+        for device, result in report.items():
+            writer.writerow([device, names.get(device, ''), result['outcome'], result['status'] or ''])
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+Multi-tenant collector: threat events pulls and inventory scans of many tenants, in a shared worker pool
+
+Copyright (C) 2023 Philippe Le Bescond
+
+Contact : philippe.le.bescond(at)trellix.com
+"""
+
+import itertools
+import json
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.trellixAPI import Trellix, profile, profile_path, logger
+from lib.sinks import Pipeline
+from lib.scheduler import PollScheduler
+from lib.dedup import DedupStore
+from lib.inventory import Inventory, INVENTORY
+
+### Constants ###
+
+# Number of jobs running at the same time, used when not set in profile file
+DEFAULT_COLLECTOR_WORKERS = 4
+
+# Delay before running a failed job again, doubled at each failure up to maximum, in seconds
+DEFAULT_TENANT_BACKOFF = 60
+DEFAULT_TENANT_BACKOFF_MAX = 3600
+
+# Settings of the tenant set in profile file, never inherited by tenant profiles: credentials, threat events cursor
+# and files holding a single tenant
+TENANT_SETTINGS = ['id', 'secret', 'api_headers', 'events_cursor', 'inventory_path', 'properties_snapshot']
+
+# Quota ledger consumer of each job
+JOB_CONSUMERS = {'events': 'pullThreatEvents', 'inventory': 'collectTenants'}
+
+
+def loadTenantProfiles(folder):
+    """
+    Load tenant profiles from a folder, one JSON file per tenant named after the tenant
+    Settings not set in a tenant profile are taken from profile file, except credentials and state of profile file tenant
+    Params: folder, string containing folder path
+    Result: dict formatted as "tenant name":"settings dict"
+    """
+
+    tenants = {}
+    for filename in sorted(os.listdir(folder)):
+        name, extension = os.path.splitext(filename)
+        if extension != '.json':
+            continue
+
+        try:
+            with open(os.path.join(folder, filename), 'r') as tenant_file:
+                tenant_profile = json.load(tenant_file)
+        except (OSError, ValueError) as e:
+            logger.error('Tenant {0} skipped, failed to read profile {1}: {2}'.format(name, filename, e))
+            continue
+
+        # Credentials must come from tenant profile, otherwise tenant would run as profile file tenant
+        if (not isinstance(tenant_profile, dict) or not all(tenant_profile.get(key) for key in ('id', 'secret'))
+                or not isinstance(tenant_profile.get('api_headers'), dict) or not tenant_profile['api_headers'].get('x-api-key')):
+            logger.error('Tenant {0} skipped, id, secret and x-api-key must be set in {1}'.format(name, filename))
+            continue
+
+        settings = {key: value for key, value in profile.items() if key not in TENANT_SETTINGS}
+        settings.update(tenant_profile)
+
+        # Other API headers are taken from profile file
+        headers = {key: value for key, value in profile.get('api_headers', {}).items() if key != 'x-api-key'}
+        headers.update(tenant_profile['api_headers'])
+        settings['api_headers'] = headers
+
+        # A worker never waits for quota reset, the job is scheduled after reset instead
+        settings['quota_policy'] = 'fail'
+
+        # Each tenant has its own inventory file
+        settings.setdefault('inventory_path', os.path.join(os.path.dirname(profile_path), INVENTORY + '.' + name))
+        tenants[name] = settings
+
+    return tenants
+
+
+def secondsToQuotaReset():
+    # Seconds until end of UTC day
+    return 86400 - time.time() % 86400
+
+
+### Tenant Class ###
+
+class Tenant:
+    """
+    Collector state of a tenant: sessions, event pipeline, scheduler and failures of each job
+    Sessions are opened by the first job run, and opened again after a failure
+    """
+
+    def __init__(self, name, settings, sinks, event_filter = None, dedup = False, inventory = False):
+        """
+        Params:
+            name: string, tenant name used in logs
+            settings: dict of profile settings of the tenant
+            sinks: list of Sink objects receiving threat events of this tenant only
+            event_filter: optional EventFilter object
+            dedup: Boolean, True to drop threat events already delivered
+            inventory: Boolean, True to keep tenant inventory synced
+        """
+
+        self.name = name
+        self.settings = settings
+        self.sinks = sinks
+        self.event_filter = event_filter
+        self.dedup_enabled = dedup
+        self.jobs = ['events'] + (['inventory'] if inventory else [])
+        self.sessions = {}
+        self.estimated = set()
+        self.failures = {job: 0 for job in self.jobs}
+        self.pipeline = Pipeline(sinks, self.__commit)
+        self.scheduler = None
+        self.dedup = None
+
+
+    def __session(self, job):
+        # Session of a job, opened on first use
+        session = self.sessions.get(job)
+        if session is None:
+            logger.info('{0}: opening session for {1}'.format(self.name, job))
+            session = Trellix(consumer = JOB_CONSUMERS[job], settings = self.settings)
+            self.sessions[job] = session
+            if job == 'events':
+                self.scheduler = PollScheduler(session)
+                if self.dedup_enabled and self.dedup is None:
+                    self.dedup = DedupStore(session.tenant, settings = self.settings)
+        return session
+
+
+    def __commit(self, cursor):
+        # Cursor is committed with current events session
+        session = self.sessions.get('events')
+        if session:
+            session.commitThreatEventsCursor(cursor)
+
+
+    def run(self, job):
+        """
+        Run a job
+        Params: job, 'events' or 'inventory'
+        Result: delay in seconds before next run
+        """
+
+        session = self.__session(job)
+
+        # Job is scheduled after quota reset instead of failing
+        if session.quota.available() <= 0:
+            delay = secondsToQuotaReset()
+            logger.warning('{0}: no query left today for {1}, next run in {2} seconds'.format(self.name, job, int(delay)))
+            return delay
+
+        # Queries estimate is logged once per session, like other scripts do before running
+        if job not in self.estimated:
+            logger.warning('{0}: estimating queries of {1} job'.format(self.name, job))
+            session.estimate(self.estimate(job, session))
+            self.estimated.add(job)
+
+        if job == 'events':
+            delay = self.pullEvents(session)
+        else:
+            delay = self.scanInventory(session)
+        self.failures[job] = 0
+        return delay
+
+
+    def estimate(self, job, session):
+        """
+        Estimate queries of a job
+        Params:
+            job: 'events' or 'inventory'
+            session: Trellix object
+        Result: number of queries pulls will send until end of UTC day within budget, or queries of next inventory sync
+        """
+
+        if job == 'events':
+            return self.scheduler.estimate()
+
+        # Device count query, then all devices pages if inventory is not fresh
+        inventory = Inventory(settings = self.settings)
+        try:
+            if inventory.isFresh():
+                return 0
+        finally:
+            inventory.close()
+        return 1 + math.ceil(session.getDeviceCount() / session.device_page_limit)
+
+
+    def pullEvents(self, session):
+        """
+        Pull new threat events and deliver them to tenant sinks
+        Params: session, Trellix object
+        Result: delay in seconds before next pull
+        """
+
+        queries = session.quota.used()
+        pulled = session.threat_events_pulled
+
+        for event_list, cursor in session.iterThreatEventPages(self.event_filter):
+            if self.dedup:
+                event_list = self.dedup.filter(event_list)
+            self.pipeline.deliver(event_list, cursor)
+
+        # Keys are saved only once their events are delivered
+        self.pipeline.drain()
+        if self.dedup:
+            self.dedup.save()
+
+        return self.scheduler.next(session.threat_events_pulled - pulled, session.quota.used() - queries)
+
+
+    def scanInventory(self, session):
+        """
+        Sync tenant inventory if it is not fresh
+        Params: session, Trellix object
+        Result: delay in seconds before next scan
+        """
+
+        # SQLite connections can not be shared between worker threads, inventory is opened by each scan
+        inventory = Inventory(settings = self.settings)
+        try:
+            updated = inventory.refresh(session)
+            logger.info('{0}: inventory synced, {1} device(s) updated'.format(self.name, updated))
+            return max(1, inventory.max_age - (time.time() - inventory.lastSync()))
+        finally:
+            inventory.close()
+
+
+    def fail(self, job, error):
+        """
+        Record a job failure, close its session so it is opened again next run
+        Params:
+            job: 'events' or 'inventory'
+            error: exception raised by the job
+        Result: delay in seconds before next run
+        """
+
+        self.failures[job] += 1
+        base = self.settings.get('tenant_backoff', DEFAULT_TENANT_BACKOFF)
+        delay = min(self.settings.get('tenant_backoff_max', DEFAULT_TENANT_BACKOFF_MAX), base * 2 ** (self.failures[job] - 1))
+        logger.error('{0}: {1} failed ({2} in a row): {3}. Next run in {4} seconds'.format(
+            self.name, job, self.failures[job], repr(error), int(delay)))
+
+        self.estimated.discard(job)
+        session = self.sessions.pop(job, None)
+        if session:
+            session.session.close()
+        return delay
+
+
+    def close(self):
+        """
+        Write queued events, commit last cursor and stop sinks
+        """
+
+        self.pipeline.close()
+        if self.dedup:
+            self.dedup.save()
+        for session in self.sessions.values():
+            session.session.close()
+
+
+### Collector Class ###
+
+class Collector:
+    """
+    Run jobs of all tenants in a shared worker pool
+    - a tenant runs a single job at a time, so a slow or failing tenant holds at most one worker
+    - when several jobs are due, the one due first runs first, so each tenant gets its turn
+    - a failing job is logged and run again after a backoff delay, other tenants are not affected
+    """
+
+    def __init__(self, tenants, workers = None):
+        """
+        Params:
+            tenants: list of Tenant objects
+            workers: optional int overriding collector_workers setting from profile
+        """
+
+        self.tenants = tenants
+        self.workers = workers or profile.get('collector_workers', DEFAULT_COLLECTOR_WORKERS)
+        self.pool = ThreadPoolExecutor(max_workers = self.workers, thread_name_prefix = 'collector')
+        self.condition = threading.Condition()
+        self.sequence = itertools.count()
+        self.due = []
+        self.busy = set()
+        self.stopped = False
+
+        # All jobs are due at start
+        for tenant in tenants:
+            for job in tenant.jobs:
+                self.__schedule(tenant, job, 0)
+
+
+    def __schedule(self, tenant, job, delay):
+        # Add job to due list, sequence keeps order of jobs due at the same time
+        self.due.append((time.time() + delay, next(self.sequence), tenant, job))
+
+
+    def __next(self):
+        # First due entry of an idle tenant
+        idle = [entry for entry in self.due if entry[2].name not in self.busy]
+        return min(idle, key = lambda entry: entry[:2]) if idle else None
+
+
+    def __work(self, tenant, job):
+        # Run job in a worker, isolating any failure to this tenant, then schedule next run
+        try:
+            delay = tenant.run(job)
+        except (Exception, SystemExit) as e:
+            delay = tenant.fail(job, e)
+
+        with self.condition:
+            self.busy.discard(tenant.name)
+            self.__schedule(tenant, job, delay)
+            self.condition.notify()
+
+
+    def run(self):
+        """
+        Dispatch due jobs to workers until stop is called
+        """
+
+        logger.warning('Starting collector for {0} tenant(s) with {1} worker(s)...'.format(len(self.tenants), self.workers))
+        with self.condition:
+            while not self.stopped:
+                entry = self.__next()
+                if entry is None or len(self.busy) >= self.workers:
+                    self.condition.wait()
+                    continue
+                wait = entry[0] - time.time()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+
+                self.due.remove(entry)
+                tenant, job = entry[2], entry[3]
+                self.busy.add(tenant.name)
+                logger.debug('{0}: starting {1}'.format(tenant.name, job))
+                self.pool.submit(self.__work, tenant, job)
+
+
+    def stop(self):
+        """
+        Stop dispatching jobs, wait for running jobs and close tenants
+        """
+
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.pool.shutdown(wait = True)
+        for tenant in self.tenants:
+            try:
+                tenant.close()
+            except Exception as e:
+                logger.error('{0}: failed to close: {1}'.format(tenant.name, e))
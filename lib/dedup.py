@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Bounded threat events deduplication store: recent event keys in an LRU, older ones in daily Bloom filters
+
+Copyright (C) 2023 Philippe Le Bescond
+
+Contact : philippe.le.bescond(at)trellix.com
+"""
+
+import hashlib
+import json
+import math
+import os
+import time
+from collections import OrderedDict
+
+from lib.trellixAPI import profile, profile_path, logger, LockedFile
+
+### Constants ###
+
+# Deduplication state file name, written next to profile file when not set in profile, one file per tenant
+EVENTS_DEDUP = '.events_dedup'
+
+# API retention of threat events in days: older events can not be pulled again
+EVENTS_RETENTION_DAYS = 3
+
+# Daily filters kept at most, each key being checked in all of them: today and retention days
+RETAINED_FILTERS = EVENTS_RETENTION_DAYS + 1
+
+# Default sizing: events expected per day, Bloom filter false positive rate, event keys kept in LRU
+DEFAULT_DEDUP_CAPACITY = 1000000
+DEFAULT_DEDUP_ERROR_RATE = 0.001
+DEFAULT_DEDUP_LRU_SIZE = 100000
+
+# State file format version, a state file with another version or sizing is discarded
+DEDUP_STATE_VERSION = 1
+
+
+def eventKey(event):
+    """
+    Params: event, dict of event attributes
+    Result: string identifying the event, None if event has no identifier
+    """
+
+    key = event.get('autoguid') or event.get('id')
+    return str(key) if key else None
+
+
+### Dedup Store Class ###
+
+class DedupStore:
+    """
+    Remember keys of events already delivered, with a memory cap
+    - the most recent keys are kept exactly in an LRU
+    - every key is added to the Bloom filter of the UTC day it was seen; a filter is dropped once
+      events it holds are older than API retention, so memory does not grow with time
+    A Bloom filter never misses a key it holds, but can report an event never seen as a duplicate.
+    A key is checked in all retained filters, so each one is sized for dedup_error_rate / RETAINED_FILTERS:
+    an event never seen is dropped at dedup_error_rate at most, while each day stays within dedup_capacity events
+    """
+
+    def __init__(self, tenant, path = None, capacity = None, error_rate = None, lru_size = None, settings = None):
+        """
+        Params:
+            tenant: string identifying the tenant, each tenant has its own state file
+            path: optional string, state file path. Default is events_dedup setting or .events_dedup next to profile file
+            capacity: optional int, events expected per day. Default is dedup_capacity setting
+            error_rate: optional float, rate of events never seen reported as duplicates, for all filters. Default is dedup_error_rate setting
+            lru_size: optional int, number of keys kept in LRU. Default is dedup_lru_size setting
+            settings: optional dict of profile settings of the tenant. Default is profile file
+        """
+
+        settings = settings or profile
+        self.tenant = tenant
+        self.capacity = capacity or settings.get('dedup_capacity', DEFAULT_DEDUP_CAPACITY)
+        self.error_rate = error_rate or settings.get('dedup_error_rate', DEFAULT_DEDUP_ERROR_RATE)
+        self.lru_size = lru_size or settings.get('dedup_lru_size', DEFAULT_DEDUP_LRU_SIZE)
+
+        # Bloom filter sizing, optimal number of bits and hash functions for capacity and error rate of each filter
+        filter_error_rate = self.error_rate / RETAINED_FILTERS
+        self.bits = max(8, math.ceil(-self.capacity * math.log(filter_error_rate) / math.log(2) ** 2))
+        self.bits += -self.bits % 8
+        self.hashes = max(1, round(self.bits / self.capacity * math.log(2)))
+
+        # Filters by UTC day number, with number of keys added
+        self.buckets = {}
+        self.counts = {}
+        self.lru = OrderedDict()
+
+        # Counters since start
+        self.hits = 0
+        self.misses = 0
+
+        path = path or settings.get('events_dedup', os.path.join(os.path.dirname(profile_path), EVENTS_DEDUP))
+        self.state = LockedFile(path + '_' + tenant, durable = True)
+        self.load()
+
+
+    ### Persistence ###
+
+    def load(self):
+        """
+        Load filters saved by a previous run, if sizing has not changed
+        """
+
+        with self.state:
+            content = self.state.loadBytes()
+        if not content:
+            return
+
+        try:
+            header, payload = content.split(b'\n', 1)
+            header = json.loads(header)
+        except ValueError:
+            logger.warning('Deduplication state {0} is corrupted, starting empty'.format(self.state.path))
+            return
+
+        size = self.bits // 8
+        if (header.get('version') != DEDUP_STATE_VERSION or header.get('bits') != self.bits or header.get('hashes') != self.hashes
+                or len(payload) != size * len(header.get('days', []))):
+            logger.warning('Deduplication state {0} does not match current settings, starting empty'.format(self.state.path))
+            return
+
+        for position, (day, count) in enumerate(header['days']):
+            self.buckets[day] = bytearray(payload[position * size:(position + 1) * size])
+            self.counts[day] = count
+        self.__expire(self.__today())
+        logger.info('Deduplication state loaded: {0} events in {1} daily filters'.format(sum(self.counts.values()), len(self.buckets)))
+
+
+    def save(self):
+        """
+        Write filters to state file
+        Call it once events have been delivered: a key saved for an event not delivered would drop it after a crash
+        Result: Boolean, True if state file has been written
+        """
+
+        days = sorted(self.buckets)
+        header = {'version': DEDUP_STATE_VERSION, 'tenant': self.tenant, 'bits': self.bits, 'hashes': self.hashes,
+                  'days': [[day, self.counts[day]] for day in days], 'saved_at': time.time()}
+        content = json.dumps(header).encode() + b'\n' + b''.join(self.buckets[day] for day in days)
+        with self.state:
+            return self.state.dumpBytes(content)
+
+
+    ### Filters ###
+
+    def __today(self):
+        # UTC day number
+        return int(time.time() // 86400)
+
+
+    def __expire(self, today):
+        # Drop filters holding only events older than API retention
+        for day in [day for day in self.buckets if day < today - EVENTS_RETENTION_DAYS]:
+            del self.buckets[day]
+            del self.counts[day]
+
+
+    def __positions(self, key):
+        # Bit positions of a key, from two 64 bits hashes (double hashing)
+        digest = hashlib.blake2b(key.encode(), digest_size = 16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+
+    def __inFilters(self, positions):
+        # True if all bits of key are set in one of the daily filters
+        for bits in self.buckets.values():
+            if all(bits[position >> 3] & (1 << (position & 7)) for position in positions):
+                return True
+        return False
+
+
+    def __add(self, key, positions, today):
+        # Add key to LRU and to today filter
+        self.lru[key] = None
+        if len(self.lru) > self.lru_size:
+            self.lru.popitem(last = False)
+
+        bits = self.buckets.get(today)
+        if bits is None:
+            self.__expire(today)
+            bits = self.buckets[today] = bytearray(self.bits // 8)
+            self.counts[today] = 0
+        for position in positions:
+            bits[position >> 3] |= 1 << (position & 7)
+        self.counts[today] += 1
+        if self.counts[today] == self.capacity + 1:
+            logger.warning('More than {0} events today, deduplication false positive rate is now above {1}. Increase dedup_capacity'.format(
+                self.capacity, self.error_rate))
+
+
+    ### Deduplication ###
+
+    def seen(self, event):
+        """
+        Verifies if an event has already been delivered, and remembers it otherwise
+        Params: event, dict of event attributes
+        Result: Boolean, True if event is a duplicate. Events without identifier are never duplicates
+        """
+
+        key = eventKey(event)
+        if key is None:
+            return False
+
+        if key in self.lru:
+            self.lru.move_to_end(key)
+            self.hits += 1
+            return True
+
+        positions = self.__positions(key)
+        if self.__inFilters(positions):
+            self.hits += 1
+            return True
+
+        self.__add(key, positions, self.__today())
+        self.misses += 1
+        return False
+
+
+    def filter(self, events):
+        """
+        Drop events already delivered, including duplicates within the list
+        Params: events, list of event dicts
+        Result: list of events not delivered yet, in the same order
+        """
+
+        return [event for event in events if not self.seen(event)]
+
+
+    def stats(self):
+        """
+        Result: dict with hits (duplicates dropped), misses (new events), keys in LRU, daily filters and memory used in bytes
+        """
+
+        return {'hits': self.hits, 'misses': self.misses, 'lru': len(self.lru), 'filters': len(self.buckets),
+                'filter_bytes': sum(len(bits) for bits in self.buckets.values())}
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Threat events filter: predicates and field projection, sent to the API as a filter when supported,
+and always applied to pulled events
+
+Copyright (C) 2023 Philippe Le Bescond
+
+Contact : philippe.le.bescond(at)trellix.com
+"""
+
+import json
+from urllib.parse import quote
+
+### Constants ###
+
+# Fields always kept by projection: timestamp is needed for cursor, autoguid identifies events
+KEY_FIELDS = ['timestamp', 'autoguid']
+
+
+### Event Filter Class ###
+
+class EventFilter:
+    """
+    Select threat events and their fields
+    - max_severity keeps events with threatseverity lower or equal (0 is the most severe)
+    - analyzers and categories keep events from these analyzers and threat categories
+    - since and until keep events with since <= timestamp < until (ISO 8601 UTC timestamps, as returned by the API)
+    - fields keeps only these attributes, plus timestamp and autoguid
+    Conditions not set do not filter anything
+    """
+
+    def __init__(self, max_severity = None, analyzers = None, categories = None, since = None, until = None, fields = None):
+        """
+        Params:
+            max_severity: optional int, highest threatseverity kept
+            analyzers: optional list of analyzer codes, like ENDP_AM_1070
+            categories: optional list of threat categories, like av.detect
+            since: optional string, first timestamp kept
+            until: optional string, timestamp excluded
+            fields: optional list of event attributes kept
+        """
+
+        self.max_severity = max_severity
+        self.analyzers = list(analyzers) if analyzers else None
+        self.categories = list(categories) if categories else None
+        self.since = since
+        self.until = until
+        self.fields = None
+        if fields:
+            self.fields = list(fields) + [field for field in KEY_FIELDS if field not in fields]
+
+        self.match = self.__compile()
+
+
+    def __bool__(self):
+        # False when filter keeps all events and all fields
+        return any(value is not None for value in (self.max_severity, self.analyzers, self.categories, self.since, self.until, self.fields))
+
+
+    ### Client side ###
+
+    def __compile(self):
+        # Build a single predicate from conditions set, checking cheapest conditions first
+        checks = []
+        if self.max_severity is not None:
+            severities = frozenset(str(severity) for severity in range(self.max_severity + 1))
+            checks.append(lambda event: str(event.get('threatseverity')) in severities)
+        if self.analyzers:
+            analyzers = frozenset(self.analyzers)
+            checks.append(lambda event: event.get('analyzer') in analyzers)
+        if self.categories:
+            categories = frozenset(self.categories)
+            checks.append(lambda event: event.get('threatcategory') in categories)
+        if self.since:
+            since = self.since
+            checks.append(lambda event: (event.get('timestamp') or '') >= since)
+        if self.until:
+            until = self.until
+            checks.append(lambda event: (event.get('timestamp') or '') < until)
+
+        if not checks:
+            return lambda event: True
+        if len(checks) == 1:
+            return checks[0]
+        return lambda event: all(check(event) for check in checks)
+
+
+    def project(self, event):
+        """
+        Params: event, dict of event attributes
+        Result: dict with selected fields only, or event itself if no field list is set
+        """
+
+        if self.fields is None:
+            return event
+        return {field: event[field] for field in self.fields if field in event}
+
+
+    def apply(self, events):
+        """
+        Filter and project a page of events
+        Params: events, list of event dicts
+        Result: list of selected events, in the same order
+        """
+
+        match = self.match
+        if self.fields is None:
+            return [event for event in events if match(event)]
+        fields = self.fields
+        return [{field: event[field] for field in fields if field in event} for event in events if match(event)]
+
+
+    ### Server side ###
+
+    def apiFilter(self):
+        """
+        Result: filter as a dict, in the API filter format used for devices (EQ, IN, GE, LT, AND), None if no condition is set
+        """
+
+        conditions = []
+        if self.max_severity is not None:
+            conditions.append({'IN': {'threatseverity': [str(severity) for severity in range(self.max_severity + 1)]}})
+        if self.analyzers:
+            conditions.append({'IN': {'analyzer': self.analyzers}})
+        if self.categories:
+            conditions.append({'IN': {'threatcategory': self.categories}})
+        if self.since:
+            conditions.append({'GE': {'timestamp': self.since}})
+        if self.until:
+            conditions.append({'LT': {'timestamp': self.until}})
+
+        if not conditions:
+            return None
+        if len(conditions) == 1:
+            return conditions[0]
+        return {'AND': conditions}
+
+
+    def queryParameters(self):
+        """
+        Result: string to add to events query, with filter and fields parameters
+        """
+
+        parameters = ''
+        api_filter = self.apiFilter()
+        if api_filter:
+            parameters += '&filter=' + quote(json.dumps(api_filter))
+        if self.fields:
+            parameters += '&fields=' + ','.join(self.fields)
+        return parameters
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+Snapshot export: devices data written in a typed, compressed and date partitioned dataset,
+in Parquet when pyarrow is installed, in gzip compressed NDJSON otherwise
+
+Copyright (C) 2023 Philippe Le Bescond
+
+Contact : philippe.le.bescond(at)trellix.com
+"""
+
+import gzip
+import json
+import os
+from datetime import datetime, timezone
+
+from lib.trellixAPI import profile, logger, AVAILABLE_PROPS
+
+# Parquet files are written when pyarrow is installed
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+### Constants ###
+
+# Column types of device properties, properties not listed are strings
+PROPERTY_TYPES = {'id': 'int64', 'parentId': 'int64', 'cpuSpeed': 'int64', 'numOfCpu': 'int64', 'totalPhysicalMemory': 'int64',
+                  'lastUpdate': 'timestamp', 'nodeCreatedDate': 'timestamp', 'managed': 'bool', 'isPortable': 'bool',
+                  'installedProducts': 'json', 'assignedTags': 'json'}
+
+# Column holding snapshot time, first column of every dataset
+SNAPSHOT_COLUMN = ('snapshot_at', 'timestamp')
+
+# Dataset schemas, as lists of (column, type). Schemas only change with AVAILABLE_PROPS, whatever properties are collected
+SCHEMAS = {
+    'systemsProperties': [SNAPSHOT_COLUMN] + [(prop, PROPERTY_TYPES.get(prop, 'string')) for prop in AVAILABLE_PROPS],
+    'propertyChanges': [SNAPSHOT_COLUMN, ('change', 'string')] + [(prop, PROPERTY_TYPES.get(prop, 'string')) for prop in AVAILABLE_PROPS],
+    'installedProducts': [SNAPSHOT_COLUMN, ('id', 'int64'), ('name', 'string'), ('productFamilyName', 'string'),
+                          ('productVersion', 'string'), ('error', 'string')]
+}
+
+# Export defaults, used when not set in profile file: file format and rows written at once (Parquet row group)
+DEFAULT_EXPORT_FORMAT = 'parquet'
+DEFAULT_EXPORT_BATCH_SIZE = 10000
+
+# File suffix and compression by format
+EXPORT_SUFFIXES = {'parquet': '.parquet', 'ndjson': '.ndjson.gz'}
+PARQUET_COMPRESSION = 'zstd'
+GZIP_LEVEL = 6
+
+# Schema file written in each dataset folder
+SCHEMA_FILE = '_schema.json'
+
+
+### Helpers ###
+
+def parseTimestamp(value):
+    """
+    Params: value, ISO 8601 string like "2024-03-07T13:09:06.118Z", or epoch time in milliseconds
+    Result: timezone aware datetime in UTC
+    """
+
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return datetime.fromtimestamp(value / 1000, timezone.utc)
+    timestamp = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo = timezone.utc)
+    return timestamp.astimezone(timezone.utc)
+
+
+def coerce(value, type):
+    """
+    Convert a value returned by the API to a column type
+    Params:
+        value: any JSON value
+        type: 'int64', 'bool', 'timestamp', 'json' or 'string'
+    Result: converted value, None for empty values
+    Raises ValueError or TypeError if value can not be converted
+    """
+
+    if value is None or value == '':
+        return None
+
+    if type == 'int64':
+        if isinstance(value, bool):
+            raise TypeError('boolean is not an integer')
+        return int(value)
+
+    if type == 'bool':
+        if isinstance(value, bool):
+            return value
+        text = str(value).casefold()
+        if text in ('true', '1', 'yes'):
+            return True
+        if text in ('false', '0', 'no'):
+            return False
+        raise ValueError('{0} is not a boolean'.format(value))
+
+    if type == 'timestamp':
+        return parseTimestamp(value)
+
+    # Lists and dicts are kept as JSON text, so that a column keeps a single type
+    if isinstance(value, str):
+        return value
+    if type == 'json' or isinstance(value, (list, dict)):
+        return json.dumps(value, sort_keys = True)
+    return str(value)
+
+
+def productRows(device):
+    """
+    Flatten installedProducts script output, one row per installed product
+    Params: device, dict with name, id, products list and optional error
+    Result: list of dict, a single row without product for devices without product
+    """
+
+    base = {'id': device.get('id'), 'name': device.get('name'), 'error': device.get('error')}
+    rows = []
+    for product in device.get('products') or [{}]:
+        row = dict(base)
+        row['productFamilyName'] = product.get('productFamilyName')
+        row['productVersion'] = product.get('productVersion')
+        rows.append(row)
+    return rows
+
+
+### Snapshot Export Class ###
+
+class SnapshotExport:
+    """
+    Write one snapshot of a dataset in <folder>/<dataset>/date=<YYYY-MM-DD>/<dataset>-<time>Z<suffix>
+    - every file of a dataset has the same columns and types, described in its _schema.json file
+    - Parquet files are compressed with zstd and written by row groups, so queries only read needed columns
+    - NDJSON files are compressed with gzip, every row has all columns with converted values
+    The file is written under a temporary name and renamed once complete, a failed export leaves no partial snapshot
+    """
+
+    def __init__(self, folder, dataset, format = None, batch_size = None):
+        """
+        Params:
+            folder: string, root folder of datasets
+            dataset: string, dataset name, one of SCHEMAS
+            format: optional 'parquet' or 'ndjson'. Default is export_format setting, ndjson if pyarrow is not installed
+            batch_size: optional int, rows written at once. Default is export_batch_size setting
+        """
+
+        self.dataset = dataset
+        self.schema = SCHEMAS[dataset]
+        self.format = format or profile.get('export_format', DEFAULT_EXPORT_FORMAT)
+        if self.format == 'parquet' and pyarrow is None:
+            logger.warning('pyarrow module is not installed, snapshot is exported in compressed NDJSON')
+            self.format = 'ndjson'
+        self.batch_size = batch_size or profile.get('export_batch_size', DEFAULT_EXPORT_BATCH_SIZE)
+
+        # All rows of a snapshot share its time, and it is partitioned by its UTC date
+        self.snapshot_at = datetime.now(timezone.utc)
+        self.folder = os.path.join(folder, dataset)
+        partition = os.path.join(self.folder, 'date=' + self.snapshot_at.strftime('%Y-%m-%d'))
+        os.makedirs(partition, exist_ok = True)
+        self.path = os.path.join(partition, '{0}-{1}Z{2}'.format(dataset, self.snapshot_at.strftime('%Y%m%dT%H%M%S%f'), EXPORT_SUFFIXES[self.format]))
+        self.temp_path = os.path.join(partition, '.' + os.path.basename(self.path) + '.tmp')
+
+        self.rows = []
+        self.count = 0
+        self.errors = {}
+        self.writer = None
+        if self.format == 'parquet':
+            self.arrow_schema = pyarrow.schema([(column, self.__arrowType(type)) for column, type in self.schema])
+            self.writer = pyarrow.parquet.ParquetWriter(self.temp_path, self.arrow_schema, compression = PARQUET_COMPRESSION)
+        else:
+            self.writer = gzip.open(self.temp_path, 'wt', encoding = 'utf-8', compresslevel = GZIP_LEVEL)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+    def __arrowType(self, type):
+        # Arrow type of a column type
+        return {'int64': pyarrow.int64(), 'bool': pyarrow.bool_(), 'timestamp': pyarrow.timestamp('ms', tz = 'UTC')}.get(type, pyarrow.string())
+
+
+    ### Writes ###
+
+    def write(self, record):
+        """
+        Add a row, written once batch is full
+        Params: record, dict of column values. Missing columns are empty, keys not in schema are ignored
+        """
+
+        row = {SNAPSHOT_COLUMN[0]: self.snapshot_at}
+        for column, type in self.schema[1:]:
+            try:
+                row[column] = coerce(record.get(column), type)
+            except (ValueError, TypeError, OverflowError):
+                # A value of unexpected type is left empty, rather than changing column type
+                self.errors[column] = self.errors.get(column, 0) + 1
+                row[column] = None
+
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.__flush()
+
+
+    def writeAll(self, records):
+        """
+        Params: records, iterable of dict
+        Result: number of rows written
+        """
+
+        for record in records:
+            self.write(record)
+        return self.count + len(self.rows)
+
+
+    def __flush(self):
+        # Write pending rows
+        if not self.rows:
+            return
+
+        if self.format == 'parquet':
+            columns = {column: [row[column] for row in self.rows] for column, type in self.schema}
+            self.writer.write_table(pyarrow.Table.from_pydict(columns, schema = self.arrow_schema))
+        else:
+            for row in self.rows:
+                self.writer.write(json.dumps(row, default = self.__isoformat, separators = (',', ':')) + '\n')
+
+        self.count += len(self.rows)
+        self.rows = []
+
+
+    def __isoformat(self, value):
+        # Timestamps in NDJSON files, in UTC with milliseconds like API timestamps
+        return value.strftime('%Y-%m-%dT%H:%M:%S.') + '{0:03d}Z'.format(value.microsecond // 1000)
+
+
+    def close(self):
+        """
+        Write pending rows, then publish snapshot file and dataset schema
+        Result: string, snapshot file path
+        """
+
+        self.__flush()
+        self.writer.close()
+        os.replace(self.temp_path, self.path)
+        self.__writeSchema()
+
+        for column, count in self.errors.items():
+            logger.warning('{0} value(s) of {1} could not be converted to {2} and are left empty'.format(
+                count, column, dict(self.schema)[column]))
+        logger.warning('Snapshot of {0} row(s) exported to {1}'.format(self.count, self.path))
+        return self.path
+
+
+    def abort(self):
+        """
+        Drop snapshot file being written
+        """
+
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+        logger.error('Snapshot export to {0} aborted'.format(self.path))
+
+
+    def __writeSchema(self):
+        # Dataset schema, for readers of NDJSON files and to check schema has not changed
+        schema = {'dataset': self.dataset, 'partitioning': 'date', 'columns': [{'name': column, 'type': type} for column, type in self.schema]}
+        schema_path = os.path.join(self.folder, SCHEMA_FILE)
+        try:
+            with open(schema_path, 'r') as schema_file:
+                if json.load(schema_file) == schema:
+                    return
+            logger.warning('Schema of dataset {0} changed, {1} is updated'.format(self.dataset, schema_path))
+        except (OSError, ValueError):
+            pass
+
+        with open(schema_path, 'w') as schema_file:
+            json.dump(schema, schema_file, indent = 4)
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+"""
+Compact in-memory fleet: device ids, names and tags of all systems, stored in parallel arrays
+
+Copyright (C) 2023 Philippe Le Bescond
+
+Contact : philippe.le.bescond(at)trellix.com
+"""
+
+import sys
+from array import array
+from bisect import bisect_left
+
+from lib.trellixAPI import splitTags
+
+
+### Fleet Class ###
+
+class Fleet:
+    """
+    Compact list of systems and their tags
+    - device ids are kept in an array, names in a single UTF-8 buffer with an offsets array
+    - tag names are interned once and each tag has a membership bitset, one bit per system
+    Tag checks and set operations on tags (systems with tag A but not tag B) work on bitsets,
+    without parsing tags strings. Tag names are matched like Trellix.getTagId: exact name first, then not case sensitive
+    """
+
+    __slots__ = ('ids', 'name_buffer', 'name_offsets', 'tag_names', 'tag_ids', 'tag_folded', 'tag_bits', 'ascending', 'position')
+
+    def __init__(self):
+        self.ids = array('q')
+        self.name_buffer = bytearray()
+        self.name_offsets = array('Q', [0])
+        self.tag_names = []
+        self.tag_ids = {}
+        self.tag_folded = {}
+        self.tag_bits = []
+        self.ascending = True
+        self.position = None
+
+
+    @classmethod
+    def fromDeviceList(cls, device_list, tags_applied):
+        """
+        Build fleet from dicts, like Trellix.deviceList and Trellix.tagsApplied or Inventory.deviceList and Inventory.tagsApplied
+        Params:
+            device_list: dict formatted as "device id":"device name"
+            tags_applied: dict formatted as "device id":"tags list"
+        Result: Fleet object
+        """
+
+        fleet = cls()
+        for device, name in device_list.items():
+            fleet.add(device, name, tags_applied.get(device))
+        return fleet
+
+
+    @classmethod
+    def fromRows(cls, rows):
+        """
+        Build fleet from rows, like Inventory.deviceRows(), without building dicts
+        Params: rows, iterable of (device id, device name, tags list)
+        Result: Fleet object
+        """
+
+        fleet = cls()
+        for device, name, tags in rows:
+            fleet.add(device, name, tags)
+        return fleet
+
+
+    @classmethod
+    def fromSession(cls, session):
+        """
+        Build fleet from all systems registered in ePO, page by page, without building dicts
+        Params: session, Trellix object
+        Result: Fleet object
+        """
+
+        fleet = cls()
+        for device in session.iterDevices(['name', 'tags']):
+            fleet.add(device['id'], device.get('name'), device.get('tags'))
+        return fleet
+
+
+    ### Building ###
+
+    def add(self, device_id, name, tags):
+        """
+        Add a system
+        Params:
+            device_id: int
+            name: string containing device name
+            tags: string containing tags separated by commas, as returned by the API
+        """
+
+        index = len(self.ids)
+        device_id = int(device_id)
+        if index and device_id <= self.ids[-1]:
+            self.ascending = False
+            self.position = None
+        self.ids.append(device_id)
+
+        self.name_buffer += (name or '').encode()
+        self.name_offsets.append(len(self.name_buffer))
+
+        for tag in splitTags(tags):
+            bits = self.tag_bits[self.__internTag(tag)]
+            byte = index >> 3
+            if byte >= len(bits):
+                bits.extend(bytes(byte + 1 - len(bits)))
+            bits[byte] |= 1 << (index & 7)
+
+
+    def __internTag(self, tag):
+        # Tag id, created on first use
+        tag_id = self.tag_ids.get(tag)
+        if tag_id is None:
+            tag_id = len(self.tag_names)
+            tag = sys.intern(tag)
+            self.tag_names.append(tag)
+            self.tag_ids[tag] = tag_id
+            self.tag_folded.setdefault(tag.casefold(), []).append(tag_id)
+            self.tag_bits.append(bytearray())
+        return tag_id
+
+
+    def __matchTag(self, tag):
+        # Ids of tags matching a name: exact name first, then all tags with the same name, not case sensitive
+        tag_id = self.tag_ids.get(tag)
+        if tag_id is not None:
+            return [tag_id]
+        return self.tag_folded.get(tag.casefold(), [])
+
+
+    def setTag(self, device_ids, tag, applied = True):
+        """
+        Update tag after it has been applied or cleared
+        Params:
+            device_ids: list of device ids
+            tag: string containing tag name
+            applied: Boolean, False if tag has been cleared
+        """
+
+        # Tag is applied under the name already known, and cleared whatever its case
+        tag_ids = self.__matchTag(tag) or [self.__internTag(tag)]
+        for device_id in device_ids:
+            index = self.index(device_id)
+            if index < 0:
+                continue
+            byte = index >> 3
+            for tag_id in tag_ids[:1] if applied else tag_ids:
+                bits = self.tag_bits[tag_id]
+                if byte >= len(bits):
+                    bits.extend(bytes(byte + 1 - len(bits)))
+                if applied:
+                    bits[byte] |= 1 << (index & 7)
+                else:
+                    bits[byte] &= ~(1 << (index & 7)) & 0xff
+
+
+    ### Lookup ###
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def index(self, device_id):
+        """
+        Position of a system in arrays
+        Params: device_id, int
+        Result: int, -1 if device is not found
+        """
+
+        device_id = int(device_id)
+
+        # Ids are usually returned in ascending order by the API, a position dict is only built otherwise
+        if self.ascending:
+            index = bisect_left(self.ids, device_id)
+            return index if index < len(self.ids) and self.ids[index] == device_id else -1
+        if self.position is None:
+            self.position = {device: index for index, device in enumerate(self.ids)}
+        return self.position.get(device_id, -1)
+
+
+    def __contains__(self, device_id):
+        return self.index(device_id) >= 0
+
+
+    def name(self, device_id):
+        """
+        Params: device_id, int
+        Result: device name, None if device is not found
+        """
+
+        index = self.index(device_id)
+        if index < 0:
+            return None
+        return self.name_buffer[self.name_offsets[index]:self.name_offsets[index + 1]].decode()
+
+
+    def __getitem__(self, device_id):
+        # Same as Trellix.deviceList[device_id]
+        name = self.name(device_id)
+        if name is None:
+            raise KeyError(device_id)
+        return name
+
+
+    def get(self, device_id, default = None):
+        # Same as dict.get on Trellix.deviceList
+        name = self.name(device_id)
+        return default if name is None else name
+
+
+    def __iter__(self):
+        # Same as iterating on Trellix.deviceList: device ids
+        return iter(self.ids)
+
+
+    def keys(self):
+        """
+        Yields device id of each system, like Trellix.deviceList.keys()
+        """
+
+        return iter(self.ids)
+
+
+    def items(self):
+        """
+        Yields (device id, device name) of each system, like Trellix.deviceList.items()
+        """
+
+        buffer = self.name_buffer
+        offsets = self.name_offsets
+        for index, device_id in enumerate(self.ids):
+            yield device_id, buffer[offsets[index]:offsets[index + 1]].decode()
+
+
+    def hasTag(self, device_id, tag):
+        """
+        Verifies if tag is applied to a system
+        Params:
+            device_id: int
+            tag: string containing tag name
+        Result: Boolean
+        """
+
+        index = self.index(device_id)
+        if index < 0:
+            return False
+        byte, bit = index >> 3, 1 << (index & 7)
+        return any(byte < len(self.tag_bits[tag_id]) and self.tag_bits[tag_id][byte] & bit for tag_id in self.__matchTag(tag))
+
+
+    def tags(self, device_id):
+        """
+        Params: device_id, int
+        Result: list of tags applied to a system
+        """
+
+        index = self.index(device_id)
+        if index < 0:
+            return []
+        byte, bit = index >> 3, 1 << (index & 7)
+        return [tag for tag, bits in zip(self.tag_names, self.tag_bits) if byte < len(bits) and bits[byte] & bit]
+
+
+    ### Tag set operations ###
+
+    def __bitset(self, tag):
+        # Tag bitset as an int, bit n is set if tag is applied on system n
+        bitset = 0
+        for tag_id in self.__matchTag(tag):
+            bitset |= int.from_bytes(self.tag_bits[tag_id], 'little')
+        return bitset
+
+
+    def select(self, all_of = (), any_of = (), none_of = ()):
+        """
+        Get systems matching tags
+        Params:
+            all_of: list of tags applied on all selected systems
+            any_of: list of tags, at least one of them is applied on selected systems
+            none_of: list of tags not applied on selected systems
+        Result: list of device ids
+        Example: select(['A'], none_of = ['B']) returns systems with tag A but not tag B
+        """
+
+        selected = (1 << len(self.ids)) - 1
+        for tag in all_of:
+            selected &= self.__bitset(tag)
+        if any_of:
+            matching = 0
+            for tag in any_of:
+                matching |= self.__bitset(tag)
+            selected &= matching
+        for tag in none_of:
+            selected &= ~self.__bitset(tag)
+
+        # Convert selected bits to device ids, skipping empty bytes
+        ids = []
+        for byte, value in enumerate(selected.to_bytes((len(self.ids) + 7) // 8, 'little')):
+            while value:
+                low = value & -value
+                ids.append(self.ids[(byte << 3) + low.bit_length() - 1])
+                value ^= low
+        return ids
+
+
+    def count(self, tag):
+        """
+        Params: tag, string containing tag name
+        Result: number of systems with tag applied
+        """
+
+        return bin(self.__bitset(tag)).count('1')
+
+
+    ### Compatibility ###
+
+    def deviceList(self):
+        """
+        Result: dict formatted as "device id":"device name", like Trellix.deviceList
+        """
+
+        return dict(self.items())
+
+
+    def tagsApplied(self):
+        """
+        Result: dict formatted as "device id":"tags list", like Trellix.tagsApplied
+        """
+
+        return {device_id: ', '.join(self.tags(device_id)) for device_id in self.ids}
+
+
+### Fleet Tags View ###
+
+class FleetTags:
+    """
+    Read only view of tags applied on each system of a fleet, used as Trellix.tagsApplied ("tags list" strings)
+    or as Trellix.deviceTags() (frozensets of tags), without building a dict
+    """
+
+    __slots__ = ('fleet', 'as_set')
+
+    def __init__(self, fleet, as_set = False):
+        """
+        Params:
+            fleet: Fleet object
+            as_set: Boolean, True for frozensets of tags, False for tags separated by commas
+        """
+
+        self.fleet = fleet
+        self.as_set = as_set
+
+
+    def __value(self, device_id):
+        tags = self.fleet.tags(device_id)
+        return frozenset(tags) if self.as_set else ', '.join(tags)
+
+
+    def __getitem__(self, device_id):
+        if device_id not in self.fleet:
+            raise KeyError(device_id)
+        return self.__value(device_id)
+
+
+    def get(self, device_id, default = None):
+        return self.__value(device_id) if device_id in self.fleet else default
+
+
+    def __contains__(self, device_id):
+        return device_id in self.fleet
+
+
+    def __iter__(self):
+        return iter(self.fleet)
+
+
+    def __len__(self):
+        return len(self.fleet)
+
+
+    def keys(self):
+        return self.fleet.keys()
+
+
+    def items(self):
+        for device_id in self.fleet:
+            yield device_id, self.__value(device_id)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Local device inventory, stored in SQLite and synced incrementally from Trellix API
+
+Copyright (C) 2023 Philippe Le Bescond
+
+Contact : philippe.le.bescond(at)trellix.com
+"""
+
+import sqlite3
+import json
+import os
+import time
+
+from lib.trellixAPI import profile, profile_path, logger, splitTags, tenantKey
+
+### Constants ###
+
+# Inventory file name, written next to profile file when not set in profile
+INVENTORY = '.inventory.db'
+
+# Properties always stored in inventory
+INVENTORY_PROPS = ['name', 'agentGuid', 'lastUpdate', 'nodeCreatedDate', 'tags']
+
+# Default inventory max age before incremental sync, and interval between full syncs, in seconds
+DEFAULT_INVENTORY_MAX_AGE = 3600
+DEFAULT_INVENTORY_FULL_SYNC = 86400
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS devices (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    agentGuid TEXT,
+    lastUpdate TEXT,
+    nodeCreatedDate TEXT,
+    tags TEXT,
+    properties TEXT
+);
+CREATE INDEX IF NOT EXISTS devices_name ON devices (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS devices_agentGuid ON devices (agentGuid);
+CREATE TABLE IF NOT EXISTS device_tags (
+    tag TEXT,
+    device_id INTEGER,
+    PRIMARY KEY (tag, device_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS device_tags_device ON device_tags (device_id);
+CREATE TABLE IF NOT EXISTS sync (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+
+### Inventory Class ###
+
+class Inventory:
+    """
+    Local device inventory: device id, name, tags and selected properties,
+    indexed by name, agentGuid and tag
+    """
+
+    def __init__(self, path = None, props = None, settings = None):
+        """
+        Open or create local inventory
+        Params:
+            path: optional string containing inventory file path, overriding inventory_path setting from profile
+            props: optional list of properties to store, overriding inventory_props setting from profile
+            settings: optional dict of profile settings of the tenant. Default is profile file
+        Result: Inventory object
+        """
+
+        settings = settings or profile
+        self.path = path or settings.get('inventory_path', os.path.join(os.path.dirname(profile_path), INVENTORY))
+        self.props = list(dict.fromkeys(INVENTORY_PROPS + (props or settings.get('inventory_props', []))))
+        self.max_age = settings.get('inventory_max_age', DEFAULT_INVENTORY_MAX_AGE)
+        self.full_sync_interval = settings.get('inventory_full_sync', DEFAULT_INVENTORY_FULL_SYNC)
+
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(SCHEMA)
+
+        # Inventory is reset if tenant or stored properties changed
+        tenant = tenantKey(settings)
+        if self.__get('tenant') != tenant or self.__get('props') != ','.join(self.props):
+            logger.info('New inventory for tenant {0} with properties {1}'.format(tenant, self.props))
+            with self.db:
+                self.db.execute('DELETE FROM devices')
+                self.db.execute('DELETE FROM device_tags')
+                self.db.execute('DELETE FROM sync')
+                self.__set('tenant', tenant)
+                self.__set('props', ','.join(self.props))
+
+
+    def close(self):
+        self.db.close()
+
+
+    ### Sync state ###
+
+    def __get(self, key, default = None):
+        row = self.db.execute('SELECT value FROM sync WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def __set(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO sync (key, value) VALUES (?, ?)', (key, str(value)))
+
+
+    def lastSync(self):
+        """
+        Get last sync time
+        Result: epoch time, 0 if never synced
+        """
+
+        return float(self.__get('last_sync', 0))
+
+
+    def isFresh(self, max_age = None):
+        """
+        Verifies if inventory has been synced recently
+        Params: max_age, optional int in seconds overriding inventory_max_age setting from profile
+        Result: Boolean
+        """
+
+        max_age = self.max_age if max_age is None else max_age
+        return time.time() - self.lastSync() < max_age
+
+
+    ### Sync functions ###
+
+    def sync(self, session, full = False, tags = False):
+        """
+        Sync inventory from Trellix API
+        Incremental sync only gathers devices with lastUpdate or nodeCreatedDate newer than previous sync.
+        Tags applied or cleared do not change these properties, so an incremental sync does not see them,
+        unless tags are refreshed: tags of all devices are then gathered too, without other properties.
+        Full sync gathers all devices and removes deleted ones, it is done if inventory is empty,
+        if forced, or if last full sync is older than inventory_full_sync setting
+        Params:
+            session: Trellix object
+            full: Boolean to force a full sync
+            tags: Boolean, True to refresh tags of all devices in an incremental sync, before tag based operations
+        Result: number of devices updated
+        """
+
+        watermark = self.__get('watermark')
+        full = full or not watermark or time.time() - float(self.__get('last_full_sync', 0)) >= self.full_sync_interval
+        sync_start = time.time()
+
+        if full:
+            logger.info('Starting full inventory sync...')
+            devices = session.getDevices(self.props)
+        else:
+            logger.info('Starting incremental inventory sync from {0}...'.format(watermark))
+            devices = session.getDevices(self.props, {'OR': [{'GE': {'lastUpdate': watermark}},
+                                                             {'GE': {'nodeCreatedDate': watermark}}]})
+
+        # Tags of all devices, changed tags are updated after devices
+        device_tags = []
+        if tags and not full:
+            logger.info('Refreshing tags of all devices...')
+            device_tags = [(device['id'], device.get('tags')) for device in session.iterDevices(['tags'])]
+
+        with self.db:
+            if full:
+                self.db.execute('DELETE FROM devices')
+                self.db.execute('DELETE FROM device_tags')
+            self.__store(devices)
+            self.__storeTags(device_tags)
+
+            # Next incremental sync starts from most recent server timestamp seen
+            timestamps = [d.get(key) for d in devices for key in ('lastUpdate', 'nodeCreatedDate') if d.get(key)]
+            if timestamps:
+                self.__set('watermark', max(timestamps + ([watermark] if watermark else [])))
+            self.__set('last_sync', sync_start)
+            if full:
+                self.__set('last_full_sync', sync_start)
+
+        logger.info('Inventory synced, {0} device(s) updated'.format(len(devices)))
+        return len(devices)
+
+
+    def refresh(self, session, max_age = None, tags = False):
+        """
+        Sync inventory only if it is not fresh
+        Params:
+            session: Trellix object
+            max_age: optional int in seconds overriding inventory_max_age setting from profile
+            tags: Boolean, True to refresh tags of all devices if an incremental sync is done, before tag based operations
+        Result: number of devices updated
+        """
+
+        if self.isFresh(max_age):
+            logger.info('Inventory is fresh, last sync {0} seconds ago'.format(int(time.time() - self.lastSync())))
+            return 0
+        return self.sync(session, tags = tags)
+
+
+    def __store(self, devices):
+        # Insert or replace devices and their tags
+        rows = []
+        tag_rows = []
+        for device in devices:
+            properties = {k: v for k, v in device.items() if k not in INVENTORY_PROPS and k != 'id'}
+            rows.append((device['id'], device.get('name'), device.get('agentGuid'), device.get('lastUpdate'),
+                         device.get('nodeCreatedDate'), device.get('tags'), json.dumps(properties)))
+            tag_rows.extend((tag, device['id']) for tag in splitTags(device.get('tags')))
+
+        self.db.executemany('DELETE FROM device_tags WHERE device_id = ?', [(row[0],) for row in rows])
+        self.db.executemany('INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        self.db.executemany('INSERT OR IGNORE INTO device_tags VALUES (?, ?)', tag_rows)
+
+
+    def __storeTags(self, device_tags):
+        # Update tags of devices already stored, only when they changed
+        stored = dict(self.db.execute('SELECT id, tags FROM devices')) if device_tags else {}
+        changed = [(device, tags) for device, tags in device_tags if device in stored and stored[device] != tags]
+
+        self.db.executemany('DELETE FROM device_tags WHERE device_id = ?', [(device,) for device, tags in changed])
+        self.db.executemany('UPDATE devices SET tags = ? WHERE id = ?', [(tags, device) for device, tags in changed])
+        self.db.executemany('INSERT OR IGNORE INTO device_tags VALUES (?, ?)',
+                            [(tag, device) for device, tags in changed for tag in splitTags(tags)])
+        if changed:
+            logger.info('Tags changed on {0} device(s)'.format(len(changed)))
+
+
+    def setTag(self, device_ids, tag, applied = True):
+        """
+        Update tag in inventory after it has been applied or cleared
+        Params:
+            device_ids: list of device ids
+            tag: string containing tag name
+            applied: Boolean, False if tag has been cleared
+        """
+
+        with self.db:
+            for device_id in device_ids:
+                row = self.db.execute('SELECT tags FROM devices WHERE id = ?', (int(device_id),)).fetchone()
+                if row is None:
+                    continue
+                tags = [t for t in splitTags(row[0]) if t != tag]
+                if applied:
+                    tags.append(tag)
+                    self.db.execute('INSERT OR IGNORE INTO device_tags VALUES (?, ?)', (tag, int(device_id)))
+                else:
+                    self.db.execute('DELETE FROM device_tags WHERE tag = ? AND device_id = ?', (tag, int(device_id)))
+                self.db.execute('UPDATE devices SET tags = ? WHERE id = ?', (', '.join(tags), int(device_id)))
+
+
+    ### Query functions ###
+
+    def getDeviceIds(self, name):
+        """
+        Get ids of devices matching a name, not case sensitive
+        Params: name, string containing device name
+        Result: list of device ids
+        """
+
+        return [row[0] for row in self.db.execute('SELECT id FROM devices WHERE name = ? COLLATE NOCASE', (name,))]
+
+
+    def getDeviceByGuid(self, guid):
+        """
+        Get id of device matching an agent guid
+        Params: guid, string containing agent guid
+        Result: device id, 0 if not found
+        """
+
+        row = self.db.execute('SELECT id FROM devices WHERE agentGuid = ?', (guid,)).fetchone()
+        return row[0] if row else 0
+
+
+    def getDevicesWithTag(self, tag):
+        """
+        Get ids of devices with a tag applied
+        Params: tag, string containing tag name
+        Result: list of device ids
+        """
+
+        return [row[0] for row in self.db.execute('SELECT device_id FROM device_tags WHERE tag = ?', (tag,))]
+
+
+    def deviceList(self):
+        """
+        Result: dict formatted as "device id":"device name", like Trellix.deviceList
+        """
+
+        return dict(self.db.execute('SELECT id, name FROM devices'))
+
+
+    def tagsApplied(self):
+        """
+        Result: dict formatted as "device id":"tags list", like Trellix.tagsApplied
+        """
+
+        return dict(self.db.execute('SELECT id, tags FROM devices'))
+
+
+    def deviceRows(self):
+        """
+        Result: yields (device id, device name, tags list) of each device, in id order, to build a Fleet without dicts
+        """
+
+        return self.db.execute('SELECT id, name, tags FROM devices ORDER BY id')
+
+
+    def properties(self, props):
+        """
+        Get stored properties of all devices
+        Params: props, list of properties, must be stored in inventory
+        Result: list of dict containing device id and properties, like Trellix.collectAllProperties
+        """
+
+        devices = []
+        for row in self.db.execute('SELECT id, name, agentGuid, lastUpdate, nodeCreatedDate, tags, properties FROM devices ORDER BY id'):
+            device = dict(zip(INVENTORY_PROPS, row[1:6]))
+            device.update(json.loads(row[6]))
+            properties = {'id': row[0]}
+            properties.update((prop, device.get(prop)) for prop in props if prop in device and prop != 'id')
+            devices.append(properties)
+        return devices
+
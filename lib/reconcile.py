@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Desired state tag reconciler, computing the minimal set of tag queries
+
+Copyright (C) 2023 Philippe Le Bescond
+
+Contact : philippe.le.bescond(at)trellix.com
+"""
+
+from lib.trellixAPI import logger, NameIndex
+
+
+def planReconcile(desired, device_list, device_tags, managed_tags = None, exclusive = False):
+    """
+    Compare desired tags with tags applied and compute tag queries to send
+    Only managed tags are applied or cleared, other tags on systems are left as is
+    Params:
+        desired: dict formatted as "device name": set of tags
+        device_list: dict formatted as "device id":"device name", like Trellix.deviceList
+        device_tags: dict formatted as "device id": set of tags, like Trellix.deviceTags()
+        managed_tags: optional set of tags to reconcile, default is all tags found in desired state
+        exclusive: Boolean, True to clear managed tags from systems not listed in desired state
+    Result:
+        plan: dict formatted as "tag": {"apply": [device ids], "clear": [device ids]}, without empty actions
+        not_found: list of device names not found
+    """
+
+    managed = set(managed_tags) if managed_tags else set().union(*desired.values())
+    index = NameIndex(device_list)
+
+    # Desired tags of each system, managed tags only
+    target = {}
+    not_found = []
+    for name, tags in desired.items():
+        ids = index.lookup(name)
+        if not ids:
+            not_found.append(name)
+            continue
+        if len(ids) > 1:
+            logger.warning('Device name {0} matches {1} devices: {2}'.format(name, len(ids), ids))
+        for device in ids:
+            target.setdefault(device, set()).update(tags & managed)
+
+    # Systems not listed lose all managed tags
+    if exclusive:
+        for device in device_list:
+            target.setdefault(device, set())
+
+    # Difference with tags applied, grouped by tag and action
+    plan = {}
+    for device, tags in target.items():
+        applied = device_tags.get(device, frozenset()) & managed
+        for tag in tags - applied:
+            plan.setdefault(tag, {}).setdefault('apply', []).append(device)
+        for tag in applied - tags:
+            plan.setdefault(tag, {}).setdefault('clear', []).append(device)
+
+    logger.info('Reconcile plan: {0} tag(s) on {1} system(s), {2} device name(s) not found'.format(
+        len(plan), len({device for actions in plan.values() for ids in actions.values() for device in ids}), len(not_found)))
+    return plan, not_found
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Adaptive polling scheduler, pacing event pulls with event rate, daily query budget and latency target
+
+Copyright (C) 2023 Philippe Le Bescond
+
+Contact : philippe.le.bescond(at)trellix.com
+"""
+
+import time
+
+from lib.trellixAPI import logger
+
+### Constants ###
+
+# Shortest interval between pulls, and longest one (latency target), in seconds
+DEFAULT_POLL_MIN_INTERVAL = 60
+DEFAULT_POLL_MAX_LATENCY = 600
+
+# Daily query budget of pulls, used when not set in profile and no quota reserve is set
+# Pulling every poll_min_interval seconds for a whole day needs 1440 queries, plus full pages of events
+DEFAULT_POLL_BUDGET = 1500
+
+# Interval change after a busy pull, and after an empty pull
+SPEED_UP = 0.5
+SLOW_DOWN = 1.5
+
+
+### Scheduler Class ###
+
+class PollScheduler:
+    """
+    Compute interval before next pull:
+    - halved when a pull returns at least a full page of events, down to poll_min_interval
+    - increased by half when a pull returns no event, up to poll_max_latency
+    - never shorter than needed to keep queries of the day within poll_budget
+    Each pull ends with a page that is not full, this query is the only one added by pulling more often:
+    full pages only depend on event rate. Budget left, once full pages already pulled are counted, is shared
+    between pulls of the rest of the day at one query each
+    """
+
+    def __init__(self, session, page_limit = None):
+        """
+        Params:
+            session: Trellix object, its quota ledger counts queries sent today and its profile holds settings
+            page_limit: optional int, number of events in a full page. Default is session events_page_limit at each pull,
+            as adaptive page sizing changes it
+        """
+
+        self.session = session
+        self.page_limit = page_limit
+        settings = session.profile
+        self.min_interval = settings.get('poll_min_interval', DEFAULT_POLL_MIN_INTERVAL)
+        self.max_latency = settings.get('poll_max_latency', DEFAULT_POLL_MAX_LATENCY)
+        self.budget = settings.get('poll_budget', settings.get('quota_reserves', {}).get(session.consumer, DEFAULT_POLL_BUDGET))
+
+        # Start at latency target, lowered as soon as events are flowing
+        self.interval = self.max_latency
+
+
+    def budgetInterval(self):
+        """
+        Shortest interval keeping queries of the day within budget, each pull costing its last page
+        Result: interval in seconds
+        """
+
+        seconds_left = 86400 - time.time() % 86400
+        budget_left = self.budget - self.session.quota.used()
+        if budget_left <= 0:
+            return seconds_left
+        return seconds_left / budget_left
+
+
+    def next(self, events, queries):
+        """
+        Compute interval before next pull
+        Params:
+            events: int, number of events returned by last pull
+            queries: int, number of queries sent by last pull
+        Result: interval in seconds
+        """
+
+        # Follow event rate, a full page is measured with page size currently used
+        if events >= (self.page_limit or self.session.events_page_limit):
+            self.interval = max(self.min_interval, self.interval * SPEED_UP)
+        elif events == 0:
+            self.interval = min(self.max_latency, self.interval * SLOW_DOWN)
+
+        # Daily budget comes first, even if latency target cannot be met
+        floor = self.budgetInterval()
+        interval = max(self.interval, floor)
+        if floor > self.max_latency:
+            logger.warning('Daily budget of {0} queries does not allow pulling every {1} seconds, next pull in {2} seconds'.format(
+                self.budget, self.max_latency, int(interval)))
+
+        logger.info('{0} event(s) pulled in {1} queries, next pull in {2} seconds'.format(events, queries, int(interval)))
+        return interval
+
+
+    def estimate(self):
+        """
+        Result: number of queries pulls will send until end of UTC day, within budget
+        """
+
+        return max(0, self.budget - self.session.quota.used())
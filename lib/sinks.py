@@ -0,0 +1,585 @@
+#!/usr/bin/env python3
+"""
+Event delivery pipeline: batched writes to file and syslog sinks, each one in its own worker thread
+
+Copyright (C) 2023 Philippe Le Bescond
+
+Contact : philippe.le.bescond(at)trellix.com
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import queue
+import re
+import socket
+import ssl
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from lib.trellixAPI import profile, logger
+
+# Faster JSON encoder and zstd compression are used when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+### Constants ###
+
+# Number of batches waiting in each sink queue before pulling is paused
+DEFAULT_SINK_QUEUE_SIZE = 8
+
+# Delay before retrying a failed batch, doubled at each failure up to maximum, in seconds
+SINK_RETRY_DELAY = 1
+SINK_RETRY_MAX = 60
+
+# File rotation: segment size in bytes and age in seconds (0 to disable), and compression of rotated segments
+DEFAULT_FILE_MAX_BYTES = 100 * 1024 * 1024
+DEFAULT_FILE_MAX_AGE = 86400
+DEFAULT_FILE_COMPRESSION = 'gzip'
+
+# Rotated segment file suffix by compression, and compression levels
+COMPRESSION_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst', 'none': ''}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Block size used to compress segments
+COPY_BLOCK_SIZE = 1024 * 1024
+
+# Syslog message fields: facility user, severity informational
+SYSLOG_PRI = 14
+SYSLOG_APP_NAME = 'TrellixThreatEvents'
+SYSLOG_MSG_ID = 'threatEvent'
+
+# Largest UDP datagram sent, longer messages are truncated
+SYSLOG_UDP_MAX = 65000
+
+# UDP messages sent per second, used when not set in profile: faster bursts overflow server receive buffer and are lost
+DEFAULT_SYSLOG_UDP_RATE = 5000
+
+
+def formatEvent(event):
+    # Same format as previous logging based output: raw event pulled from ePO
+    return str(event)
+
+
+def encodeEvent(event):
+    """
+    Encode an event as a JSON line
+    Params: event, dict
+    Result: bytes, ending with a new line
+    """
+
+    if orjson:
+        return orjson.dumps(event, option = orjson.OPT_APPEND_NEWLINE)
+    return json.dumps(event, ensure_ascii = False, separators = (',', ':')).encode('utf-8') + b'\n'
+
+
+### Sinks ###
+
+class SinkError(Exception):
+    """
+    Raised by a sink which stopped on an unexpected error, events can not be delivered anymore
+    """
+
+
+class Sink:
+    """
+    Event sink with a bounded queue of batches and a worker thread writing them
+    A batch failing is retried until it is written, so events are never dropped; while a sink is
+    failing its queue fills up and submit blocks, which pauses pulling
+    Any other error stops the sink: submit and wait raise SinkError, so cursors are not committed
+    Subclasses implement write(batch) and optionally close()
+    """
+
+    name = 'sink'
+
+    def __init__(self, queue_size = None):
+        self.queue = queue.Queue(maxsize = queue_size or profile.get('sink_queue_size', DEFAULT_SINK_QUEUE_SIZE))
+        self.delivered = 0
+        self.events = 0
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target = self.__worker, name = self.name, daemon = True)
+        self.thread.start()
+
+
+    def submit(self, batch):
+        """
+        Queue a batch of events, waiting while queue is full
+        Params: batch, list of events
+        """
+
+        if self.queue.full():
+            logger.info('{0} sink is slow, pausing until a batch is written'.format(self.name))
+
+        # Queue is not consumed anymore once sink has stopped on an error
+        while True:
+            self.__check()
+            try:
+                self.queue.put(batch, timeout = 1)
+                return
+            except queue.Full:
+                pass
+
+
+    def __check(self):
+        # Raise error which stopped worker thread
+        if self.error is not None:
+            raise SinkError('{0} sink stopped: {1}'.format(self.name, repr(self.error))) from self.error
+
+
+    def __worker(self):
+        # Write batches in order, retrying each one until it is written
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                self.close()
+                return
+
+            delay = SINK_RETRY_DELAY
+            while True:
+                try:
+                    self.write(batch)
+                    break
+                except (OSError, ssl.SSLError) as e:
+                    logger.error('{0} sink failed to write {1} events: {2}. Retrying in {3} seconds'.format(self.name, len(batch), e, delay))
+                    self.reset()
+                    time.sleep(delay)
+                    delay = min(delay * 2, SINK_RETRY_MAX)
+                except Exception as e:
+                    # Not a transient error, writing again would fail the same way
+                    logger.error('{0} sink stopped, failed to write {1} events: {2}'.format(self.name, len(batch), repr(e)))
+                    with self.condition:
+                        self.error = e
+                        self.condition.notify_all()
+                    try:
+                        self.close()
+                    except Exception:
+                        pass
+                    return
+
+            with self.condition:
+                self.delivered += 1
+                self.events += len(batch)
+                self.condition.notify_all()
+
+
+    def wait(self, count):
+        """
+        Wait until count batches have been written
+        Raises SinkError if sink stopped on an error
+        """
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.delivered >= count or self.error is not None)
+        if self.delivered < count:
+            self.__check()
+
+
+    def stop(self):
+        """
+        Write queued batches, then stop worker thread
+        """
+
+        if self.error is None:
+            self.queue.put(None)
+        self.thread.join()
+
+
+    def write(self, batch):
+        raise NotImplementedError
+
+    def reset(self):
+        # Called after a failed write, to reopen connection or file
+        pass
+
+    def close(self):
+        pass
+
+
+class FileSink(Sink):
+    """
+    Append events to a file, one per line, as JSON (ndjson format) or as raw Python data (raw format)
+    Each batch is written at once, then flushed to disk
+    The file is rotated when it reaches file_max_bytes or file_max_age: it is renamed to a segment
+    named after rotation time, compressed in a background thread, and listed in a manifest file
+    """
+
+    def __init__(self, path, format = 'ndjson', max_bytes = None, max_age = None, compression = None, queue_size = None):
+        """
+        Params:
+            path: string containing active file path
+            format: 'ndjson' (default) or 'raw'
+            max_bytes: optional int, segment size triggering rotation. Default is file_max_bytes setting, 0 to disable
+            max_age: optional int, segment age in seconds triggering rotation. Default is file_max_age setting, 0 to disable
+            compression: optional 'gzip', 'zstd' or 'none'. Default is file_compression setting
+        """
+
+        self.path = path
+        self.name = 'file ' + path
+        self.format = format
+        self.file = None
+        self.size = 0
+        self.started = 0
+        self.max_bytes = profile.get('file_max_bytes', DEFAULT_FILE_MAX_BYTES) if max_bytes is None else max_bytes
+        self.max_age = profile.get('file_max_age', DEFAULT_FILE_MAX_AGE) if max_age is None else max_age
+        self.compression = compression or profile.get('file_compression', DEFAULT_FILE_COMPRESSION)
+        if self.compression == 'zstd' and zstandard is None:
+            logger.warning('zstandard module is not installed, rotated segments are compressed with gzip')
+            self.compression = 'gzip'
+
+        # Rotated segments: <name>.<rotation time><extension>, listed in <path>.manifest once compressed
+        folder, filename = os.path.split(os.path.abspath(path))
+        root, self.extension = os.path.splitext(filename)
+        self.folder = folder
+        self.root = root
+        self.segment_name = re.compile(re.escape(root) + r'\.\d{20}Z' + re.escape(self.extension) + '$')
+        self.manifest = os.path.abspath(path) + '.manifest'
+
+        # Segments are compressed by their own thread, so writes are never held by compression
+        self.segments = queue.Queue()
+        self.compressor = threading.Thread(target = self.__compressor, name = self.name + ' compressor', daemon = True)
+        self.compressor.start()
+        self.__recover()
+        super().__init__(queue_size)
+
+
+    ### Writing ###
+
+    def __open(self):
+        # Open active file, a file left by a previous run is kept and its age starts from its last write
+        self.file = open(self.path, 'ab')
+        self.size = self.file.tell()
+        self.started = os.path.getmtime(self.path) if self.size else time.time()
+
+
+    def encode(self, event):
+        # One line per event
+        if self.format == 'raw':
+            return (formatEvent(event) + '\n').encode('utf-8')
+        return encodeEvent(event)
+
+
+    def write(self, batch):
+        if self.file is None:
+            self.__open()
+
+        # Segment old enough is rotated before writing, even if batch is empty
+        if self.max_age and self.size and time.time() - self.started >= self.max_age:
+            self.__rotate()
+            self.__open()
+
+        data = b''.join(self.encode(event) for event in batch)
+        if not data:
+            return
+        if not self.size:
+            self.started = time.time()
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.size += len(data)
+
+        # Segment large enough is rotated after writing, so a batch is never split between segments
+        if self.max_bytes and self.size >= self.max_bytes:
+            self.__rotate()
+
+
+    def __rotate(self):
+        # Rename active file to a new segment and queue it for compression
+        self.reset()
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S%f')
+        segment = os.path.join(self.folder, '{0}.{1}Z{2}'.format(self.root, stamp, self.extension))
+        os.replace(self.path, segment)
+        logger.info('{0} rotated to {1}'.format(self.name, segment))
+        self.segments.put(segment)
+
+
+    def reset(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
+
+
+    def close(self):
+        # Close active file, then wait until rotated segments are compressed
+        self.reset()
+        self.segments.put(None)
+        self.compressor.join()
+
+
+    ### Compression ###
+
+    def __listed(self):
+        # Segments already listed in manifest
+        try:
+            with open(self.manifest, 'r', encoding = 'utf-8') as manifest:
+                return {json.loads(line).get('segment') for line in manifest if line.strip()}
+        except (OSError, ValueError):
+            return set()
+
+
+    def __recover(self):
+        # Segments left uncompressed by a previous run (stopped during compression) are compressed again
+        listed = self.__listed()
+        for filename in sorted(os.listdir(self.folder)):
+            if self.segment_name.match(filename) and filename not in listed:
+                self.segments.put(os.path.join(self.folder, filename))
+
+
+    def __compressor(self):
+        # Compress segments in rotation order, then list them in manifest
+        while True:
+            segment = self.segments.get()
+            if segment is None:
+                return
+            try:
+                self.__compress(segment)
+            except OSError as e:
+                logger.error('Failed to compress {0}: {1}. It will be compressed again at next start'.format(segment, e))
+
+
+    def __compress(self, segment):
+        # Write compressed copy under a temporary name, rename it, add it to manifest, then remove segment
+        target = segment + COMPRESSION_SUFFIXES[self.compression]
+        events = 0
+        first_line = last_line = b''
+
+        if self.compression == 'none':
+            with open(segment, 'rb') as source:
+                for line in source:
+                    events += 1
+                    first_line = first_line or line
+                    last_line = line
+        else:
+            temp = target + '.tmp'
+            with open(segment, 'rb') as source, open(temp, 'wb') as output:
+                if self.compression == 'zstd':
+                    writer = zstandard.ZstdCompressor(level = ZSTD_LEVEL).stream_writer(output, closefd = False)
+                else:
+                    writer = gzip.GzipFile(filename = os.path.basename(segment), mode = 'wb', fileobj = output, compresslevel = GZIP_LEVEL)
+                with writer:
+                    tail = b''
+                    while True:
+                        block = source.read(COPY_BLOCK_SIZE)
+                        if not block:
+                            break
+                        writer.write(block)
+                        events += block.count(b'\n')
+                        if not first_line:
+                            first_line = (tail + block).split(b'\n', 1)[0]
+                        tail = (tail + block)[-COPY_BLOCK_SIZE:]
+                    last_line = tail.rstrip(b'\n').rsplit(b'\n', 1)[-1]
+                output.flush()
+                os.fsync(output.fileno())
+            os.replace(temp, target)
+
+        # Checksum of file to ingest
+        checksum = hashlib.sha256()
+        with open(target, 'rb') as compressed:
+            for block in iter(lambda: compressed.read(COPY_BLOCK_SIZE), b''):
+                checksum.update(block)
+
+        entry = {'segment': os.path.basename(target), 'format': self.format, 'compression': self.compression,
+                 'events': events, 'bytes': os.path.getsize(segment), 'size': os.path.getsize(target),
+                 'sha256': checksum.hexdigest(), 'first_timestamp': self.__timestamp(first_line),
+                 'last_timestamp': self.__timestamp(last_line), 'rotated_at': datetime.now(timezone.utc).isoformat()}
+        self.__addToManifest(entry)
+        if target != segment:
+            os.remove(segment)
+        logger.info('{0} compressed: {1} events, {2} bytes'.format(target, events, entry['size']))
+
+
+    def __timestamp(self, line):
+        # Event timestamp of a ndjson line, None for raw format
+        if self.format != 'ndjson' or not line:
+            return None
+        try:
+            return json.loads(line).get('timestamp')
+        except ValueError:
+            return None
+
+
+    def __addToManifest(self, entry):
+        # Append segment to manifest, once: a segment compressed again after a crash may already be listed
+        if entry['segment'] in self.__listed():
+            return
+        with open(self.manifest, 'a', encoding = 'utf-8') as manifest:
+            manifest.write(json.dumps(entry) + '\n')
+            manifest.flush()
+            os.fsync(manifest.fileno())
+
+
+class SyslogSink(Sink):
+    """
+    Send events to a syslog server as RFC 5424 messages
+    - udp: one datagram per event, paced to syslog_udp_rate messages per second, without delivery guarantee (RFC 5426)
+    - tcp and tls: persistent connection, octet counting framing (RFC 6587), reconnected after a failure
+    Each batch is sent in a single write. Message id is threatEvent, or tenant name when set by the collector
+    Message is the event as JSON (ndjson format), or as raw Python data (raw format)
+    """
+
+    def __init__(self, host, port, protocol = 'tcp', ca_file = None, queue_size = None, msg_id = SYSLOG_MSG_ID, format = 'ndjson'):
+        self.host = host
+        self.format = format
+        self.msg_id = msg_id
+        self.port = port
+        self.protocol = protocol
+        self.name = 'syslog {0}://{1}:{2}'.format(protocol, host, port)
+        self.hostname = socket.gethostname() or '-'
+        self.socket = None
+
+        # TLS context, server certificate is verified with system CAs or given CA file
+        self.context = ssl.create_default_context(cafile = ca_file) if protocol == 'tls' else None
+
+        # UDP has no backpressure, messages are paced instead
+        self.udp_rate = profile.get('syslog_udp_rate', DEFAULT_SYSLOG_UDP_RATE)
+        if protocol == 'udp':
+            logger.warning('{0}: udp gives no delivery guarantee, events can be lost. Use tcp or tls to deliver all events'.format(self.name))
+        super().__init__(queue_size)
+
+
+    def message(self, event):
+        """
+        Format an event as RFC 5424 syslog message
+        Params: event, dict
+        Result: bytes
+        """
+
+        timestamp = datetime.now(timezone.utc).isoformat(timespec = 'milliseconds').replace('+00:00', 'Z')
+        header = '<{0}>1 {1} {2} {3} {4} {5} - '.format(SYSLOG_PRI, timestamp, self.hostname, SYSLOG_APP_NAME, os.getpid(), self.msg_id)
+        if self.format == 'raw':
+            return header.encode() + formatEvent(event).encode('utf-8')
+        return header.encode() + encodeEvent(event).rstrip(b'\n')
+
+
+    def __connect(self):
+        # Open persistent connection
+        if self.protocol == 'udp':
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.connect((self.host, self.port))
+            return
+
+        connection = socket.create_connection((self.host, self.port), timeout = SINK_RETRY_MAX)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.context:
+            connection = self.context.wrap_socket(connection, server_hostname = self.host)
+        self.socket = connection
+        logger.info('{0} sink connected'.format(self.name))
+
+
+    def write(self, batch):
+        if self.socket is None:
+            self.__connect()
+
+        if self.protocol == 'udp':
+            start = time.monotonic()
+            for count, event in enumerate(batch):
+                # Wait until message is due, at most udp_rate messages per second
+                if self.udp_rate:
+                    ahead = start + count / self.udp_rate - time.monotonic()
+                    if ahead > 0:
+                        time.sleep(ahead)
+                self.socket.send(self.message(event)[:SYSLOG_UDP_MAX])
+            return
+
+        # Octet counting: each message is preceded by its length and a space
+        frames = []
+        for event in batch:
+            message = self.message(event)
+            frames.append(str(len(message)).encode() + b' ' + message)
+        self.socket.sendall(b''.join(frames))
+
+    def reset(self):
+        self.close()
+
+    def close(self):
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            except OSError:
+                pass
+            self.socket = None
+
+
+### Pipeline ###
+
+class Pipeline:
+    """
+    Deliver batches of events to all sinks in parallel
+    Each batch comes with a cursor, which is committed once the batch and all previous ones
+    have been written by all sinks, so delivery is at least once
+    """
+
+    def __init__(self, sinks, commit = None):
+        """
+        Params:
+            sinks: list of Sink objects
+            commit: optional function called with cursor of last batch written by all sinks
+        """
+
+        self.sinks = sinks
+        self.commit = commit
+        self.submitted = 0
+        self.pending = deque()
+
+
+    def deliver(self, batch, cursor = None):
+        """
+        Queue a batch to all sinks, waiting while a sink queue is full, and commit cursors already delivered
+        Params:
+            batch: list of events
+            cursor: optional cursor after last event of the batch
+        """
+
+        for sink in self.sinks:
+            sink.submit(batch)
+        self.submitted += 1
+        self.pending.append((self.submitted, cursor))
+        self.__commitDelivered()
+
+
+    def drain(self):
+        """
+        Wait until all batches have been written by all sinks, and commit last cursor
+        Raises SinkError if a sink stopped on an error, after committing cursor of batches written by all sinks
+        """
+
+        try:
+            for sink in self.sinks:
+                sink.wait(self.submitted)
+        finally:
+            self.__commitDelivered()
+
+
+    def __commitDelivered(self):
+        # Commit cursor of last batch written by all sinks
+        delivered = min(sink.delivered for sink in self.sinks)
+        cursor = None
+        while self.pending and self.pending[0][0] <= delivered:
+            cursor = self.pending.popleft()[1]
+        if cursor is not None and self.commit:
+            self.commit(cursor)
+
+
+    def close(self):
+        """
+        Write queued batches, commit last cursor and stop sinks
+        """
+
+        try:
+            self.drain()
+        finally:
+            for sink in self.sinks:
+                sink.stop()
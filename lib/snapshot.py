@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Device properties snapshot: last properties delivered for each device, to collect and emit only changes
+
+Copyright (C) 2023 Philippe Le Bescond
+
+Contact : philippe.le.bescond(at)trellix.com
+"""
+
+import os
+import time
+
+from lib.trellixAPI import profile, profile_path, logger, LockedFile, AVAILABLE_PROPS, tenantKey
+
+### Constants ###
+
+# Snapshot file name, written next to profile file when not set in profile
+PROPERTIES_SNAPSHOT = '.properties_snapshot'
+
+# Properties always gathered, used as watermark of incremental collections
+WATERMARK_PROPS = ['lastUpdate', 'nodeCreatedDate']
+
+# Default interval between full collections, which detect removed devices, in seconds
+DEFAULT_SNAPSHOT_FULL_SYNC = 86400
+
+# Snapshot file format version, a snapshot with another version is discarded
+SNAPSHOT_VERSION = 1
+
+
+### Snapshot Class ###
+
+class Snapshot:
+    """
+    Properties of all devices as delivered by the last successful collection, with the most recent
+    lastUpdate or nodeCreatedDate seen
+    - an incremental collection only gathers devices with lastUpdate or nodeCreatedDate newer than this watermark,
+      filtered by the API
+    - a full collection gathers all devices, it is the only way to detect removed devices
+    """
+
+    def __init__(self, props, path = None, settings = None):
+        """
+        Open snapshot, a new one is started if tenant or properties changed
+        Params:
+            props: list of properties to collect, 'all' for all available properties
+            path: optional string, snapshot file path. Default is properties_snapshot setting or .properties_snapshot next to profile file
+            settings: optional dict of profile settings of the tenant. Default is profile file
+        """
+
+        settings = settings or profile
+        self.props = [prop for prop in AVAILABLE_PROPS if prop != 'id' and ('all' in props or prop in props)]
+        self.full_sync_interval = settings.get('snapshot_full_sync', DEFAULT_SNAPSHOT_FULL_SYNC)
+        self.tenant = tenantKey(settings)
+
+        path = path or settings.get('properties_snapshot', os.path.join(os.path.dirname(profile_path), PROPERTIES_SNAPSHOT))
+        self.state = LockedFile(path, durable = True)
+
+        # Devices by id, as strings since snapshot is stored in JSON
+        self.devices = {}
+        self.watermark = None
+        self.last_full_sync = 0
+        self.load()
+
+
+    ### Persistence ###
+
+    def load(self):
+        """
+        Load snapshot saved by the last successful collection, if tenant and properties have not changed
+        """
+
+        with self.state:
+            data = self.state.load()
+        if not data:
+            return
+
+        if data.get('version') != SNAPSHOT_VERSION or data.get('tenant') != self.tenant or data.get('props') != self.props:
+            logger.warning('Properties snapshot {0} does not match tenant or properties, starting a new one'.format(self.state.path))
+            return
+
+        self.devices = data.get('devices', {})
+        self.watermark = data.get('watermark')
+        self.last_full_sync = data.get('last_full_sync', 0)
+        logger.info('Properties snapshot loaded: {0} devices, watermark {1}'.format(len(self.devices), self.watermark))
+
+
+    def save(self):
+        """
+        Write snapshot
+        Call it once changes have been written: a snapshot saved with changes not written would lose them after a crash
+        Result: Boolean, True if snapshot has been written
+        """
+
+        data = {'version': SNAPSHOT_VERSION, 'tenant': self.tenant, 'props': self.props, 'watermark': self.watermark,
+                'last_full_sync': self.last_full_sync, 'saved_at': time.time(), 'devices': self.devices}
+        with self.state:
+            return self.state.dump(data)
+
+
+    ### Collection ###
+
+    def isFullSyncDue(self):
+        """
+        Result: Boolean, True if snapshot is empty or last full collection is older than snapshot_full_sync setting
+        """
+
+        return not self.watermark or time.time() - self.last_full_sync >= self.full_sync_interval
+
+
+    def __record(self, change, device_id, properties):
+        # Change record: change type, device id then collected properties
+        record = {'change': change, 'id': int(device_id)}
+        record.update(properties)
+        return record
+
+
+    def delta(self, session, full = False):
+        """
+        Collect devices changed since the last collection and update snapshot
+        Snapshot is only updated in memory, call save once changes are written
+        Params:
+            session: Trellix object
+            full: Boolean to force a full collection
+        Result: yields dict of each added, changed or removed device: change ('added', 'changed' or 'removed'),
+                device id and properties. Removed devices carry their last known properties
+        """
+
+        full = full or self.isFullSyncDue()
+
+        if full:
+            logger.warning('Starting full properties collection, {0} device(s) in snapshot...'.format(len(self.devices)))
+            device_filter = None
+        else:
+            logger.warning('Starting incremental properties collection from {0}...'.format(self.watermark))
+            device_filter = {'OR': [{'GE': {'lastUpdate': self.watermark}}, {'GE': {'nodeCreatedDate': self.watermark}}]}
+
+        sync_start = time.time()
+        watermark = self.watermark
+        seen = set()
+        counts = {'added': 0, 'changed': 0, 'removed': 0}
+
+        for device in session.iterDevices(self.props + WATERMARK_PROPS, device_filter):
+            device_id = str(device['id'])
+            seen.add(device_id)
+
+            # Next incremental collection starts from most recent server timestamp seen
+            for key in WATERMARK_PROPS:
+                if device.get(key) and (watermark is None or device[key] > watermark):
+                    watermark = device[key]
+
+            # Devices returned again with the same properties are not changes
+            properties = {prop: device[prop] for prop in self.props if prop in device}
+            previous = self.devices.get(device_id)
+            if previous == properties:
+                continue
+
+            change = 'added' if previous is None else 'changed'
+            self.devices[device_id] = properties
+            counts[change] += 1
+            yield self.__record(change, device_id, properties)
+
+        # Devices not listed by a full collection have been removed
+        if full:
+            for device_id in [device_id for device_id in self.devices if device_id not in seen]:
+                counts['removed'] += 1
+                yield self.__record('removed', device_id, self.devices.pop(device_id))
+            self.last_full_sync = sync_start
+
+        self.watermark = watermark
+        logger.warning('Properties collection done: {0} added, {1} changed, {2} removed, {3} device(s) in snapshot'.format(
+            counts['added'], counts['changed'], counts['removed'], len(self.devices)))
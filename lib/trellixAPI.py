@@ -8,17 +8,103 @@ Contact : philippe.le.bescond(at)trellix.com
 """
 
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import os
 import sys
 import logging
 import time
+import hashlib
+import tempfile
+import threading
+import queue
+import re
+import random
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote, urlsplit
+
+# File locking is platform specific
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 ### Constants ###
 
 # Profile file path
 PROFILE = '../profile'
 
+# Default transport settings, used when not set in profile file
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 120
+
+# Token cache file name, written next to profile file when not set in profile
+TOKEN_CACHE = '.token_cache'
+
+# Maximum length of a query URL, used to size device name filters
+DEFAULT_MAX_URL_LENGTH = 4096
+
+# Page sizes tried first by adaptive page sizing, and smallest page size it can back off to
+MAX_PAGE_LIMITS = {'devices': 1000, 'events': 1000, 'tags': 1000}
+MIN_PAGE_LIMIT = 10
+
+# Adaptive page sizing is used when not set in profile file
+DEFAULT_ADAPTIVE_PAGE_SIZE = True
+
+# Page sizes learned by adaptive page sizing, and page sizes that failed, are kept in this file, next to profile file, for one day
+PAGE_LIMITS = '.page_limits'
+PAGE_LIMITS_LIFETIME = 86400
+
+# Status codes lowering page size once retries are exhausted: 500 and read timeouts mean the page is too large
+# and the failed size is kept as a ceiling for next sessions, 504 may come from an overloaded gateway so it is only used for
+# current session. 400 and 422 are not retried, and mean the API rejects page size when it is larger than MIN_PAGE_LIMIT
+PAGE_TOO_LARGE_STATUS = (500,)
+PAGE_SLOW_STATUS = (504,)
+PAGE_REJECTED_STATUS = (400, 422)
+
+# Successful pages in a row before a lowered page size is doubled again
+PAGE_LIMIT_GROWTH = 10
+
+# Page size parameter in queries, encoded or not
+PAGE_LIMIT_PARAM = re.compile(r'(page(?:%5B|\[)limit(?:%5D|\])=)(\d+)')
+
+# Session attribute holding page size of each endpoint
+PAGE_LIMIT_ATTRIBUTES = {'devices': 'device_page_limit', 'events': 'events_page_limit', 'tags': 'tags_page_limit'}
+
+# Threat events cursor file name, written next to profile file when not set in profile
+EVENTS_STATE = '.events_state'
+
+# Quota ledger file name, written next to profile file when not set in profile
+QUOTA_LEDGER = '.quota_ledger'
+
+# Number of API queries allowed per day and per license
+DEFAULT_DAILY_QUOTA = 2500
+
+# Token lifetime in seconds if not returned by IAM, and refresh margin before expiry
+DEFAULT_TOKEN_LIFETIME = 600
+DEFAULT_TOKEN_MARGIN = 60
+
+# Retry policy: number of retries, exponential backoff base and maximum delay in seconds
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF_BASE = 2
+DEFAULT_BACKOFF_MAX = 60
+
+# Longest Retry-After delay honoured, in seconds
+MAX_RETRY_AFTER = 600
+
+# Status codes retried for any query, as the API did not process it, and for idempotent queries only
+RETRY_ALWAYS = (429, 503)
+RETRY_IDEMPOTENT = (500, 502, 504)
+
+# Status codes meaning the service is down, counted by circuit breaker
+BREAKER_STATUS = (502, 503, 504)
+
+# Circuit breaker: consecutive failures opening it, and seconds before a trial query
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_COOLDOWN = 60
+
 # List of all available props used in collect properties functions
 AVAILABLE_PROPS = ['id', 'name', 'parentId', 'epoGroup', 'agentGuid', 'lastUpdate', 'agentState', 'nodePath', 'agentPlatform',
                     'agentVersion','nodeCreatedDate', 'managed', 'tenantId', 'tags', 'excludedTags', 'managedState', 'computerName',
@@ -31,10 +117,12 @@ try:
     try:
         with open(PROFILE, 'r') as profile_file:
             profile = json.load(profile_file)
+        profile_path = PROFILE
 
     except:
         with open('profile', 'r') as profile_file:
             profile = json.load(profile_file)
+        profile_path = 'profile'
 except:
     print('Profile file not found. Exiting...')
 
@@ -63,6 +151,510 @@ file_handler.setFormatter(formatter)
 logger.addHandler(file_handler)
 
 
+### Helpers ###
+
+def tenantKey(settings):
+    """
+    Key identifying a tenant in state files shared by scripts: quota ledger, cursors, page sizes, dedup store,
+    inventory and snapshot. Tenants sharing an API key but with other credentials or API url have their own key
+    Params: settings, dict of profile settings of the tenant
+    Result: string, 16 hexadecimal characters
+    """
+
+    key = '|'.join([settings['api_headers']['x-api-key'], settings['id'], settings['api_url']])
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def splitTags(tags):
+    """
+    Split tags list returned by the API
+    Params: tags, string containing tags separated by commas
+    Result: list of tags
+    """
+
+    return [tag.strip() for tag in (tags or '').split(',') if tag.strip()]
+
+
+class NameIndex:
+    """
+    Inverted index of device names, built once from a device list
+    Lookup is not case sensitive, and a short name matches a FQDN and the other way round:
+    host matches host.corp.local, host.corp.local matches host, but not host.other.local
+    Only short names are indexed, full names are read from the device list, so a Fleet keeps them in its name buffer
+    """
+
+    def __init__(self, device_list):
+        """
+        Params: device_list, dict formatted as "device id":"device name", like Trellix.deviceList, or Fleet object
+        """
+
+        self.device_list = device_list
+
+        # Device id by short name, list of device ids if several devices have the same short name
+        self.short = {}
+        for device, name in device_list.items():
+            short = (name or '').casefold().split('.')[0]
+            ids = self.short.get(short)
+            if ids is None:
+                self.short[short] = device
+            elif isinstance(ids, list):
+                ids.append(device)
+            else:
+                self.short[short] = [ids, device]
+
+
+    def __ids(self, short):
+        # Devices with a short name
+        ids = self.short.get(short, [])
+        return list(ids) if isinstance(ids, list) else [ids]
+
+
+    def lookup(self, name):
+        """
+        Get ids of devices matching a name
+        Params: name, string containing device name, short name or FQDN
+        Result: list of device ids, several ids if duplicate entries
+        """
+
+        name = name.strip().casefold()
+        short = name.split('.')[0]
+
+        # Short name matches all devices with this short name, with or without domain
+        if short == name:
+            return self.__ids(short)
+
+        # FQDN matches the same FQDN, and devices registered without domain
+        names = {device: (self.device_list.get(device) or '').casefold() for device in self.__ids(short)}
+        return [device for device in names if names[device] == name] + [device for device in names if names[device] == short]
+
+
+### Circuit breaker ###
+
+class CircuitBreaker:
+    """
+    Per tenant and host circuit breaker, shared by all sessions of a tenant in a script, so failures
+    of a tenant do not hold queries of other tenants to the same host
+    After threshold consecutive failures, queries to the host are held for cooldown seconds,
+    then a single trial query is sent: it closes the breaker if it succeeds, or opens it again
+    """
+
+    # Breakers by tenant and host
+    breakers = {}
+    breakers_lock = threading.Lock()
+
+    def __init__(self, host, threshold, cooldown):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = 0
+        self.trial = False
+        self.lock = threading.Lock()
+
+
+    @classmethod
+    def forHost(cls, tenant, host, threshold = DEFAULT_BREAKER_THRESHOLD, cooldown = DEFAULT_BREAKER_COOLDOWN):
+        """
+        Get breaker of a tenant and host, created on first use
+        Params:
+            tenant: string identifying the tenant
+            host: string containing host name
+            threshold: consecutive failures opening breaker, 0 to disable it
+            cooldown: seconds before a trial query
+        Result: CircuitBreaker object
+        """
+
+        with cls.breakers_lock:
+            if (tenant, host) not in cls.breakers:
+                cls.breakers[(tenant, host)] = cls(host, threshold, cooldown)
+            return cls.breakers[(tenant, host)]
+
+
+    def wait(self):
+        """
+        Block while breaker is open, until query can be sent
+        """
+
+        while True:
+            with self.lock:
+                # Closed breaker
+                if not self.threshold or self.failures < self.threshold:
+                    return
+                # Open breaker, a single trial query is allowed after cooldown
+                remaining = self.opened_at + self.cooldown - time.time()
+                if remaining <= 0 and not self.trial:
+                    self.trial = True
+                    logger.info('{0} circuit breaker half open, sending trial query'.format(self.host))
+                    return
+            time.sleep(max(min(remaining, 1), 0.1))
+
+
+    def success(self):
+        with self.lock:
+            if self.threshold and self.failures >= self.threshold:
+                logger.warning('{0} circuit breaker closed, service is back'.format(self.host))
+            self.failures = 0
+            self.trial = False
+
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.threshold and self.failures >= self.threshold:
+                # Opening, or opening again after a failed trial query
+                if self.failures == self.threshold:
+                    logger.error('{0} circuit breaker open after {1} failures, holding queries for {2} seconds'.format(
+                        self.host, self.failures, self.cooldown))
+                self.opened_at = time.time()
+
+
+### Rate limiter ###
+
+class RateLimiter:
+    """
+    Per tenant token bucket, shared by all sessions and worker threads of a script
+    Queries are sent at most at rate per second on average, with bursts up to burst queries
+    """
+
+    # Limiters by tenant
+    limiters = {}
+    limiters_lock = threading.Lock()
+
+    def __init__(self, rate, burst = None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    @classmethod
+    def forTenant(cls, tenant, rate, burst = None):
+        """
+        Get rate limiter of a tenant, created on first use
+        Params:
+            tenant: string identifying the tenant
+            rate: queries per second, 0 to disable limit
+            burst: optional int, queries sent at once after an idle period. Default is rate
+        Result: RateLimiter object
+        """
+
+        with cls.limiters_lock:
+            if tenant not in cls.limiters:
+                cls.limiters[tenant] = cls(rate, burst)
+            return cls.limiters[tenant]
+
+
+    def acquire(self):
+        """
+        Block until a query can be sent
+        """
+
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+### Shared state files ###
+
+class LockedFile:
+    """
+    JSON state file stored on disk and shared by all scripts using the same profile
+    Use it as a context manager to hold an exclusive lock while reading and writing
+    """
+
+    def __init__(self, path, durable = False):
+        """
+        Params:
+            path: string containing state file path
+            durable: Boolean, True to flush state file to disk before replacing previous one
+        """
+
+        self.path = path
+        self.durable = durable
+        self.lock_path = path + '.lock'
+        self.lock_file = None
+        self.thread_lock = threading.Lock()
+
+    def __enter__(self):
+        # Acquire exclusive lock, waiting for other threads and scripts to release it
+        self.thread_lock.acquire()
+        self.lock_file = open(self.lock_path, 'a+')
+        if fcntl:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            self.lock_file.seek(0)
+            msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Release lock
+        if fcntl:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+        else:
+            self.lock_file.seek(0)
+            msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.lock_file.close()
+        self.lock_file = None
+        self.thread_lock.release()
+
+    def load(self):
+        """
+        Read state file
+        Result: dict, empty if file is missing or corrupted
+        """
+
+        try:
+            return json.loads(self.loadBytes() or b'{}')
+        except ValueError:
+            return {}
+
+    def dump(self, data):
+        """
+        Write state file atomically: write a temporary file then replace state file
+        Params: data, dict to write
+        Result: Boolean, True if state file has been written
+        """
+
+        return self.dumpBytes(json.dumps(data).encode())
+
+    def loadBytes(self):
+        """
+        Read raw content of state file
+        Result: bytes, None if file is missing or unreadable
+        """
+
+        try:
+            with open(self.path, 'rb') as state_file:
+                return state_file.read()
+        except OSError:
+            return None
+
+    def dumpBytes(self, content):
+        """
+        Write raw content to state file atomically: write a temporary file then replace state file
+        Params: content, bytes to write
+        Result: Boolean, True if state file has been written
+        """
+
+        temp_path = None
+        try:
+            folder = os.path.dirname(os.path.abspath(self.path))
+            fd, temp_path = tempfile.mkstemp(dir=folder, prefix=os.path.basename(self.path) + '.')
+            with os.fdopen(fd, 'wb') as state_file:
+                state_file.write(content)
+                if self.durable:
+                    state_file.flush()
+                    os.fsync(state_file.fileno())
+            os.replace(temp_path, self.path)
+            temp_path = None
+
+            # Rename itself must reach the disk, folders can only be synced on POSIX systems
+            if self.durable and fcntl:
+                folder_fd = os.open(folder, os.O_RDONLY)
+                try:
+                    os.fsync(folder_fd)
+                finally:
+                    os.close(folder_fd)
+            return True
+        except OSError as e:
+            logger.warning('Impossible to write {0}: {1}'.format(self.path, e))
+            if temp_path:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+            return False
+
+
+class TokenCache(LockedFile):
+    """
+    Token cache shared by all scripts using the same profile
+    """
+
+    def read(self, key):
+        """
+        Read a token from cache
+        Params: key, string identifying the API client
+        Result: dict with 'token' and 'expires_at' keys, None if not cached
+        """
+
+        return self.load().get(key)
+
+    def write(self, key, token, expires_at):
+        """
+        Write a token in cache
+        Params:
+            key: string identifying the API client
+            token: string containing access token
+            expires_at: token expiry as epoch time
+        """
+
+        # Drop expired tokens
+        now = time.time()
+        cache = {k: v for k, v in self.load().items() if v.get('expires_at', 0) > now}
+        cache[key] = {'token': token, 'expires_at': expires_at}
+        self.dump(cache)
+
+
+class CursorState(LockedFile):
+    """
+    Event cursors shared by all scripts using the same profile, by tenant
+    Written durably, so a cursor survives a crash once it has been committed
+    """
+
+    def __init__(self, path):
+        super().__init__(path, durable = True)
+
+    def read(self, tenant):
+        """
+        Read event cursor of a tenant
+        Params: tenant, string identifying the tenant
+        Result: cursor string, None if not saved
+        """
+
+        with self:
+            return self.load().get(tenant, {}).get('cursor')
+
+    def write(self, tenant, cursor):
+        """
+        Save event cursor of a tenant
+        Params:
+            tenant: string identifying the tenant
+            cursor: cursor string
+        Result: Boolean, True if cursor has been written to disk
+        """
+
+        with self:
+            state = self.load()
+            state[tenant] = {'cursor': cursor, 'updated_at': time.time()}
+            return self.dump(state)
+
+
+class QuotaLedger(LockedFile):
+    """
+    Daily API queries ledger shared by all scripts using the same tenant
+    Queries are counted per tenant and per consumer (script name), and reset each UTC day
+    """
+
+    def __init__(self, path, tenant, consumer, daily_quota, reserves, policy):
+        """
+        Params:
+            path: string containing ledger file path
+            tenant: string identifying the tenant
+            consumer: string identifying the script sending queries
+            daily_quota: int, number of queries allowed per day. 0 to count queries without limit
+            reserves: dict formatted as "consumer":"number of queries reserved each day"
+            policy: 'fail' to stop when quota would be exceeded, 'defer' to wait next UTC day
+        """
+
+        super().__init__(path)
+        self.tenant = tenant
+        self.consumer = consumer
+        self.daily_quota = daily_quota
+        self.reserves = reserves
+        self.policy = policy
+
+    def __usage(self, ledger):
+        # Tenant usage for current UTC day, reset if day has changed
+        today = time.strftime('%Y-%m-%d', time.gmtime())
+        usage = ledger.get(self.tenant)
+        if not usage or usage.get('day') != today:
+            usage = {'day': today, 'total': 0, 'consumers': {}}
+        return usage
+
+    def __available(self, usage):
+        # Queries left for consumer, not counting queries reserved for other consumers
+        if not self.daily_quota:
+            return sys.maxsize
+        reserved = 0
+        for consumer, reserve in self.reserves.items():
+            if consumer != self.consumer:
+                reserved += max(0, reserve - usage['consumers'].get(consumer, 0))
+        return self.daily_quota - usage['total'] - reserved
+
+    def available(self):
+        """
+        Get the number of queries the consumer can still send today
+        Result: int
+        """
+
+        with self:
+            return self.__available(self.__usage(self.load()))
+
+    def used(self):
+        """
+        Get the number of queries sent today by the consumer
+        Result: int
+        """
+
+        with self:
+            return self.__usage(self.load())['consumers'].get(self.consumer, 0)
+
+    def __capacity(self):
+        # Queries consumer can send in a whole day, once other consumers reserves are set aside
+        return self.daily_quota - sum(reserve for consumer, reserve in self.reserves.items() if consumer != self.consumer)
+
+    def __overrun(self, needed, available):
+        # Apply policy when quota would be exceeded. Waiting is useless if even a whole day is not enough
+        capacity = self.__capacity()
+        if needed > capacity:
+            logger.error('{0} queries needed but daily quota only allows {1} for {2}, after reserves of other consumers. Ending operation...'.format(
+                needed, max(capacity, 0), self.consumer))
+            sys.exit()
+        if self.policy == 'defer':
+            wait = 86400 - time.time() % 86400
+            logger.warning('{0} queries needed but only {1} left for {2} today. Waiting {3} seconds for quota reset...'.format(
+                needed, available, self.consumer, int(wait)))
+            time.sleep(wait)
+        else:
+            logger.error('{0} queries needed but only {1} left for {2} today. Ending operation...'.format(needed, available, self.consumer))
+            sys.exit()
+
+    def check(self, estimate):
+        """
+        Log the estimated number of queries of a job and apply policy if it would exceed quota
+        Job fails whatever the policy if it would exceed daily quota, less reserves of other consumers
+        Params: estimate, int number of queries the job will send
+        """
+
+        available = self.available()
+        logger.warning('{0} will send about {1} API queries. {2} queries left for today.'.format(
+            self.consumer, estimate, available if self.daily_quota else 'Unlimited'))
+        while estimate > available:
+            self.__overrun(estimate, available)
+            available = self.available()
+
+    def record(self, count = 1):
+        """
+        Count queries in ledger, applying policy first if quota is exhausted
+        Params: count, int number of queries
+        """
+
+        while True:
+            with self:
+                ledger = self.load()
+                usage = self.__usage(ledger)
+                available = self.__available(usage)
+                if available >= count:
+                    usage['total'] += count
+                    usage['consumers'][self.consumer] = usage['consumers'].get(self.consumer, 0) + count
+                    ledger[self.tenant] = usage
+                    self.dump(ledger)
+                    return
+            self.__overrun(count, available)
+
+
 ### Trellix API Class ###
 
 class Trellix:
@@ -70,103 +662,256 @@ class Trellix:
     Trellix API session object
     """
     
-    def __init__(self):
+    def __init__(self, pool_size = None, consumer = None, settings = None):
         """
         Create a new session to Trellix API
+        Params:
+            pool_size: optional int overriding pool_size setting from profile
+            consumer: optional string naming the job in quota ledger. Script name by default
+            settings: optional dict of profile settings, to open a session to another tenant. Default is profile file
         Result: Trellix object, contaning session information
         """
    
         # Session settings
-        self.headers = profile['api_headers']
-        self.url = profile['api_url']
-        self.short_url = profile['api_short_url']
-        self.device_page_limit = profile['device_page_limit']
-        self.events_page_limit = profile['events_page_limit']
-        try:
-            self.threat_events_cursor = profile['events_cursor']
-        except:
-            self.threat_events_cursor = ''
-
-        auth_headers = profile['auth_headers']
-
-        auth = (profile['id'],profile['secret'])
-
-        data = profile['auth_payload']
+        self.profile = settings or profile
+        self.headers = self.profile['api_headers']
+        self.url = self.profile['api_url']
+        self.short_url = self.profile['api_short_url']
+        self.device_page_limit = self.profile['device_page_limit']
+        self.events_page_limit = self.profile['events_page_limit']
+        self.tags_page_limit = self.profile.get('tags_page_limit', self.profile['device_page_limit'])
+        self.max_url_length = self.profile.get('max_url_length', DEFAULT_MAX_URL_LENGTH)
+        self.prefetch_depth = self.profile.get('prefetch_depth', 0)
+        self.tagCatalog = None
+        self.tagsApplied = {}
+        self.device_tags = {}
+        self.device_tags_source = None
+        self.deviceList = {}
+        self.name_index = None
+        self.name_index_source = None
+        self.tag_catalog_lock = threading.Lock()
+
+        # Transport settings
+        self.pool_size = pool_size or self.profile.get('pool_size', DEFAULT_POOL_SIZE)
+        self.timeout = (self.profile.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT), self.profile.get('read_timeout', DEFAULT_READ_TIMEOUT))
+        self.session = self.__newSession()
+
+        # Quota ledger, shared by all scripts using the same tenant
+        self.consumer = consumer or os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'trellixAPI'
+        self.tenant = tenantKey(self.profile)
+        self.quota = QuotaLedger(self.profile.get('quota_ledger', os.path.join(os.path.dirname(profile_path), QUOTA_LEDGER)),
+                                 self.tenant, self.consumer, self.profile.get('daily_quota', DEFAULT_DAILY_QUOTA),
+                                 self.profile.get('quota_reserves', {}), self.profile.get('quota_policy', 'fail'))
+
+        # Threat events cursor, from state file or from profile if not saved yet
+        self.cursor_state = CursorState(self.profile.get('events_state', os.path.join(os.path.dirname(profile_path), EVENTS_STATE)))
+        self.threat_events_cursor = self.cursor_state.read(self.tenant)
+
+        # Cursor saved by previous versions, under a key made of API key only
+        if self.threat_events_cursor is None:
+            self.threat_events_cursor = self.cursor_state.read(hashlib.sha256(self.profile['api_headers']['x-api-key'].encode()).hexdigest()[:16])
+            if self.threat_events_cursor is not None:
+                logger.warning('Threat events cursor saved by a previous version is used, it is saved again for this tenant at next commit')
+        if self.threat_events_cursor is None:
+            self.threat_events_cursor = self.profile.get('events_cursor', '')
+
+        # Threat events filters are sent to the API only if it supports them, and always applied to events pulled
+        self.events_pushdown = self.profile.get('events_pushdown', False)
+        self.threat_events_pulled = 0
+
+        # Token settings
+        self.token = ''
+        self.token_expiry = 0
+        self.token_cached = False
+        self.token_margin = self.profile.get('token_refresh_margin', DEFAULT_TOKEN_MARGIN)
+        self.token_cache = TokenCache(self.profile.get('token_cache', os.path.join(os.path.dirname(profile_path), TOKEN_CACHE)))
+        self.tenant_check = self.profile.get('tenant_check', 'always')
+
+        # Retry policy
+        self.retries = self.profile.get('retries', DEFAULT_RETRIES)
+        self.backoff_base = self.profile.get('backoff_base', DEFAULT_BACKOFF_BASE)
+        self.backoff_max = self.profile.get('backoff_max', DEFAULT_BACKOFF_MAX)
+        self.breaker_threshold = self.profile.get('breaker_threshold', DEFAULT_BREAKER_THRESHOLD)
+        self.breaker_cooldown = self.profile.get('breaker_cooldown', DEFAULT_BREAKER_COOLDOWN)
+
+        # Queries of all sessions and workers of the tenant share the same rate limit
+        self.rate_limiter = RateLimiter.forTenant(self.tenant, self.profile.get('max_rate', 0), self.profile.get('max_burst'))
+
+        # Adaptive page sizing, starting from page sizes learned recently or largest page sizes
+        self.adaptive_page_size = self.profile.get('adaptive_page_size', DEFAULT_ADAPTIVE_PAGE_SIZE)
+        if self.adaptive_page_size:
+            # Page sizes capped by the API, page sizes never grow above them
+            self.page_limit_caps = {}
+
+            # Smallest page sizes that failed and when, page sizes never grow back to them until they expire
+            self.page_limit_ceilings = {}
+
+            # Page sizes saved for next sessions
+            self.page_limits_saved = {}
+
+            self.page_limits_state = LockedFile(self.profile.get('page_limits', os.path.join(os.path.dirname(profile_path), PAGE_LIMITS)))
+            with self.page_limits_state:
+                learned = self.page_limits_state.load().get(self.tenant, {})
+            for endpoint, limit in MAX_PAGE_LIMITS.items():
+                state = learned.get(endpoint, {})
+                if time.time() - state.get('learned_at', 0) < PAGE_LIMITS_LIFETIME:
+                    limit = state['limit']
+                    self.page_limits_saved[endpoint] = limit
+                if state.get('ceiling') and time.time() - state.get('failed_at', 0) < PAGE_LIMITS_LIFETIME:
+                    self.page_limit_ceilings[endpoint] = (state['ceiling'], state['failed_at'])
+                self.__setPageLimit(endpoint, limit)
 
         self.auth()
 
+        # Tenant has already been checked when cached token was issued
+        if self.token_cached and self.tenant_check == 'auto':
+            logger.debug('Cached token is still valid, skipping tenant check')
+            return
+
         # Simple query to check id settings are correct (get 1 system properties)
         simple_query = self.url + 'devices?fields=id&page%5Boffset%5D=0&page%5Blimit%5D=1'
-        response = requests.get(simple_query, headers=self.headers)
+        response = self.__retry('get', simple_query, idempotent = True, headers=self.headers)
         logger.debug('Tenant check result: {0}'.format(response))
         if not response.status_code == 200:
             self.__responseCheck(response)                         
         
 
-    def auth(self):
+    def auth(self, force = False):
         """
         Authenticate to Trellix API
+        A cached token is reused if it does not expire within token_refresh_margin seconds
+        Params: force, boolean to request a new token even if current one is still valid
         """
         
         logger.debug('Trying to authenticate to Trellix API')
 
-        # Session settings
-        try:
-            with open(PROFILE, 'r') as profile_file:
-                profile = json.load(profile_file)
-        except:
-            with open('profile', 'r') as profile_file:
-                profile = json.load(profile_file)
-
+        auth_headers = self.profile['auth_headers']
 
-        auth_headers = profile['auth_headers']
+        auth = (self.profile['id'],self.profile['secret'])
 
-        auth = (profile['id'],profile['secret'])
+        data = self.profile['auth_payload']
 
-        data = profile['auth_payload']
+        # Cache key identifying API client, without storing credentials
+        cache_key = hashlib.sha256('|'.join([self.profile['auth_url'], self.profile['id'], data.get('scope', '')]).encode()).hexdigest()
 
         attempts = 5
         retries = attempts
 
-        # Start authentication loop
-        while retries:
-            
-            logger.debug('Attempt {0} of {1} to connect to Trellix API:'.format((attempts+1)-retries,attempts))
-            # Send authentication request
-
-            response = requests.post(profile['auth_url'], headers=auth_headers, auth=auth, data=data)
+        # Token rejected by API, captured before waiting for lock as another thread may refresh it meanwhile
+        rejected_token = self.token if force else None
 
-            logger.debug('Authentication request payload: {0}'.format(response.json()))
+        # Lock cache so concurrent scripts wait for a single token request
+        with self.token_cache:
 
-            # Stop if wrong credentials
-            if not response.status_code == 200:
-                logger.error('Authentication failed: {0} {1}'.format(response.json()['error_description'], response))
-                sys.exit()
+            # Reuse cached token, unless it is the one that has been rejected
+            cached = self.token_cache.read(cache_key)
+            if cached and cached['expires_at'] - self.token_margin > time.time() and cached['token'] != rejected_token:
+                self.__setToken(cached['token'], cached['expires_at'])
+                self.token_cached = True
+                logger.debug('Reusing cached token, expiring in {0} seconds'.format(int(cached['expires_at'] - time.time())))
+                return True
 
-            # Get session token
-            try:
+            # Start authentication loop
+            while retries:
                 
-                self.token = response.json()['access_token']
+                logger.debug('Attempt {0} of {1} to connect to Trellix API:'.format((attempts+1)-retries,attempts))
+                # Send authentication request
+
+                # Token requests can be sent again safely
+                response = self.__retry('post', self.profile['auth_url'], idempotent = True, headers=auth_headers, auth=auth, data=data)
+
+                logger.debug('Authentication request payload: {0}'.format(response.json()))
+
+                # Stop if wrong credentials
+                if not response.status_code == 200:
+                    logger.error('Authentication failed: {0} {1}'.format(response.json()['error_description'], response))
+                    sys.exit()
+
+                # Get session token
+                try:
+                    
+                    token = response.json()['access_token']
+                    expires_at = time.time() + int(response.json().get('expires_in', DEFAULT_TOKEN_LIFETIME))
+
+                    self.__setToken(token, expires_at)
+                    self.token_cached = False
+                    self.token_cache.write(cache_key, token, expires_at)
+                    logger.debug('Authentication successful. Status code: {0}'.format(response))
+                    return response
+                except:
+                    logger.debug('Authentication failed: {0}'.format(response))
+                    logger.debug('Retrying in 10 seconds...')
+                    time.sleep(10)
                 
-                # Rebuilding API headers
-                self.headers = profile['api_headers']
-                self.headers['Authorization'] += self.token
-                logger.debug('Authentication successful. Status code: {0}'.format(response))
-                return response
-            except:
-                logger.debug('Authentication failed: {0}'.format(response))
-                logger.debug('Retrying in 10 seconds...')
-                time.sleep(10)
-            
-            retries -= 1
+                retries -= 1
         
         # All attempts failed
         if retries == 0:
             logger.error('Impossible to authenticate to Trellix API. Ending operation...')
             sys.exit()
+
+
+    def __setToken(self, token, expires_at):
+        """
+        Internal function to set session token and rebuild API headers
+        Params:
+            token: string containing access token
+            expires_at: token expiry as epoch time
+        """
+
+        self.token = token
+        self.token_expiry = expires_at
+
+        # Rebuilding API headers
+        self.headers = dict(self.profile['api_headers'])
+        self.headers['Authorization'] += self.token
+
     
     ### Request functions ###
+
+    def __newSession(self):
+        """
+        Internal function to create the HTTP session used by all queries
+        Connections are kept alive and reused for each host, up to pool_size connections per host
+        Result: requests.Session object
+        """
+
+        session = requests.Session()
+
+        # Mount a pooled adapter for both schemes
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        logger.debug('HTTP session created with pool size {0} and timeouts {1}'.format(self.pool_size, self.timeout))
+
+        return session
+
             
+    def __send(self, method, query, **kwargs):
+        """
+        Internal function sending a query on HTTP session and counting it in quota ledger
+        Params:
+            method: must be 'get', 'post' or 'delete' string
+            query: string containing query
+            kwargs: other arguments passed to requests
+        Result:
+            request result
+        """
+
+        self.quota.record()
+        return self.session.request(method, query, timeout=self.timeout, **kwargs)
+
+
+    def estimate(self, queries):
+        """
+        Log the estimated number of API queries of a job before running it
+        and stop or wait next UTC day, depending on quota_policy, if it would exceed daily quota
+        Params: queries, int number of queries the job will send
+        """
+
+        self.quota.check(queries)
+
+
     def __responseCheck(self, response):
         """
         Verifies if API response is correct or return an error
@@ -194,7 +939,7 @@ class Trellix:
                 message = response.json()['message']
                 logger.error('Access denied: {0} {1}. {2}'.format(response, message, known_errors[message]))
                 if message == 'Unauthorized':
-                    self.auth()
+                    self.auth(force = True)
                     return False
             except Exception as e:
                 logger.debug(str(e))
@@ -211,159 +956,458 @@ class Trellix:
         elif response.status_code == 409:
             logger.info('Tag is already applied. Status code: {0}'.format(response))
             return False
-        elif response.status_code == 500:
+        elif response.status_code in (500, 502, 503, 504):
             logger.error('Impossible to connect to server. Status code: {0}'.format(response))
             return False
+        elif response.status_code == 429:
+            logger.error('Too many requests, API rate limit reached. Status code: {0}'.format(response))
+            return False
         else:
             logger.info('Unknown error. Status code: {0}'.format(response))
             logger.debug(response.text)
             sys.exit()
 
     
-    def __request(self, type, query, post = {}):
+    def __request(self, type, query, post = {}, retries = None, idempotent = None):
         """
-        Internal request function to manage timeouts and server side errors
+        Internal request function to manage token refresh, timeouts and server side errors
         Params:
             type: must be 'get', 'post' or 'delete' string
             query: string containing query
+            post: payload of post and delete queries
+            retries: optional int overriding retries setting from profile
+            idempotent: Boolean, True if query can be sent again when its result is unknown. Default is True for get queries only
         Result:
             request result
         """
 
-        retries = 5
+        if type not in ('get', 'post', 'delete'):
+            logger.error('Error in __request function: query is not "get", "post" or "delete". Aborting.')
+            sys.exit()
 
-        if type == 'get':
-            response = requests.get(query, headers=self.headers)
-            # If response code is 401 or 403, it might be a timeout, so we try to auth again
-            if response.status_code == 401 or response.status_code == 403:
-                logger.debug('Query return {0} error, it might be a timeout. Trying to refresh session...'.format(response.status_code))
-                self.auth()
+        # Refresh token shortly before it expires
+        if time.time() > self.token_expiry - self.token_margin:
+            logger.debug('Token expires in less than {0} seconds. Refreshing...'.format(self.token_margin))
+            self.auth()
 
-                logger.debug('New attempt to run query {0}:'.format(query))
-                response = requests.get(query, headers=self.headers)
+        kwargs = {} if type == 'get' else {'json': post}
+        return self.__retry(type, query, retries, type == 'get' if idempotent is None else idempotent, reauth = True, **kwargs)
 
-            # If reponse code is 500, it's generally server side
-            elif response.status_code == 500:
-                for i in range(retries):
-                    logger.debug(response.text)
-                    logger.debug('Query return error {0}, it might be on server side. Retry {1} of {2} in 60 seconds...'.format(response.status_code, i + 1, retries))
-                    time.sleep(60)
 
-                    logger.debug('New attempt to run query {0}:'.format(query))
-                    response = requests.get(query, headers=self.headers)
-                    
-                    # Check if error 500 is resolved
-                    if response.status_code == 401 or response.status_code == 403:
-                        return self.__request('get', query)
-                    elif response.status_code != 500:
-                        return response
-                    
-            return response
+    def __retry(self, method, query, retries = None, idempotent = False, reauth = False, **kwargs):
+        """
+        Internal function sending a query with retry policy shared by all queries:
+        - 429 and 503 responses are retried, as the API did not process the query
+        - 500, 502 and 504 responses, read timeouts and lost connections are retried only if query is idempotent,
+          as the API may have processed it
+        - delay before each retry grows exponentially, with jitter, and follows Retry-After header if sent by the API
+        - 401 and 403 responses trigger a single new authentication, if reauth is set
+        - queries are held by tenant and host circuit breaker while the service is down
+        Params:
+            method: must be 'get', 'post' or 'delete' string
+            query: string containing query
+            retries: optional int overriding retries setting from profile
+            idempotent: Boolean, True if query can be sent again when its result is unknown
+            reauth: Boolean, True to authenticate again on 401 and 403, and send session headers
+            kwargs: other arguments passed to requests
+        Result:
+            request result. Raises last requests exception if all attempts failed without response
+        """
 
-        elif type == 'post':
-            response = requests.post(query, headers=self.headers, json=post)
-            # If response code is 401 or 403, it might be a timeout, so we try to auth again
-            if response.status_code == 401 or response.status_code == 403:
-                logger.debug('Query return {0} error, it might be a timeout. Trying to refresh session...'.format(response.status_code))
-                self.auth()
+        retries = self.retries if retries is None else retries
+        breaker = CircuitBreaker.forHost(self.tenant, urlsplit(query).netloc, self.breaker_threshold, self.breaker_cooldown)
+        reauthenticated = False
+        attempt = 0
 
-                logger.debug('New attempt to run query {0}:'.format(query))
-                response = requests.post(query, headers=self.headers, json=post)
-            
-            # If reponse code is 500, it's generally server side
-            elif response.status_code == 500:
-                for i in range(retries):
-                    logger.debug('Query return {0} error, it might be on server side. Retry {1} of {2} in 60 seconds...'.format(response.status_code, i + 1, retries))
-                    time.sleep(60)
-
-                    logger.debug('New attempt to run query {0}:'.format(query))
-                    response = requests.post(query, headers=self.headers, json=post)
-                    
-                    # Check if error 500 is resolved
-                    if response.status_code == 401 or response.status_code == 403:
-                        return self.__request('post', query, post)
-                    elif response.status_code != 500:
-                        return response
+        while True:
+            breaker.wait()
+            self.rate_limiter.acquire()
+            if reauth:
+                kwargs['headers'] = self.headers
 
-            return response
-        
-        elif type == 'delete':
-            response = requests.delete(query, headers=self.headers, json=post)
-            # If response code is 401 or 403, it might be a timeout, so we try to auth again
-            if response.status_code == 401 or response.status_code == 403:
-                logger.debug('Query return {0} error, it might be a timeout. Trying to refresh session...'.format(response.status_code))
-                self.auth()
-
-                logger.debug('New attempt to run query {0}:'.format(query))
-                response = requests.delete(query, headers=self.headers, json=post)
-
-            # If reponse code is 500, it's generally server side
-            elif response.status_code == 500:
-                for i in range(retries):
-                    logger.debug('Query return {0} error, it might be on server side. Retry {1} of {2} in 60 seconds...'.format(response.status_code, i + 1, retries))
-                    time.sleep(60)
-
-                    logger.debug('New attempt to run query {0}:'.format(query))
-                    response = requests.delete(query, headers=self.headers, json=post)
-                    
-                    # Check if error 500 is resolved
-                    if response.status_code == 401 or response.status_code == 403:
-                        return self.__request('delete', query, post)
-                    elif response.status_code != 500:
-                        return response
-                    
-            return response
-        
-        else:
-            logger.error('Error in __request function: query is not "get", "post" or "delete". Aborting.')
-            sys.exit()
+            # Send query
+            error = None
+            response = None
+            try:
+                response = self.__send(method, query, **kwargs)
+            except requests.exceptions.ConnectTimeout as e:
+                # Connection not established, query has not been sent
+                error, retryable, down = e, True, True
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                error, retryable, down = e, idempotent, isinstance(e, requests.exceptions.ConnectionError)
+
+            if response is not None:
+                # Token may have expired, authenticate again once
+                if reauth and response.status_code in (401, 403) and not reauthenticated:
+                    logger.debug('Query return {0} error, it might be a timeout. Trying to refresh session...'.format(response.status_code))
+                    breaker.success()
+                    self.auth(force = True)
+                    reauthenticated = True
+                    continue
+                retryable = response.status_code in RETRY_ALWAYS or (idempotent and response.status_code in RETRY_IDEMPOTENT)
+                down = response.status_code in BREAKER_STATUS
+
+            # Record host state
+            if down:
+                breaker.failure()
+            else:
+                breaker.success()
+
+            # Return response, or raise error, if not retryable or no retry left
+            if not retryable or attempt >= retries:
+                if error is not None:
+                    raise error
+                response.attempts = attempt + 1
+                return response
+
+            # Wait before next attempt
+            attempt += 1
+            delay = self.__retryDelay(attempt, response)
+            logger.info('Query {0} {1} failed ({2}). Retry {3} of {4} in {5:.1f} seconds...'.format(
+                method, query, error if error is not None else response.status_code, attempt, retries, delay))
+            time.sleep(delay)
+
+
+    def __retryDelay(self, attempt, response):
+        """
+        Internal function computing delay before a retry
+        Exponential backoff with full jitter, unless API sent a Retry-After header
+        Params:
+            attempt: int, retry number starting from 1
+            response: last response, None if query failed without response
+        Result: delay in seconds
+        """
+
+        # Retry-After header, in seconds or as HTTP date
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = None
+            if delay is not None:
+                return min(max(delay, 0), MAX_RETRY_AFTER)
+
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+
+    def __pages(self, query, caller, next_prefix = '', endpoint = None):
+        """
+        Internal generator following links.next from a first query, one page at a time
+        If prefetch_depth is set, next pages are requested in background while current one is consumed
+        Params:
+            query: string containing first query
+            caller: string containing calling function name, for logs
+            next_prefix: string added before links.next, if API returns relative links
+            endpoint: 'devices', 'events' or 'tags' string, to adapt page size if adaptive_page_size is set
+        Result:
+            yields each page json
+        """
+
+        if self.prefetch_depth > 0:
+            return self.__prefetchPages(query, caller, next_prefix, endpoint)
+        return self.__serialPages(query, caller, next_prefix, endpoint)
+
+
+    def __prefetchPages(self, query, caller, next_prefix, endpoint):
+        """
+        Internal generator reading pages ahead in a background thread, up to prefetch_depth pages
+        Errors in background thread are raised in consumer, and background thread stops
+        once consumer stops or fails
+        """
+
+        pages = queue.Queue(maxsize=self.prefetch_depth)
+        stop = threading.Event()
+        end = object()
+
+        def put(item):
+            # Wait for a free slot, unless consumer has stopped
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fetch():
+            try:
+                for data in self.__serialPages(query, caller, next_prefix, endpoint):
+                    if not put(data):
+                        logger.debug('{0} prefetch cancelled'.format(caller))
+                        return
+                put(end)
+            except BaseException as e:
+                # Including SystemExit raised on fatal API errors
+                put(e)
+
+        thread = threading.Thread(target=fetch, name=caller + '-prefetch', daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                item = pages.get()
+                if item is end:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
+
+    def __serialPages(self, query, caller, next_prefix, endpoint):
+        """
+        Internal generator following links.next from a first query, one page at a time
+        Next page is only requested when previous one has been consumed
+        With adaptive page sizing, each query uses the current page size of its endpoint, which is
+        lowered to the page size returned by the API if it is capped, halved when a page still fails with 500,
+        504 or a read timeout after retry policy or is rejected with 400 or 422, and doubled again after
+        PAGE_LIMIT_GROWTH successful pages, unless doubled size has already failed
+        Only page sizes that returned a page are saved for next sessions
+        Params:
+            query: string containing first query
+            caller: string containing calling function name, for logs
+            next_prefix: string added before links.next, if API returns relative links
+            endpoint: 'devices', 'events' or 'tags' string, to adapt page size if adaptive_page_size is set
+        Result:
+            yields each page json
+        """
+
+        adaptive = self.adaptive_page_size and endpoint
+        pages = 0
+        limit = 0
+        successes = 0
 
+        while query:
+
+            # Use current page size of endpoint
+            if adaptive:
+                limit = self.pageLimit(endpoint)
+                query = PAGE_LIMIT_PARAM.sub(r'\g<1>' + str(limit), query)
+            can_shrink = adaptive and limit > MIN_PAGE_LIMIT
+
+            logger.debug('{0} sent query: {1}'.format(caller, query))
+            try:
+                # Retry policy comes first, a transient error must not lower page size
+                response = self.__request('get', query)
+            except requests.exceptions.ReadTimeout:
+                if not can_shrink:
+                    raise
+                self.__shrinkPageLimit(endpoint, caller, 'timeout', learned = True)
+                successes = 0
+                continue
+            logger.debug('{0} response: {1}'.format(caller, response))
+
+            # Back off if page is too large
+            if can_shrink and response.status_code in PAGE_TOO_LARGE_STATUS + PAGE_SLOW_STATUS + PAGE_REJECTED_STATUS:
+                self.__shrinkPageLimit(endpoint, caller, response.status_code, learned = response.status_code in PAGE_TOO_LARGE_STATUS)
+                successes = 0
+                continue
+
+            # Retry same page if query failed
+            if not self.__responseCheck(response):
+                logger.info('Waiting 60 seconds before next try')
+                time.sleep(60)
+                continue
+
+            data = response.json()
+
+            try:
+                query = next_prefix + data['links']['next'] if data['links']['next'] else ""
+                logger.debug('{0} next query: {1}'.format(caller, query))
+            except:
+                query = ""
+                logger.debug('{0} next query: none'.format(caller))
+
+            # API returned less devices than requested while there are more pages: page size is capped
+            if adaptive and query and 0 < len(data['data']) < limit:
+                logger.info('{0}: API caps {1} page size to {2}'.format(caller, endpoint, len(data['data'])))
+                limit = len(data['data'])
+                self.page_limit_caps[endpoint] = limit
+                self.__setPageLimit(endpoint, limit)
+
+            # Page size lowered after errors grows back once pages succeed again, below sizes that failed
+            elif adaptive:
+                successes += 1
+                growth = min(self.page_limit_caps.get(endpoint, MAX_PAGE_LIMITS[endpoint]), limit * 2)
+                if successes >= PAGE_LIMIT_GROWTH and limit < growth < self.__pageLimitCeiling(endpoint):
+                    logger.info('{0}: {1} pages pulled without error, raising {2} page size to {3}'.format(caller, successes, endpoint, growth))
+                    self.__setPageLimit(endpoint, growth)
+                    successes = 0
+
+            # Page size is saved once it has returned a page
+            if adaptive and self.page_limits_saved.get(endpoint) != limit:
+                self.__savePageLimit(endpoint, limit = limit)
+
+            pages += 1
+            yield data
+
+        # Run summary
+        if adaptive:
+            logger.warning('{0}: {1} page(s) pulled, page size used: {2}'.format(caller, pages, self.pageLimit(endpoint)))
+        elif endpoint:
+            logger.info('{0}: {1} page(s) pulled, page size used: {2}'.format(caller, pages, self.pageLimit(endpoint)))
+
+
+    def pageLimit(self, endpoint):
+        """
+        Get page size currently used for an endpoint
+        Params: endpoint, 'devices', 'events' or 'tags' string
+        Result: int
+        """
+
+        return getattr(self, PAGE_LIMIT_ATTRIBUTES[endpoint])
+
+
+    def __setPageLimit(self, endpoint, limit):
+        """
+        Internal function setting page size of an endpoint for current session
+        Params:
+            endpoint: 'devices', 'events' or 'tags' string
+            limit: int, page size
+        """
+
+        setattr(self, PAGE_LIMIT_ATTRIBUTES[endpoint], limit)
+
+
+    def __savePageLimit(self, endpoint, limit = None, ceiling = None):
+        """
+        Internal function saving page size of an endpoint, or page size that failed, for next sessions
+        Params:
+            endpoint: 'devices', 'events' or 'tags' string
+            limit: optional int, page size that returned a page
+            ceiling: optional int, page size that failed
+        """
+
+        with self.page_limits_state:
+            state = self.page_limits_state.load()
+            saved = state.setdefault(self.tenant, {}).setdefault(endpoint, {})
+            if limit is not None:
+                saved.update({'limit': limit, 'learned_at': time.time()})
+                self.page_limits_saved[endpoint] = limit
+            if ceiling is not None:
+                saved.update({'ceiling': ceiling, 'failed_at': time.time()})
+            self.page_limits_state.dump(state)
+
+
+    def __pageLimitCeiling(self, endpoint):
+        """
+        Internal function getting smallest page size that failed for an endpoint, until it expires
+        Params: endpoint, 'devices', 'events' or 'tags' string
+        Result: int, larger than largest page size if no page size failed
+        """
+
+        ceiling, failed_at = self.page_limit_ceilings.get(endpoint, (0, 0))
+        if not ceiling or time.time() - failed_at >= PAGE_LIMITS_LIFETIME:
+            return MAX_PAGE_LIMITS[endpoint] + 1
+        return ceiling
+
+
+    def __shrinkPageLimit(self, endpoint, caller, reason, learned = False):
+        """
+        Internal function halving page size of an endpoint after a server error, a timeout or a rejected page size
+        Failed page size is kept as a ceiling, page size does not grow back to it
+        Params:
+            endpoint: 'devices', 'events' or 'tags' string
+            caller: string containing calling function name, for logs
+            reason: status code or 'timeout', for logs
+            learned: Boolean, True to save failed page size for next sessions, when error means page is too large
+        """
+
+        failed = self.pageLimit(endpoint)
+        ceiling = min(failed, self.__pageLimitCeiling(endpoint))
+        self.page_limit_ceilings[endpoint] = (ceiling, time.time())
+        if learned:
+            self.__savePageLimit(endpoint, ceiling = ceiling)
+
+        limit = max(MIN_PAGE_LIMIT, failed // 2)
+        logger.warning('{0}: query failed ({1}), lowering {2} page size to {3}'.format(caller, reason, endpoint, limit))
+        self.__setPageLimit(endpoint, limit)
+
+    
     ### Tag functions ###
             
+    def loadTagCatalog(self):
+        """
+        Load all tags from tag catalog, once per session
+        Result:
+            self.tagCatalog, dict formatted as "tag name":"tag id"
+        """
+
+        # Several threads may need tag catalog at the same time, only one loads it
+        with self.tag_catalog_lock:
+            if self.tagCatalog is not None:
+                return self.tagCatalog
+
+            tag_query = self.url + 'tags?fields=id,name&page%5Boffset%5D=0&page%5Blimit%5D=' + str(self.tags_page_limit)
+            catalog = {}
+            for data in self.__pages(tag_query, 'loadTagCatalog', endpoint = 'tags'):
+                for tag in data['data']:
+                    catalog[tag['attributes']['name']] = tag['id']
+
+            logger.info('Tag catalog loaded, {0} tag(s)'.format(len(catalog)))
+            logger.debug('Tag catalog: {0}'.format(catalog))
+            self.tagCatalog = catalog
+            return catalog
+
+
     def getTagId(self, tag):
         """
-        Get tag id from tag name
+        Get tag id from tag name, using tag catalog loaded once per session
         Params: tag, string containing tag name
-        Result: tag id, int
+        Result: tag id, 0 if tag is not found
         """
 
-        # Forge query
-        tag_query = self.url + 'tags?filter=%7B%22EQ%22%3A%7B%22name%22%20%3A%20%22' + tag + '%22%7D%7D&fields=id,name'
-        logger.debug('getTagId query: {0}'.format(tag_query))
+        catalog = self.loadTagCatalog()
 
-        # Send query
-        response = self.__request('get', tag_query)
-        logger.debug('getTagId response: {0}'.format(response.json()))
-
-        # Return tag id if query is successful
-        if self.__responseCheck(response):
-            
-            # Verify tag has been found and return tag id
-            try:
-                tag_id = response.json()['data'][0]['id']
-                logger.debug('Tag has been found in tag catalog, tag {0} id is {1}.'.format(tag, tag_id))
-                return tag_id
-            # Return 0 if tag is not found in ePO
-            except:
-                logger.info('Tag {0} is not found in Tag catalog in ePO'.format(tag))
-                return 0
+        # Exact name first, then not case sensitive
+        tag_id = catalog.get(tag)
+        if tag_id is None:
+            tag_id = next((i for name, i in catalog.items() if name.casefold() == tag.casefold()), None)
 
-        # Return -1 if query failed
-        else:
-            logger.info('Failed to find tag {0}. Status code: {1}'.format(tag, response.status_code))
+        if tag_id is None:
+            logger.info('Tag {0} is not found in Tag catalog in ePO'.format(tag))
             return 0
 
+        logger.debug('Tag has been found in tag catalog, tag {0} id is {1}.'.format(tag, tag_id))
+        return tag_id
+
 
     def isTagApplied(self, deviceId, tag):
         """
         Verifies if tag is applied to a system
+        Tag name is matched like getTagId: exact name first, then not case sensitive
         Params:
             deviceId: int contaning device id
             tag: string containing tag name
         Result: Boolean
         """
 
-        return tag in list(self.tagsApplied[deviceId].split(", "))
+        tags = self.deviceTags().get(deviceId, ())
+        return tag in tags or tag.casefold() in {applied.casefold() for applied in tags}
+
+
+    def deviceTags(self):
+        """
+        Set based index of tags applied on each system, built once from self.tagsApplied
+        Result: dict formatted as "device id": frozenset of tags, or FleetTags view if tagsApplied is a fleet view
+        """
+
+        # Fleet module imports this module
+        from lib.fleet import FleetTags
+
+        # Index is rebuilt only if tagsApplied has been replaced, by getAllDevices or from inventory
+        if self.device_tags_source is not self.tagsApplied:
+            if isinstance(self.tagsApplied, FleetTags):
+                self.device_tags = FleetTags(self.tagsApplied.fleet, as_set = True)
+            else:
+                self.device_tags = {device: frozenset(splitTags(tags)) for device, tags in self.tagsApplied.items()}
+            self.device_tags_source = self.tagsApplied
+        return self.device_tags
             
 
     def applyTag(self, tag_id, device_id):
@@ -418,13 +1462,19 @@ class Trellix:
         logger.debug('ApplyTag payload: {0}'.format(payload))
 
         # Send post query
-        response = self.__request('post', apply_tag_query, payload)
+        # Applying a tag twice leaves systems in the same state, so query can be retried
+        response = self.__request('post', apply_tag_query, payload, idempotent = True)
         logger.debug('ApplyTag response: {0}'.format(response))
         
         if response.status_code == 204:
             logger.info('Tag successfully applied on {0} systems. Status code {1}'.format(sys_len, response))
             return True
 
+        # Tag applied by a previous attempt which response has been lost
+        if response.status_code == 409 and response.attempts > 1:
+            logger.info('Tag applied on {0} systems by a previous attempt. Status code {1}'.format(sys_len, response))
+            return True
+
         # return response check result if failed
         return self.__responseCheck(response)
    
@@ -481,7 +1531,8 @@ class Trellix:
         logger.debug('ClearTag payload: {0}'.format(payload))
 
         # Send delete query
-        response = response = self.__request('delete', clear_tag_query, payload)
+        # Clearing a tag twice leaves systems in the same state, so query can be retried
+        response = self.__request('delete', clear_tag_query, payload, idempotent = True)
         logger.debug('ClearTag response: {0}'.format(response))
         
         if response.status_code == 204:
@@ -492,8 +1543,75 @@ class Trellix:
         return self.__responseCheck(response)
  
 
+    def tagQuery(self, tag_id, device_ids, clear = False):
+        """
+        Send a single apply or clear tag query on a list of systems, without checking response
+        Used by bulk tag executor, which handles each response status
+        Params:
+            tag_id: tag id
+            device_ids: list of device ids
+            clear: Boolean, True to clear tag instead of applying it
+        Result:
+            request result
+        """
+
+        tag_query = self.url + 'tags/' + str(tag_id) + '/relationships/devices'
+        payload = {"data": [{"type": "devices", "id": int(device)} for device in device_ids]}
+        logger.debug('tagQuery {0} on {1} systems: {2}'.format('clear' if clear else 'apply', len(device_ids), tag_query))
+
+        # Applying or clearing a tag twice leaves systems in the same state, so query can be retried
+        return self.__request('delete' if clear else 'post', tag_query, payload, idempotent = True)
+
+
     ### Devices functions ###
 
+    def nameIndex(self):
+        """
+        Inverted index of device names, built once from self.deviceList
+        Result: NameIndex object
+        """
+
+        # Index is rebuilt only if deviceList has been replaced, by getAllDevices or from inventory
+        if self.name_index_source is not self.deviceList:
+            self.name_index = NameIndex(self.deviceList)
+            self.name_index_source = self.deviceList
+        return self.name_index
+
+
+    def lookupDevices(self, names):
+        """
+        From device names, get device ids using device list gathered by getAllDevices, without any query
+        Names are not case sensitive, and short names match FQDN
+        Params: names, list of device names
+        Result:
+            resolved: dict formatted as "device name":[device ids], list has several ids if duplicate entries
+            ambiguous: dict formatted as "device name":[device ids], for names matching several devices
+            not_found: list of device names not found in device list
+        """
+
+        index = self.nameIndex()
+        resolved = {}
+        not_found = []
+
+        for name in dict.fromkeys(names):
+            if not name.strip():
+                continue
+            ids = index.lookup(name)
+            if ids:
+                resolved[name] = ids
+            else:
+                not_found.append(name)
+
+        # Duplicate entries are reported, tags are applied on all of them
+        ambiguous = {name: ids for name, ids in resolved.items() if len(ids) > 1}
+        for name, ids in ambiguous.items():
+            logger.warning('Device name {0} matches {1} devices: {2}'.format(name, len(ids), ', '.join(
+                '{0} ({1})'.format(self.deviceList[id], id) for id in ids)))
+
+        logger.info('{0} device(s) found, {1} ambiguous, {2} not found'.format(len(resolved), len(ambiguous), len(not_found)))
+        return resolved, ambiguous, not_found
+
+
     def getDeviceId(self, device):
         """
         From device name, get device id
@@ -537,50 +1655,133 @@ class Trellix:
             return 0
 
 
-    def getAllDevices(self):
+    def deviceNameChunks(self, names):
         """
-        List all devices registered in ePO and their applied tags
-        Result: 
-            self.deviceList, dict formatted as "device id":"device name"
-            self.tagsApplied, dict formatted as "device id":"tags list"            
+        Split device names in chunks, each chunk being resolved by resolveDevices with a single query
+        Chunks are sized so the query URL with its OR filter fits in max_url_length
+        Params: names, list of device names
+        Result: list of lists of device names, without duplicate and empty names
         """
-        
-        # Forge query
-        offset = 0
-        device_query = self.url + 'devices?fields=id,name,tags&page%5Boffset%5D=' + str(offset) + '&page%5Blimit%5D=' + str(self.device_page_limit)
-        
 
-        # Dictionnaries initialisation
-        self.deviceList = {}
-        self.tagsApplied = {}
-        
-        # Query loop to browse system list
-        while device_query:
-            logger.debug('getAllDevices sent query: {0}'.format(device_query))
-            logger.debug('Headers: {0}'.format(self.headers))
-            response = self.__request('get', device_query)
-            logger.debug('getAllDevices response: {0}'.format(response))
-            
-            if self.__responseCheck(response):
-                data = response.json()
+        # Length of query without conditions
+        base_length = len(self.url + 'devices?fields=id,name&page%5Boffset%5D=0&page%5Blimit%5D=0000&filter=' + quote('{"OR": []}'))
+
+        chunks = []
+        chunk = []
+        length = base_length
+
+        for name in dict.fromkeys(names):
+            if not name:
+                continue
+
+            # Encoded condition and separator length
+            condition_length = len(quote(json.dumps({'EQ': {'name': name}}) + ', '))
+            if chunk and length + condition_length > self.max_url_length:
+                chunks.append(chunk)
+                chunk = []
+                length = base_length
+
+            chunk.append(name)
+            length += condition_length
+
+        if chunk:
+            chunks.append(chunk)
+
+        return chunks
+
+
+    def resolveDevices(self, names):
+        """
+        From device names, get device ids using one query per chunk of names instead of one query per name
+        Params: names, list of device names
+        Result:
+            resolved: dict formatted as "device name":[device ids], in names order, list has several ids if duplicate entries.
+            Names differing only by case are all resolved to the same devices
+            not_found: list of device names not found in ePO, in names order
+        """
+
+        # Device ids by case folded name, as hostnames are not case sensitive
+        found = {}
+
+        for chunk in self.deviceNameChunks(names):
+            chunk_names = {name.casefold() for name in chunk}
+
+            # Forge query
+            device_filter = {'OR': [{'EQ': {'name': name}} for name in chunk]}
+            device_query = (self.url + 'devices?fields=id,name&page%5Boffset%5D=0&page%5Blimit%5D=' + str(max(len(chunk), self.device_page_limit))
+                            + '&filter=' + quote(json.dumps(device_filter)))
+            logger.debug('resolveDevices query: {0}'.format(device_query))
 
-                for i in range(len(data['data'])):
-                    self.deviceList[int(data['data'][i]['id'])] = data['data'][i]['attributes']['name']
-                    self.tagsApplied[int(data['data'][i]['id'])] = data['data'][i]['attributes']['tags']
+            # Query loop, duplicate entries can return more devices than names in chunk
+            while device_query:
+                response = self.__request('get', device_query)
+                logger.debug('resolveDevices response: {0}'.format(response))
+
+                if not self.__responseCheck(response):
+                    logger.info('Failed to resolve devices {0}. Status code: {1}'.format(chunk, response.status_code))
+                    break
+
+                data = response.json()
+                for device in data['data']:
+                    name = device['attributes']['name'].casefold()
+                    if name in chunk_names and device['id'] not in found.get(name, []):
+                        found.setdefault(name, []).append(device['id'])
 
                 try:
                     device_query = data['links']['next']
-                    logger.debug('getAllDevices next query: {0}'.format(device_query))
                 except:
-                    device_query = ""
-                    logger.debug('getAllDevices next query: none')
-                
-            
-        
-        # Dictionnary completed
-        logger.info('Devices information successfully pulled from ePO')
-        logger.debug('System list generated from ePO: {0}'.format(self.deviceList))
-        logger.debug('List of all applied tags per device: {0}'.format(self.tagsApplied))
+                    device_query = ''
+
+        # Devices are returned in API order, results follow names order
+        resolved = {name: found[name.casefold()] for name in dict.fromkeys(names) if name and name.casefold() in found}
+        not_found = [name for name in dict.fromkeys(names) if name and name not in resolved]
+
+        logger.info('{0} device(s) resolved, {1} device(s) not found'.format(len(resolved), len(not_found)))
+        logger.debug('Resolved devices: {0}'.format(resolved))
+        logger.debug('Devices not found: {0}'.format(not_found))
+
+        return resolved, not_found
+
+
+    def getDeviceCount(self):
+        """
+        Get the number of devices registered in ePO
+        Result: int, 0 if not returned by the API
+        """
+
+        # Forge query
+        count_query = self.url + 'devices?fields=id&page%5Boffset%5D=0&page%5Blimit%5D=1'
+        logger.debug('getDeviceCount query: {0}'.format(count_query))
+
+        # Send query
+        response = self.__request('get', count_query)
+
+        if self.__responseCheck(response):
+            try:
+                return int(response.json()['meta']['totalResourceCount'])
+            except:
+                logger.debug('Device count not returned by the API')
+        return 0
+
+
+    def getAllDevices(self):
+        """
+        List all devices registered in ePO and their applied tags, in a compact fleet built page by page
+        Result: 
+            self.deviceList, Fleet object, used like a dict formatted as "device id":"device name"
+            self.tagsApplied, FleetTags view, used like a dict formatted as "device id":"tags list"
+        """
+
+        # Fleet module imports this module
+        from lib.fleet import Fleet, FleetTags
+
+        # Query loop to browse system list
+        fleet = Fleet.fromSession(self)
+        self.deviceList = fleet
+        self.tagsApplied = FleetTags(fleet)
+
+        # Fleet completed
+        logger.info('Devices information successfully pulled from ePO: {0} device(s)'.format(len(fleet)))
 
    
     def collectProperties(self, device_id, props = AVAILABLE_PROPS):
@@ -590,7 +1791,7 @@ class Trellix:
             device_id: int
             props: list of all device properties to gather
         Result:
-            json containing device information
+            dict containing device id (int) and properties
         """
 
         # Filtering props
@@ -617,9 +1818,12 @@ class Trellix:
         response = self.__request('get', props_query)
         logger.debug('collectProperties response: {0}'.format(response.json()))
 
-        # Return device properties query is successful
+        # Return device id and properties query is successful
         if self.__responseCheck(response):
-            return response.json()['data']['attributes']
+            device = response.json()['data']
+            device_data = {'id': int(device['id'])}
+            device_data.update(device['attributes'])
+            return device_data
 
         # Return 0 if query failed
         else:
@@ -635,9 +1839,18 @@ class Trellix:
         Result:
             List of json data containing devices information
         """
-        
-        # Create new list to store properties
-        all_props = []
+
+        return list(self.iterAllProperties(props))
+
+
+    def iterAllProperties(self, props = AVAILABLE_PROPS):
+        """
+        Get all devices properties, page by page
+        Params:
+            props: list of all device properties to gather. If not specified, collect all properties
+        Result:
+            yields dict containing device id (int) and properties, like iterDevices
+        """
 
         # Filtering props
         logger.info('Checking if properties exists...')
@@ -661,28 +1874,53 @@ class Trellix:
         logger.debug('collectProperties query: {0}'.format(props_query))
 
         # Query loop to browse system list
-        while props_query:
-            logger.debug('collectAllProperties sent query: {0}'.format(props_query))
-            logger.debug('Headers: {0}'.format(self.headers))
-            response = self.__request('get', props_query)
-            logger.debug('collectAllProperties response: {0}'.format(response))
-            
-            if self.__responseCheck(response):
-                data = response.json()
-                logger.debug('Data collected: {0}'.format(data))
+        for data in self.__pages(props_query, 'collectAllProperties', endpoint = 'devices'):
+            for device in data['data']:
+                device_data = {'id': int(device['id'])}
+                device_data.update(device['attributes'])
+                yield device_data
+    
 
-                for i in range(len(data['data'])):
-                    all_props.append(data['data'][i]['attributes'])
+    def getDevices(self, props, device_filter = None):
+        """
+        List devices with their id and properties, optionally matching a filter
+        Params:
+            props: list of device properties to gather
+            device_filter: optional dict containing API filter, like {"GT": {"lastUpdate": "2024-03-07T13:09:06.118Z"}}
+        Result:
+            list of dict containing device id (int) and properties
+        """
 
-                try:
-                    props_query = data['links']['next']
-                    logger.debug('collectAllProperties next query: {0}'.format(props_query))
-                except:
-                    props_query = ""
-                    logger.debug('collectAllProperties next query: none')
+        devices = list(self.iterDevices(props, device_filter))
+        logger.info('{0} devices listed'.format(len(devices)))
+        return devices
+
+
+    def iterDevices(self, props, device_filter = None):
+        """
+        List devices with their id and properties, optionally matching a filter, page by page
+        Params:
+            props: list of device properties to gather
+            device_filter: optional dict containing API filter, like {"GT": {"lastUpdate": "2024-03-07T13:09:06.118Z"}}
+        Result:
+            yields dict containing device id (int) and properties
+        """
+
+        # Keep only available props
+        filtered_props = [prop for prop in AVAILABLE_PROPS if prop in props and prop != 'id']
+
+        # Forge first query
+        device_query = self.url + 'devices?fields=' + ','.join(filtered_props) + '&page%5Boffset%5D=0&page%5Blimit%5D=' + str(self.device_page_limit)
+        if device_filter:
+            device_query += '&filter=' + quote(json.dumps(device_filter))
+
+        # Query loop to browse system list
+        for data in self.__pages(device_query, 'getDevices', endpoint = 'devices'):
+            for device in data['data']:
+                device_data = {'id': int(device['id'])}
+                device_data.update(device['attributes'])
+                yield device_data
 
-        return all_props
-    
 
     def getInstalledProducts(self, device_id):
         """
@@ -712,97 +1950,91 @@ class Trellix:
 
     ### Events functions ###
 
-    def __updateThreatEventsCursor(self, guid, timestamp):
+    def commitThreatEventsCursor(self, cursor):
         """
-        Internal function to update threat events cursor when new events are pulled
-        and write it in profile file for saving
-        Params:
-            guid: string containing last event guid
-            timestamp: string containing last event timestamp
+        Save threat events cursor in events state file, once events up to this cursor have been delivered
+        Profile file is never written
+        Params: cursor, string returned by iterThreatEventPages ('eventguid_:_timestamp')
+        Result: Boolean, True if cursor has been written to disk
         """
 
-        # Update threat event cursor in session
-        self.threat_events_cursor = guid + '_:_' + timestamp
-        logger.debug('Updated threat event cursor: {0}'.format(self.threat_events_cursor))
+        self.threat_events_cursor = cursor
+        logger.debug('Updated threat event cursor: {0}'.format(cursor))
 
-        # Update profile file with last threat events cursor
-        try:
-            try:
-                with open(PROFILE, 'r') as profile_file:
-                    profile = json.load(profile_file)
-                
-                profile['events_cursor'] = self.threat_events_cursor
+        if not self.cursor_state.write(self.tenant, cursor):
+            logger.warning('Threat event cursor is not saved. Pulling progress is not saved and might generate duplicate events')
+            return False
+        return True
 
-                with open(PROFILE, 'w') as profile_file:
-                    json.dump(profile, profile_file, indent = 4)
 
-            except:
-                with open('profile', 'r') as profile_file:
-                    profile = json.load(profile_file)
+    def pullThreatEvents(self, event_filter = None):
+        """
+        Pull all threat events from ePO console from last event (cursor)
+        If no cursor, pull all events from ePO
+        Param:
+            event_filter: optional EventFilter object selecting events and fields
+        Result:
+            json containing events
+        """
 
-                profile['events_cursor'] = self.threat_events_cursor
+        threat_events = list(self.iterThreatEvents(event_filter))
 
-                with open(PROFILE, 'w') as profile_file:
-                    json.dump(profile, profile_file, indent = 4)
-        except:
-            logger.warning('Profile file not found to update Threat event cursor. '
-                         'Pulling progress is not saved and might generate duplicate events')
+        logger.info('{0} new threat events have been pulled'.format(len(threat_events)))
+        return threat_events
 
 
-    def pullThreatEvents(self):
+    def iterThreatEvents(self, event_filter = None):
         """
-        Pull all threat events from ePO console from last event (cursor)
+        Pull all threat events from ePO console from last event (cursor), page by page
+        Cursor is committed once all events of a page have been consumed, so stopping before
+        the end of a page pulls its events again next time
         Param:
-            cursor: string containing last event pulled ('eventguid_:_timestamp')
-                    If no cursor, pull all events from ePO
+            event_filter: optional EventFilter object selecting events and fields
         Result:
-            json containing events
+            yields json containing each event
         """
 
-        # Threat events list
-        threat_events = []
+        for events, cursor in self.iterThreatEventPages(event_filter):
+            for event in events:
+                yield event
+            self.commitThreatEventsCursor(cursor)
+
+
+    def iterThreatEventPages(self, event_filter = None):
+        """
+        Pull all threat events from ePO console from last event (cursor), page by page, without committing cursor
+        Caller commits cursor with commitThreatEventsCursor once events of a page have been delivered,
+        so events are delivered at least once, even if the script stops
+        Param:
+            event_filter: optional EventFilter object selecting events and fields. Sent to the API when
+                          events_pushdown is set, and always applied to events pulled
+        Result:
+            yields (list of events json, cursor after last event of the page). List can be empty when no event
+            of the page matches filter, cursor must still be committed
+        """
 
         # Forge first events query
         if self.threat_events_cursor == "":
             event_query = self.url + 'events?page[limit]=' + str(self.events_page_limit) + '&sort=timestamp'
         else:
             event_query = self.url + 'events?page[limit]=' + str(self.events_page_limit) + '&page[cursor]=' + self.threat_events_cursor + '&sort=timestamp'
+        if event_filter and self.events_pushdown:
+            event_query += event_filter.queryParameters()
         logger.debug('Threat events next query: {0}'.format(event_query))
 
         # Query loop to pull all new threat events
-        while event_query:
-            logger.debug('pullThreatEvents sent query: {0}'.format(event_query))
-            logger.debug('Headers: {0}'.format(self.headers))
-            response = self.__request('get', event_query)
-            logger.debug('pullThreatEvents response: {0}'.format(response))
-            
-            if self.__responseCheck(response):
-                data = response.json()
-                logger.debug('Data collected: {0}'.format(data))
+        for data in self.__pages(event_query, 'pullThreatEvents', self.short_url, 'events'):
 
-                # Concatenate all new threat events
-                for i in range(len(data['data'])):
-                    logger.debug('New threat event: {0}'.format(data['data'][i]['attributes']))
-                    threat_events.append(data['data'][i]['attributes'])
+            # Stop if no new threat events
+            if len(data['data']) == 0:
+                logger.info('No new threat events to pull')
+                return
 
-                try:
-                    event_query = self.short_url + data['links']['next']
-                    logger.debug('pullThreatEvents next query: {0}'.format(event_query))
-                except:
-                    event_query = ""
-                    logger.debug('pullThreatEvents next query: none')
-
-                # Update threat event cursor if new events are pulled
-                if len(threat_events) == 0:
-                    logger.info('No new threat events to pull')
-                    return threat_events
-                else:
-                    last_event = data['data'][-1]
-                    self.__updateThreatEventsCursor(last_event['id'], last_event['attributes']['timestamp'])
-            
-            else:
-                logger.info('Waiting 60 seconds before next try')
-                time.sleep(60)
+            # Cursor after last event of the page, taken before filtering
+            self.threat_events_pulled += len(data['data'])
+            last_event = data['data'][-1]
+            cursor = last_event['id'] + '_:_' + last_event['attributes']['timestamp']
 
-        logger.info('{0} new threat events have been pulled'.format(len(threat_events)))
-        return threat_events
\ No newline at end of file
+            # Filter is applied again, next pages links may not carry it and some conditions may not be supported
+            events = [event['attributes'] for event in data['data']]
+            yield (event_filter.apply(events) if event_filter else events), cursor
@@ -6,12 +6,9 @@
 #
 # Contact : philippe.le.bescond(at)trellix.com
 
-import json
 import argparse
 import os
 import sys
-import logging
-from logging.handlers import SysLogHandler
 import time
 
 # Setting path for module import
@@ -19,23 +16,39 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 
 import lib.trellixAPI as trellixAPI
 from lib.trellixAPI import logger
+from lib.sinks import FileSink, SyslogSink, Pipeline, SinkError
+from lib.scheduler import PollScheduler
+from lib.dedup import DedupStore
+from lib.eventFilter import EventFilter
 
-### Constants ###
+### Functions ###
 
-# Pull interval in seconds
-PULL_INTERVAL = 600
-LOGGER_NAME = 'Trellix threat event'
+def splitList(value):
+    # Comma separated argument to list, None if not set
+    if not value:
+        return None
+    return [item.strip() for item in value.split(',') if item.strip()]
 
-### Functions ###
 
 def main():
     
     # Script usage
     parser = argparse.ArgumentParser(description='Pull threat events from Trellix ePO SaaS',
-                                     usage='pullThreatEvents.py [-f file] [-s syslog_server] [-p syslog_port]')
+                                     usage='pullThreatEvents.py [-f file] [-F ndjson|raw] [-s syslog_server] [-p syslog_port] [-t udp|tcp|tls] [-c ca_file] [-d]\n'
+                                           '       [-S max_severity] [-a analyzers] [-C categories] [--since timestamp] [--until timestamp] [-o fields]')
     parser.add_argument('-f', '--file', type=str, help='File where to write threat events')
+    parser.add_argument('-F', '--format', type=str, choices=['ndjson', 'raw'], default='ndjson', help='Events format, in file and syslog messages: one JSON event per line or raw data. Default is ndjson')
     parser.add_argument('-s', '--server', type=str, help='Syslog server address where to send threat events')
     parser.add_argument('-p', '--port', type=int, help='Syslog server address where to send threat events')
+    parser.add_argument('-t', '--protocol', type=str, choices=['udp', 'tcp', 'tls'], default='tcp', help='Syslog protocol. Default is tcp')
+    parser.add_argument('-c', '--ca', type=str, help='CA file used to verify syslog server certificate with tls protocol. Default is system CAs')
+    parser.add_argument('-d', '--dedup', action='store_true', help='Drop threat events already delivered, when events are pulled again')
+    parser.add_argument('-S', '--severity', type=int, help='Keep threat events with this severity or a more severe one (lower value)')
+    parser.add_argument('-a', '--analyzers', type=str, help='Keep threat events from these analyzers, separated by commas')
+    parser.add_argument('-C', '--categories', type=str, help='Keep threat events of these threat categories, separated by commas')
+    parser.add_argument('--since', type=str, help='Keep threat events from this UTC timestamp, like 2024-03-07T00:00:00.000Z')
+    parser.add_argument('--until', type=str, help='Keep threat events before this UTC timestamp')
+    parser.add_argument('-o', '--fields', type=str, help='Keep only these event fields, separated by commas. timestamp and autoguid are always kept')
 
     # Parse arguments
     args = parser.parse_args()
@@ -58,54 +71,68 @@ def main():
     # Open Trellix API session
     session = trellixAPI.Trellix()
 
-    # Configure file logger
-    if args.file != None:
-        logger.info('Setting up log file to write threat events in {0}'.format(args.file))
-        file_logger = logging.getLogger(LOGGER_NAME)
-        file_log_handler = logging.FileHandler(args.file)
-        file_logger.addHandler(file_log_handler)
-        file_logger.setLevel(level=logging.INFO)
-
-    # Configue syslog logger
-    if args.server != None:
-        logger.info('Setting up Syslog server to send threat events to {0}:{1}'.format(args.server, args.port))
-        syslog_logger = logging.getLogger(LOGGER_NAME)
-        syslog_log_handler = SysLogHandler(address=(args.server, args.port))
-        syslog_logger.addHandler(syslog_log_handler)
-        syslog_logger.setLevel(level=logging.INFO)
+    # Pull interval follows event rate, within daily budget and latency target
+    scheduler = PollScheduler(session)
+
+    # Estimate queries until quota reset at end of UTC day: pulls are paced to stay within budget
+    session.estimate(scheduler.estimate())
+
+    # Configure sinks, each one writes batches of events in its own thread
+    sinks = []
+    if file:
+        logger.info('Setting up log file to write threat events in {0} ({1})'.format(args.file, args.format))
+        sinks.append(FileSink(args.file, args.format))
+
+    if syslog:
+        logger.info('Setting up Syslog server to send threat events to {0}:{1} ({2})'.format(args.server, args.port, args.protocol))
+        sinks.append(SyslogSink(args.server, args.port, args.protocol, args.ca, format = args.format))
+
+    # Optional filter and field projection, applied before deduplication and delivery
+    event_filter = EventFilter(args.severity, splitList(args.analyzers), splitList(args.categories), args.since, args.until, splitList(args.fields))
+    if event_filter:
+        logger.info('Threat events filter: {0}, fields: {1}'.format(event_filter.apiFilter(), event_filter.fields or 'all'))
+
+    # Optional deduplication of events pulled again after a crash or a lost cursor
+    dedup = DedupStore(session.tenant) if args.dedup else None
+
+    # Cursor is committed once events have been written by all sinks
+    pipeline = Pipeline(sinks, session.commitThreatEventsCursor)
 
     logger.warning('Starting collecting new threat events...')
 
     # Pull event loop
     while True:
-        # Reauth each pull to refresh token (useful if PULL_INTERVAL >= 600)
-        session.auth()
+        # Token is refreshed by queries only when it is about to expire
+        queries = session.quota.used()
+        pulled = session.threat_events_pulled
 
-        # Pull threat events events
+        # Pull threat events, page by page. Pulling pauses while a sink queue is full
         logger.info('Pulling new threat events...')
-        event_list = session.pullThreatEvents()
-        logger.debug('List of pulled events:')
-        logger.debug(event_list)
-
-        # Write each event in correct loggers
-        if file and syslog:
-            for event in event_list:
-                print(type(event))
-                file_logger.info(event)
-                syslog_logger.info(event)
-
-        elif file:
-            for event in event_list:
-                file_logger.info(event)
-
-        elif syslog:
-            for event in event_list:
-                syslog_logger.info('New event:')
-                syslog_logger.info(event)
-
-        # Wait next pull
-        logger.debug('Waiting {0} seconds until next pull'.format(PULL_INTERVAL))
-        time.sleep(PULL_INTERVAL)
+        try:
+            for event_list, cursor in session.iterThreatEventPages(event_filter):
+                # Duplicates are dropped, cursor is still delivered to be committed
+                if dedup:
+                    event_list = dedup.filter(event_list)
+                pipeline.deliver(event_list, cursor)
+
+            # All events of this pull are delivered before waiting
+            pipeline.drain()
+
+        # Cursor is left after last events delivered, they are pulled again at next start
+        except SinkError as e:
+            logger.error('Failed to deliver threat events: {0}. Exiting...'.format(e))
+            sys.exit()
+
+        # Keys are saved only once their events are delivered
+        if dedup:
+            dedup.save()
+            stats = dedup.stats()
+            logger.info('Deduplication: {0} duplicate(s) dropped, {1} new event(s) since start'.format(stats['hits'], stats['misses']))
+
+        # Wait next pull, event rate is measured before filtering as pages are full or not
+        interval = scheduler.next(session.threat_events_pulled - pulled, session.quota.used() - queries)
+        logger.debug('Waiting {0} seconds until next pull'.format(int(interval)))
+        time.sleep(interval)
         
 
 if __name__ == "__main__":
@@ -12,115 +12,169 @@ import argparse
 import os
 import sys
 import bisect
+import tempfile
 
 # Setting path for module import
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import lib.trellixAPI as trellixAPI
 from lib.trellixAPI import logger
+from lib.asyncTrellixAPI import AsyncTrellix, Progress, iterate
+from lib.export import SnapshotExport, productRows
 
-def systemsProducts(devices):
+async def __systemsProductsAsync(devices, workers):
 
     # Authenticate to Trellix API
-    session = trellixAPI.Trellix()
+    async with await AsyncTrellix.create(workers) as session:
 
-    # Initiate device props list
-    data = []
+        # Estimate queries: device ids by chunks of names, then installed products for each device
+        session.trellix.estimate(len(session.trellix.deviceNameChunks(devices)) + len(devices))
 
-    logger.warning('Starting collecting products from {0} device(s)...'.format(len(devices)))
-    logger.info('Devices list: {0}'.format(devices))
+        logger.warning('Starting collecting products from {0} device(s) with {1} workers...'.format(len(devices), session.max_in_flight))
+        logger.info('Devices list: {0}'.format(devices))
 
-    # Collecting properties from each device
-    for device in devices:
-        
-        # Get device id for each device in list
-        device_id = session.getDeviceId(device)
-
-        # TODO : Manage duplicate entries
-        
-        # If device has been found in ePO
-        if device_id:
-            logger.info('Device {0} id: {1}'.format(device, device_id))
-
-            # Format device data
-            # If system is a duplicate entry
-            if isinstance(device_id, list):
-                for id in device_id:
-                    device_data = {"name": device,
-                            "id": id}
-
-                    # Collect products list for device
-                    product_list = session.getInstalledProducts(id)
-                    product_list_filtered = [product['attributes'] for product in product_list]
-
-                    # Add it to products list
-                    device_data["products"] = product_list_filtered
-                    data.append(device_data)                    
-            else:
-                device_data = {"name": device,
-                           "id": device_id}
+        # Get device ids for all devices in list
+        resolved, not_found = await session.resolveDevices(devices)
 
-                # Collect products list for device
-                product_list = session.getInstalledProducts(device_id)
-                product_list_filtered = [product['attributes'] for product in product_list]
+        # Devices that have not been found
+        for device in not_found:
+            logger.info('Device {0} not found'.format(device))
 
-                # Add it to products list
-                device_data["products"] = product_list_filtered
-                data.append(device_data)
+        # Several ids if duplicate entries, in devices list order whatever order the API returned them
+        targets = [(device, id) for device in dict.fromkeys(devices) for id in resolved.get(device, [])]
 
-        # If device has not been found
-        elif device_id == 0:
-            logger.info('Device {0} not found'.format(device))
+        async def collect(target):
+            return await session.getInstalledProducts(target[1])
 
-    return data
+        # Collecting products concurrently, devices are returned in list order as soon as they are collected
+        progress = Progress('installedProducts', len(targets))
+        async for (device, id), product_list, error in session.stream(collect, targets, progress = progress):
+            device_data = {"name": device,
+                           "id": id}
 
+            # A device failing does not stop collection, error is written in its data
+            if error is not None:
+                logger.error('Failed to collect products from device {0} ({1}): {2}'.format(device, id, repr(error)))
+                device_data["products"] = []
+                device_data["error"] = repr(error)
+            else:
+                device_data["products"] = [product['attributes'] for product in product_list]
+            yield device_data
 
-def __csvParser(data):
+        progress.summary()
 
-    # Parse json list to csv
-    parsed_data = ''
-    
-    # Checking if data available
-    if len(data) == 0:
-        return 'No data found'
-    
-    product_list = []
-    
-    # Creating product list
-    for device in data:
-        for product in device['products']:
-            if product['productFamilyName'] not in product_list:
-                bisect.insort(product_list, product['productFamilyName'])
-    logger.debug('List of all products found for CSV: {0}'.format(product_list))
 
-    # Add System name property and add product list to CSV 
-    product_list.insert(0, 'System Name')
-    parsed_data = ','.join(product_list)
+def systemsProducts(devices, workers = 0):
 
-    # Collecting product versions from systems
-    device_products_list = []
-    for device in data:
-        device_products = {key: '' for key in product_list}
-        device_products['System Name'] = device['name']
-        for product in device['products']:
-            device_products[product['productFamilyName']] = product['productVersion']
-        device_products = list(device_products.values())
-        device_products_list.append(device_products)
-        logger.debug('list of product versions collected from system {0}: {1}'.format(device, device_products_list))
+    # Collecting products of devices concurrently
+    if workers:
+        yield from iterate(__systemsProductsAsync, devices, workers)
+        return
 
-        # Formating in CSV
-        device_data = ','.join(device_products)
-        parsed_data = '\n'.join([parsed_data, device_data])
+    # Authenticate to Trellix API
+    session = trellixAPI.Trellix()
 
-    return parsed_data
+    # Estimate queries: device ids by chunks of names, then installed products for each device
+    session.estimate(len(session.deviceNameChunks(devices)) + len(devices))
+
+    logger.warning('Starting collecting products from {0} device(s)...'.format(len(devices)))
+    logger.info('Devices list: {0}'.format(devices))
+
+    # Get device ids for all devices in list
+    resolved, not_found = session.resolveDevices(devices)
+
+    # Devices that have not been found
+    for device in not_found:
+        logger.info('Device {0} not found'.format(device))
+
+    # Collecting products from each device found in ePO, in devices list order
+    for device in dict.fromkeys(devices):
+        device_ids = resolved.get(device, [])
+        if not device_ids:
+            continue
+        logger.info('Device {0} id: {1}'.format(device, device_ids))
+
+        # Several ids if duplicate entries
+        for id in device_ids:
+            device_data = {"name": device,
+                           "id": id}
+
+            # Collect products list for device, a device failing does not stop collection
+            try:
+                product_list = session.getInstalledProducts(id)
+            except (Exception, SystemExit) as e:
+                logger.error('Failed to collect products from device {0} ({1}): {2}'.format(device, id, repr(e)))
+                device_data["products"] = []
+                device_data["error"] = repr(e)
+                yield device_data
+                continue
+            product_list_filtered = [product['attributes'] for product in product_list]
+
+            # Return device data as soon as it is collected
+            device_data["products"] = product_list_filtered
+            yield device_data
+
+
+def __csvWriter(data, output):
+
+    # Product columns are only known once all devices are collected,
+    # so devices are spooled in a temporary file instead of being kept in memory
+    product_list = []
+    with tempfile.TemporaryFile('w+') as spool:
+
+        # Creating product list
+        for device in data:
+            for product in device['products']:
+                if product['productFamilyName'] not in product_list:
+                    bisect.insort(product_list, product['productFamilyName'])
+            spool.write(json.dumps(device) + '\n')
+        logger.debug('List of all products found for CSV: {0}'.format(product_list))
+
+        # Checking if data available
+        if spool.tell() == 0:
+            output.write('No data found\n')
+            return
+
+        # Add System name property and add product list to CSV 
+        product_list.insert(0, 'System Name')
+        output.write(','.join(product_list) + '\n')
+
+        # Collecting product versions from systems
+        spool.seek(0)
+        for line in spool:
+            device = json.loads(line)
+            device_products = {key: '' for key in product_list}
+            device_products['System Name'] = device['name']
+            for product in device['products']:
+                device_products[product['productFamilyName']] = product['productVersion']
+            device_products = list(device_products.values())
+            logger.debug('list of product versions collected from system {0}: {1}'.format(device, device_products))
+
+            # Formating in CSV
+            output.write(','.join(device_products) + '\n')
+
+
+def __jsonWriter(data, output):
+
+    # Write devices data in json, one device at a time, formatted like json.dumps({"data": data}, indent = 4)
+    output.write('{\n    "data": [')
+
+    separator = '\n'
+    for device in data:
+        output.write(separator + '        ' + json.dumps(device, indent = 4).replace('\n', '\n        '))
+        separator = ',\n'
+
+    output.write(']\n}\n' if separator == '\n' else '\n    ]\n}\n')
 
 
 def main():
 
     # Script usage
-    parser = argparse.ArgumentParser(description = 'Get installed products from a systems list', usage = 'systemProperties <filename> -o [csv|json]')
+    parser = argparse.ArgumentParser(description = 'Get installed products from a systems list', usage = 'installedProducts <filename> -o [csv|json] [-w workers] [-e folder]')
     parser.add_argument('filename', type=str, help = 'Filepath containing device names')
     parser.add_argument('-o', '--output', nargs='?', default = 'json', type=str, help = 'Output format, can be csv or json. Output is json by default')
+    parser.add_argument('-e', '--export', type=str, help = 'Export a snapshot in this folder, in Parquet or compressed NDJSON, instead of writing to standard output')
+    parser.add_argument('-w', '--workers', type=int, default = 0, help = 'Number of queries sent at the same time. By default queries are sent one by one')
 
     # Parse arguments
     args = parser.parse_args()    
@@ -140,17 +194,20 @@ def main():
             sys.exit()
 
     # Collect system products
-    data = systemsProducts(devices)
+    data = systemsProducts(devices, args.workers)
+
+    # Export snapshot while it is collected, one row per installed product
+    if args.export:
+        with SnapshotExport(args.export, 'installedProducts') as export:
+            for device in data:
+                export.writeAll(productRows(device))
 
-    # Write data
-    if args.output.casefold() == 'csv':
-        parsed_data = __csvParser(data)
-        print(parsed_data)
+    # Write data while it is collected
+    elif args.output.casefold() == 'csv':
+        __csvWriter(data, sys.stdout)
 
     else:
-        parsed_data = {}
-        parsed_data['data'] = data
-        print(json.dumps(parsed_data, indent = 4))
+        __jsonWriter(data, sys.stdout)
 
 
 if __name__ == "__main__":
@@ -11,100 +11,185 @@ import json
 import argparse
 import os
 import sys
+import asyncio
+import math
 
 # Setting path for module import
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import lib.trellixAPI as trellixAPI
 from lib.trellixAPI import logger
+from lib.asyncTrellixAPI import AsyncTrellix
+from lib.inventory import Inventory
+from lib.snapshot import Snapshot
+from lib.export import SnapshotExport
 
-def systemsProperties(props, devices = []):
+async def __systemsPropertiesAsync(props, devices, workers):
+
+    # Authenticate to Trellix API
+    async with await AsyncTrellix.create(workers) as session:
+
+        # Estimate queries: device ids by chunks of names, then properties for each device
+        session.trellix.estimate(len(session.trellix.deviceNameChunks(devices)) + len(devices))
+
+        logger.warning('Starting collecting properties from {0} device(s) with {1} workers...'.format(len(devices), session.max_in_flight))
+        logger.info('Devices list: {0}'.format(devices))
+
+        # Get device ids for all devices in list, several ids if duplicate entries
+        resolved, not_found = await session.resolveDevices(devices)
+        id_list = [id for device_ids in resolved.values() for id in device_ids]
+
+        # Devices that have not been found
+        for device in not_found:
+            logger.info('Device {0} not found'.format(device))
+
+        # Collect all props if all is specified
+        if 'all' in props:
+            results = await session.gather(session.collectProperties, id_list)
+        # Else collect specfified props
+        else:
+            results = await session.gather(session.collectProperties, id_list, props)
+
+        # Devices which properties could not be collected return 0
+        return [properties for properties in results if properties]
+
+
+def __collectDevices(session, resolved, props):
+
+    # Collecting properties from each device found in ePO
+    for device, device_ids in resolved.items():
+
+        logger.info('Device {0} id: {1}'.format(device, device_ids))
+
+        # Several ids if duplicate entries
+        for id in device_ids:
+            # Collect all props if all is specified
+            if 'all' in props:
+                properties = session.collectProperties(id)
+            # Else collect specfified props
+            else:
+                properties = session.collectProperties(id, props)
+
+            if properties:
+                yield properties
+
+
+def __deltaProperties(props):
 
     # Authenticate to Trellix API
     session = trellixAPI.Trellix()
+    snapshot = Snapshot(props)
+
+    # Estimate queries: all devices pages for a full collection, a few pages for an incremental one
+    if snapshot.isFullSyncDue():
+        session.estimate(math.ceil(session.getDeviceCount() / session.device_page_limit))
+    else:
+        session.estimate(1)
+
+    yield from snapshot.delta(session)
+
+    # Snapshot is saved once all changes have been written
+    snapshot.save()
+
 
-    # Initiate device props list
-    data = []
+def systemsProperties(props, devices = [], workers = 0, use_inventory = False, delta = False):
+
+    # Collecting only devices added, changed or removed since last run
+    if len(devices) == 0 and delta:
+        return __deltaProperties(props)
+
+    # Reading properties of all devices from local inventory, if it stores all requested properties
+    if len(devices) == 0 and use_inventory:
+        inventory = Inventory()
+        if 'all' not in props and set(props) <= set(inventory.props):
+            if not inventory.isFresh():
+                inventory.sync(trellixAPI.Trellix())
+            return inventory.properties(props)
+        logger.warning('Properties {0} are not all stored in local inventory, collecting them from ePO'.format(props))
 
     # Collecting properties of all devices if no specific devices
     if len(devices) == 0:
+
+        # Authenticate to Trellix API
+        session = trellixAPI.Trellix()
+
+        # Estimate queries: all devices pages
+        device_count = session.getDeviceCount()
+        session.estimate(math.ceil(device_count / session.device_page_limit))
         
-        # Collecting all props if all is specified
+        # Collecting all props if all is specified, page by page
         if 'all' in props:
-            return session.collectAllProperties()
+            return session.iterAllProperties()
         # Else collect specfified props
         else:
-            return session.collectAllProperties(props)
+            return session.iterAllProperties(props)
+
+    # Collecting properties of devices concurrently
+    elif workers:
+        return asyncio.run(__systemsPropertiesAsync(props, devices, workers))
 
     else:
         logger.warning('Starting collecting properties from {0} device(s)...'.format(len(devices)))
         logger.info('Devices list: {0}'.format(devices))
 
-        # Collecting properties from each device
-        for device in devices:
-            
-            # Get device id for each device in list
-            device_id = session.getDeviceId(device)
-            
-            # If device has been found in ePO
-            if device_id:
-
-                logger.info('Device {0} id: {1}'.format(device, device_id))
-
-                # If system is a duplicate entry
-                if isinstance(device_id, list):
-                    for id in device_id:
-                        # Collect all props if all is specified
-                        if 'all' in props:
-                            data.append(session.collectProperties(id))
-                        # Else collect specfified props
-                        else:
-                            data.append(session.collectProperties(id, props))        
-                else:
-                    # Collect all props if all is specified
-                    if 'all' in props:
-                        data.append(session.collectProperties(device_id))
-                    # Else collect specfified props
-                    else:
-                        data.append(session.collectProperties(device_id, props))
-
-            # If device has not been found
-            elif device_id == 0:
-                logger.info('Device {0} not found'.format(device))
-
-        return data
-
-
-def __csvParser(data):
-
-    # Parse json list to csv
-    parsed_data = ''
-    
-    # Adding csv columns in first line
-    if len(data):
-        parsed_data = ','.join(list(data[0].keys()))
-    else:
-        parsed_data = 'No data found'
-    
-    # Parsing each device data
+        # Authenticate to Trellix API
+        session = trellixAPI.Trellix()
+
+        # Estimate queries: device ids by chunks of names, then properties for each device
+        session.estimate(len(session.deviceNameChunks(devices)) + len(devices))
+
+        # Get device ids for all devices in list
+        resolved, not_found = session.resolveDevices(devices)
+
+        # Devices that have not been found
+        for device in not_found:
+            logger.info('Device {0} not found'.format(device))
+
+        # Collecting properties from each device found in ePO, device by device
+        return __collectDevices(session, resolved, props)
+
+
+def __csvWriter(data, output):
+
+    # Write devices data in csv, one device at a time
+    columns = False
+
     for device in data:
 
+        # Adding csv columns in first line
+        if not columns:
+            output.write(','.join(list(device.keys())) + '\n')
+            columns = True
+
         device_data = []
 
         for key in device:
             # Replacing commas by semicolon in properties (especially tags) to avoid issue in CSV
             device_data.append(str(device[key]).replace(',',';'))
 
-        device_data = ','.join(device_data)
-        parsed_data = '\n'.join([parsed_data, device_data])
+        output.write(','.join(device_data) + '\n')
+
+    if not columns:
+        output.write('No data found\n')
+
 
-    return parsed_data
+def __jsonWriter(data, output):
+
+    # Write devices data in json, one device at a time, formatted like json.dumps({"data": data}, indent = 4)
+    output.write('{\n    "data": [')
+
+    separator = '\n'
+    for device in data:
+        output.write(separator + '        ' + json.dumps(device, indent = 4).replace('\n', '\n        '))
+        separator = ',\n'
+
+    output.write(']\n}\n' if separator == '\n' else '\n    ]\n}\n')
 
 
 def main():
 
     # Script usage
-    parser = argparse.ArgumentParser(description = 'Get system properties of list of device names', usage = 'systemProperties <properties> <filename> -o [csv|json]')
+    parser = argparse.ArgumentParser(description = 'Get system properties of list of device names', usage = 'systemProperties <properties> <filename> -o [csv|json] [-w workers] [-i] [-D] [-e folder]')
     parser.add_argument(
         'properties', type = str, help = 'List of properties to collect. Must be a list of properties separated by commas, from those properties:\n'
         'id, name, parentId, epoGroup, agentGuid, lastUpdate, agentState, nodePath, agentPlatform, agentVersion,'
@@ -114,6 +199,10 @@ def main():
     )
     parser.add_argument('filename', type=str, help = 'Filepath containing device names')
     parser.add_argument('-o', '--output', nargs='?', default = 'json', type=str, help = 'Output format, can be csv or json. Output is json by default')
+    parser.add_argument('-i', '--inventory', action='store_true', help = '(Optional) Read properties of all systems from local inventory, if it stores them')
+    parser.add_argument('-D', '--delta', action='store_true', help = '(Optional) Only write systems added, changed or removed since last run with -D, when collecting properties of all systems')
+    parser.add_argument('-e', '--export', type=str, help = '(Optional) Export a snapshot in this folder, in Parquet or compressed NDJSON, instead of writing to standard output')
+    parser.add_argument('-w', '--workers', type=int, default = 0, help = '(Optional) Number of queries sent at the same time when collecting properties from a device list')
 
     # Parse arguments
     args = parser.parse_args()    
@@ -134,18 +223,25 @@ def main():
             logger.error('Error while opening {0} file'.format(args.filename))
             sys.exit()
 
+    # Delta is computed against a snapshot of all systems
+    if args.delta and devices:
+        logger.error('Delta collection (-D) is only available for all systems')
+        sys.exit()
+
     # Collect system properties
-    data = systemsProperties(props, devices)
+    data = systemsProperties(props, devices, args.workers, args.inventory, args.delta)
+
+    # Export snapshot while it is collected, changes have their own dataset
+    if args.export:
+        with SnapshotExport(args.export, 'propertyChanges' if args.delta else 'systemsProperties') as export:
+            export.writeAll(data)
 
-    # Write data
-    if args.output.casefold() == 'csv':
-        parsed_data = __csvParser(data)
-        print(parsed_data)
+    # Write data while it is collected
+    elif args.output.casefold() == 'csv':
+        __csvWriter(data, sys.stdout)
 
     else:
-        parsed_data = {}
-        parsed_data['data'] = data
-        print(json.dumps(parsed_data, indent = 4))
+        __jsonWriter(data, sys.stdout)
 
 
 if __name__ == "__main__":
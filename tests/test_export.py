@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+#
+# Snapshot export tests, run against the stand-in server of benchmark folder
+#
+# Copyright (C) 2023 Philippe Le Bescond
+#
+# Contact : philippe.le.bescond(at)trellix.com
+
+import gzip
+import json
+import os
+import shutil
+import sys
+
+import pytest
+
+# Setting path for module import
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'benchmark')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'systemProperties')))
+
+from standInServer import StandInServer, useStandInProfile
+
+DEVICES = 50
+
+
+@pytest.fixture(scope = 'module')
+def standIn():
+
+    # Profile pointing to stand-in server must be written before the library is imported, as it loads profile at import
+    server = StandInServer(devices = DEVICES).start()
+    cwd = os.getcwd()
+    folder = useStandInProfile(server)
+    yield server
+
+    os.chdir(cwd)
+    server.stop()
+    shutil.rmtree(folder, ignore_errors = True)
+
+
+def exportRows(folder, data):
+
+    # Export data in compressed NDJSON, which needs no optional module, and read rows back
+    from lib.export import SnapshotExport
+
+    with SnapshotExport(str(folder), 'systemsProperties', format = 'ndjson') as export:
+        export.writeAll(data)
+    with gzip.open(export.path, 'rt', encoding = 'utf-8') as export_file:
+        return [json.loads(line) for line in export_file]
+
+
+def test_all_systems_export_id(standIn, tmp_path):
+
+    from systemsProperties import systemsProperties
+
+    rows = exportRows(tmp_path, systemsProperties(['name', 'tags']))
+
+    assert len(rows) == DEVICES
+    assert [row['id'] for row in rows] == list(range(1, DEVICES + 1))
+    assert all(row['name'] == 'host{0}'.format(row['id']) for row in rows)
+
+
+def test_system_list_export_id(standIn, tmp_path):
+
+    from systemsProperties import systemsProperties
+
+    rows = exportRows(tmp_path, systemsProperties(['name'], ['host3', 'host7']))
+
+    assert [(row['id'], row['name']) for row in rows] == [(3, 'host3'), (7, 'host7')]